@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Common Python library imports
+from __future__ import unicode_literals
+
+import io
+import os
+
+# Pip package imports
+from PIL import Image
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+# Internal package imports
+import flask_mm as mm
+from flask_mm.managers.image import resize_and_crop
+from flask_mm.postprocess import Watermarker
+
+from .conftest import IMAGE_SIZES, IMAGE_FORMATS, SOURCE_IMAGE, image_bytes, filestorage
+
+ROUNDS = {
+    'small': 20,
+    'medium': 10,
+    'large': 3,
+}
+
+@pytest.mark.benchmark(group='image.save')
+@pytest.mark.parametrize('format', IMAGE_FORMATS)
+@pytest.mark.parametrize('size', sorted(IMAGE_SIZES))
+def bench_image_save(benchmark, local_app, size, format):
+    local_app(MANAGER='image')
+    st = mm.by_name()
+    content = image_bytes(size, format)
+
+    def setup():
+        return (filestorage(content, 'image.' + format.lower()), ), {}
+
+    benchmark.pedantic(st.save, setup=setup, rounds=ROUNDS[size])
+
+@pytest.mark.benchmark(group='image.save')
+@pytest.mark.parametrize('size', sorted(IMAGE_SIZES))
+def bench_image_save_webp(benchmark, local_app, size):
+    local_app(MANAGER='image', OUTPUT_FORMAT='WEBP')
+    st = mm.by_name()
+    content = image_bytes(size, 'JPEG')
+
+    def setup():
+        return (filestorage(content, 'image.jpg'), ), {}
+
+    benchmark.pedantic(st.save, setup=setup, rounds=ROUNDS[size])
+
+@pytest.mark.benchmark(group='image.resize_and_crop')
+@pytest.mark.parametrize('crop_type', ['top', 'middle'])
+@pytest.mark.parametrize('size', sorted(IMAGE_SIZES))
+def bench_resize_and_crop(benchmark, size, crop_type):
+    image = Image.open(io.BytesIO(image_bytes(size, 'JPEG')))
+    image.load()
+
+    benchmark.pedantic(resize_and_crop, args=(image, 200, 200, crop_type), rounds=ROUNDS[size])
+
+@pytest.mark.benchmark(group='postprocess.watermark')
+@pytest.mark.parametrize('size', sorted(IMAGE_SIZES))
+def bench_watermark(benchmark, size):
+    image = Image.open(io.BytesIO(image_bytes(size, 'JPEG')))
+    image.load()
+    watermarker = Watermarker(SOURCE_IMAGE, opacity=0.08, scale=0.2, position='c')
+
+    benchmark.pedantic(watermarker.process, args=(image, ), rounds=ROUNDS[size])
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Common Python library imports
+from __future__ import unicode_literals
+
+# Pip package imports
+from flask import url_for
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+# Internal package imports
+import flask_mm as mm
+
+from .conftest import image_bytes, filestorage
+
+URLS = 100
+
+@pytest.mark.benchmark(group='manager.url')
+@pytest.mark.parametrize('external', [False, True])
+def bench_url_view(benchmark, local_app, external):
+    local_app(MANAGER='file')
+    st = mm.by_name()
+
+    benchmark(st.url, 'ed5a4d6c-1d1a-4b8e-9a1c-3c8a3b1f0e2d_sep_image.jpg', external)
+
+@pytest.mark.benchmark(group='manager.url')
+def bench_url_storage(benchmark, s3_app):
+    s3_app(MANAGER='file')
+    st = mm.by_name()
+
+    benchmark(st.url, 'ed5a4d6c-1d1a-4b8e-9a1c-3c8a3b1f0e2d_sep_image.jpg')
+
+@pytest.mark.benchmark(group='manager.urls')
+def bench_urls(benchmark, local_app):
+    local_app(MANAGER='file')
+    st = mm.by_name()
+    filenames = [st.generate_name('image.jpg') for _ in range(URLS)]
+
+    benchmark(st.urls, filenames)
+
+@pytest.mark.benchmark(group='view.get_file')
+def bench_get_file(benchmark, local_app):
+    app = local_app(MANAGER='file')
+    st = mm.by_name()
+    st.storage.write('image.jpg', image_bytes('medium', 'JPEG'))
+    client = app.test_client()
+    file_url = url_for('mm.get_file', mm=st.name, filename='image.jpg')
+
+    def get():
+        response = client.get(file_url)
+        response.close()
+        return response
+
+    assert benchmark(get).status_code == 200
+
+@pytest.mark.benchmark(group='view.get_file')
+@pytest.mark.parametrize('accept', ['image/jpeg', 'image/webp'])
+def bench_get_image_negotiated(benchmark, local_app, accept):
+    app = local_app(MANAGER='image', ALTERNATE_FORMATS=['WEBP'])
+    st = mm.by_name()
+    filename = st.save(filestorage(image_bytes('medium', 'JPEG'), 'image.jpg'))
+    client = app.test_client()
+    file_url = url_for('mm.get_file', mm=st.name, filename=filename)
+
+    def get():
+        response = client.get(file_url, headers={'Accept': accept})
+        response.close()
+        return response
+
+    assert benchmark(get).status_code == 200
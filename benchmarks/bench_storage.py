@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Common Python library imports
+from __future__ import unicode_literals
+
+import itertools
+
+# Pip package imports
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+# Internal package imports
+import flask_mm as mm
+
+from .conftest import PAYLOAD_SIZES, payload
+
+LIST_FILES = 100
+ARCHIVE_FILES = 10
+
+@pytest.fixture(params=['local', 's3'])
+def storage_app(request):
+    '''
+    Parametrize a benchmark over the local and the S3 storage
+    '''
+    return request.getfixturevalue(request.param + '_app')
+
+@pytest.mark.benchmark(group='storage.write')
+@pytest.mark.parametrize('size', sorted(PAYLOAD_SIZES))
+def bench_write(benchmark, storage_app, size):
+    storage_app(MANAGER='file')
+    st = mm.by_name()
+    content = payload(size)
+    names = ('write-%d.bin' % i for i in itertools.count())
+
+    benchmark(lambda: st.storage.write(next(names), content))
+
+@pytest.mark.benchmark(group='storage.read')
+@pytest.mark.parametrize('size', sorted(PAYLOAD_SIZES))
+def bench_read(benchmark, storage_app, size):
+    storage_app(MANAGER='file')
+    st = mm.by_name()
+    st.storage.write('read.bin', payload(size))
+
+    benchmark(st.storage.read, 'read.bin')
+
+@pytest.mark.benchmark(group='storage.metadata')
+@pytest.mark.parametrize('size', sorted(PAYLOAD_SIZES))
+def bench_metadata(benchmark, storage_app, size):
+    storage_app(MANAGER='file')
+    st = mm.by_name()
+    st.storage.write('metadata.bin', payload(size))
+
+    benchmark(st.storage.metadata, 'metadata.bin')
+
+@pytest.mark.benchmark(group='storage.list_files')
+def bench_list_files(benchmark, storage_app):
+    storage_app(MANAGER='file')
+    st = mm.by_name()
+    for i in range(LIST_FILES):
+        st.storage.write('list-%d.bin' % i, b'')
+
+    benchmark(lambda: list(st.list_files()))
+
+@pytest.mark.benchmark(group='storage.archive_files')
+def bench_archive_files(benchmark, storage_app):
+    storage_app(MANAGER='file')
+    st = mm.by_name()
+    filenames = []
+    for i in range(ARCHIVE_FILES):
+        filenames.append('archive-%d.bin' % i)
+        st.storage.write(filenames[-1], payload('64k'))
+
+    benchmark(st.archive_files, 'archive.zip', filenames)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Common Python library imports
+from __future__ import unicode_literals
+
+import io
+import os
+
+# Pip package imports
+from flask import Flask
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+import pytest
+
+# Internal package imports
+import flask_mm as mm
+
+from tests.s3server import s3_endpoint
+
+SOURCE_IMAGE = os.path.join(os.path.dirname(__file__), '..', 'tests', 'flask.png')
+
+#: Image sizes used by the benchmarks, from avatar uploads to camera photos
+IMAGE_SIZES = {
+    'small': (320, 240),
+    'medium': (1280, 960),
+    'large': (4000, 3000),
+}
+
+#: Upload formats used by the benchmarks
+IMAGE_FORMATS = ['JPEG', 'PNG']
+
+#: Payload sizes used by the storage benchmarks
+PAYLOAD_SIZES = {
+    '1k': 2 ** 10,
+    '64k': 2 ** 16,
+    '1m': 2 ** 20,
+}
+
+S3_BUCKET = 'flask-mm-benchmarks'
+S3_REGION = 'us-east-1'
+
+_images = {}
+
+def image_bytes(size, format):
+    '''
+    Return the encoded bytes of the (deterministic) benchmark image in a given size and format
+    '''
+    key = (size, format)
+    if key not in _images:
+        image = Image.open(SOURCE_IMAGE).convert('RGB').resize(IMAGE_SIZES[size], Image.BICUBIC)
+        out = io.BytesIO()
+        image.save(out, format=format)
+        _images[key] = out.getvalue()
+    return _images[key]
+
+def filestorage(content, filename):
+    return FileStorage(io.BytesIO(content), filename)
+
+def payload(size):
+    return os.urandom(PAYLOAD_SIZES[size])
+
+def create_app(config, instance_path):
+    app = Flask('flask-mm-benchmarks', instance_path=str(instance_path))
+    app.config['TESTING'] = True
+    app.config['MEDIA_MANAGER'] = config
+    mm.MediaManager(app)
+    return app
+
+@pytest.fixture
+def make_app(tmp_path):
+    '''
+    Factory of configured applications, each with a pushed request context
+    '''
+    contexts = []
+    def factory(config):
+        app = create_app(config, tmp_path)
+        ctx = app.test_request_context()
+        ctx.push()
+        contexts.append(ctx)
+        return app
+    yield factory
+    for ctx in reversed(contexts):
+        ctx.pop()
+
+@pytest.fixture
+def local_app(make_app, tmp_path):
+    def factory(**config):
+        return make_app(dict({
+            'STORAGE': 'local',
+            'ROOT': str(tmp_path / 'media'),
+        }, **config))
+    return factory
+
+@pytest.fixture
+def s3_app(make_app, s3_endpoint):
+    pytest.importorskip('boto3')
+    def factory(**config):
+        return make_app(dict({
+            'STORAGE': 's3',
+            'ROOT': 'benchmarks',
+            'BUCKET_NAME': S3_BUCKET,
+            'AWS_REGION': S3_REGION,
+            'AWS_ACCESS_KEY': 'benchmark',
+            'AWS_SECRET_ACCESS_KEY': 'benchmark',
+            'ENDPOINT_URL': s3_endpoint,
+        }, **config))
+    return factory
@@ -2,8 +2,11 @@
 # -*- coding: utf-8 -*-
 
 # Common Python library imports
+import re
+from collections import namedtuple
+from functools import lru_cache
 from os.path import join
-import pkg_resources
+from types import MappingProxyType
 
 # Pip package imports
 from flask import current_app, Blueprint
@@ -31,29 +34,89 @@ PREFIX = '{0}_MM_'
 MANAGER_PREFIX = 'MM_{0}_'
 STORAGE_PREFIX = 'MM_{0}_'
 
-MANAGERS = dict((ep.name, ep) for ep in pkg_resources.iter_entry_points('mm.managers'))
-STORAGES = dict((ep.name, ep) for ep in pkg_resources.iter_entry_points('mm.storages'))
+def _iter_entry_points(group):
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        # Python < 3.8
+        import pkg_resources
+        return pkg_resources.iter_entry_points(group)
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        return eps.select(group=group)
+    # Python < 3.10
+    return eps.get(group, [])
+
+@lru_cache(maxsize=None)
+def entry_points(group):
+    '''
+    Return the entry points of a group as a name -> entry point dictionary.
+    Entry points are only looked up on first use, then the result is cached.
+    '''
+    return dict((ep.name, ep) for ep in _iter_entry_points(group))
+
+@lru_cache(maxsize=None)
+def load_entry_point(group, name):
+    try:
+        return entry_points(group)[name].load()
+    except KeyError:
+        raise ValueError("Unknown %s entry point: '%s', must be one of %s" % (group, name, list(entry_points(group).keys())))
+
+@lru_cache(maxsize=None)
+def _config_pattern(allowed_configs):
+    """
+        Compile a pattern which splits MM_[<NAME>_]<CONFIG> keys into name and configuration element.
+        The name is optional and as short as possible, so the longest allowed configuration element wins.
+    """
+    elements = '|'.join(re.escape(e) for e in sorted(allowed_configs, key=len, reverse=True))
+    return re.compile(r'^%s(?:(?P<name>.+?)_)??(?P<element>%s)$' % (re.escape(CONF_PREFIX), elements))
+
+class ManagerConfig(namedtuple('ManagerConfig', 'name manager storage options')):
+    '''
+    Validated, immutable configuration of a single manager.
+    The manager and storage classes are resolved from the mm.managers and mm.storages entry points.
+    '''
+
+    @classmethod
+    def from_dict(cls, name, config):
+        config = dict(config)
+        # Override global configuration
+        manager = load_entry_point('mm.managers', config.pop('MANAGER'))
+        storage = load_entry_point('mm.storages', config.pop('STORAGE'))
+        options = MappingProxyType({k.lower(): v for k, v in config.items()})
+        return cls(name, manager, storage, options)
+
+    def create(self, app):
+        return self.manager(app, self.name, storage=self.storage(**self.options), **self.options)
 
 def _config_from_dict(app, name, config):
-    # Override global configuration
-    manager = config.pop('MANAGER')
-    storage = config.pop('STORAGE')
+    return ManagerConfig.from_dict(name, config).create(app)
 
-    manager_class = MANAGERS[manager].load()
-    storage_class = STORAGES[storage].load()
+class ManagerRegistry(dict):
+    '''
+    The configured managers keyed by their lowercase name.
+    The default manager (used when no name is given) is resolved once, when the registry is created.
+    '''
 
-    config = {k.lower(): v for k, v in config.items()}
+    def __init__(self, instances):
+        super(ManagerRegistry, self).__init__(instances)
+        self.default = next(iter(self.values())) if len(self) == 1 else None
 
-    return manager_class(app, name, storage=storage_class(**config), **config)
+    def get_manager(self, name=''):
+        try:
+            return self[name]
+        except KeyError:
+            pass
+        if not name and self.default is not None:
+            return self.default
+        try:
+            return self[name.lower()]
+        except KeyError:
+            msg = "Input argument: \'%s\' must one of %s" % (name, list(self.keys()))
+            raise KeyError(msg)
 
 def by_name(name=''):
-    if len(name) == 0 and len(current_app.extensions[MediaManager.key].keys()) == 1:
-        name = list(current_app.extensions[MediaManager.key].keys())[0]
-    try:
-        return current_app.extensions[MediaManager.key][name.lower()]
-    except KeyError:
-        msg = "Input argument: %s must one of %s" % (name, current_app.extensions[MediaManager.key].keys())
-        raise KeyError(msg)
+    return current_app.extensions[MediaManager.key].get_manager(name)
 
 class MediaManager(object):
 
@@ -61,26 +124,82 @@ class MediaManager(object):
         # Common configuration values
         'URL',
         'ROOT',
+        'PREFIX',
         'MANAGER',
         'STORAGE',
         'EXTENSIONS',
-        'PUBLIC_VIEW'
+        'PUBLIC_VIEW',
+        'NAME_GEN',
+        'SPOOL_SIZE',
+        'SNIFF_CONTENT',
+        'COALESCE',
+        'LOCK_DIR',
+        'LOCK_STRIPES',
         # Image Manager related configuration values
         'MAX_SIZE',
         'THUMBNAIL_SIZE',
         'KEEP_IMAGE_FORMATS',
         'IMAGE_QUALITY',
-        'CROP_TYPE'
+        'CROP_TYPE',
         'PREPROCESS',
         'POSTPROCESS',
+        'OUTPUT_FORMAT',
+        'THUMBNAIL_FORMAT',
+        'ALTERNATE_FORMATS',
+        'ENCODER_OPTIONS',
+        'STRIP_METADATA',
+        'EXIF_ORIENTATION',
+        'ANIMATION',
+        'ANIMATED_THUMBNAIL',
+        'MAX_FRAMES',
+        'MAX_DURATION',
+        'MAX_ANIMATION_PIXELS',
+        'NEGOTIATE_FORMATS',
+        'GENERATE_VARIANTS',
+        'PROFILE',
+        'KEEP_ORIGINAL',
+        'SOURCE_PREFIX',
+        'SOURCE_STORAGE',
+        'PROBE_SIZE',
+        'PROBE_CACHE_SIZE',
+        'PROBE_WORKERS',
         # Local Storage related configuration values
         'PERMISSION',
+        'SHARD_DEPTH',
+        'SHARD_WIDTH',
+        'ATOMIC_WRITES',
+        'DURABILITY',
+        'DIR_CACHE_SIZE',
         # Amazon S3 Storage related configuration values
         'AWS_ACCESS_KEY',
         'AWS_SECRET_ACCESS_KEY',
         'AWS_REGION',
         'BUCKET_NAME',
-        'OBJECT_ACL'
+        'OBJECT_ACL',
+        'ENDPOINT_URL',
+        'COPY_WORKERS',
+        'COPY_PART_SIZE',
+        # Cached Storage related configuration values
+        'ORIGIN',
+        'CACHE_ROOT',
+        'CACHE_DISK_SIZE',
+        'CACHE_MEMORY_SIZE',
+        'CACHE_OBJECT_SIZE',
+        'CACHE_METADATA_SIZE',
+        'CACHE_EVICTION',
+        'CACHE_WRITE',
+        'CACHE_WRITE_WORKERS',
+        # Replicated Storage related configuration values
+        'REPLICAS',
+        'WRITE_QUORUM',
+        'HEDGE',
+        'HEDGE_QUANTILE',
+        'REPLICA_RETRY',
+        'REPLICA_WORKERS',
+        # Sharded Storage related configuration values
+        'SHARDS',
+        'SHARD_VNODES',
+        'SHARD_FALLBACK',
     ]
 
     key = 'mediamanager'
@@ -97,41 +216,25 @@ class MediaManager(object):
             self.init_app(app, *args, **kwargs)
 
     def init_app(self, app, *args, **kwargs):
-        self.instances = self.configure(app)
+        self.instances = ManagerRegistry(self.configure(app))
         app.extensions = getattr(app, 'extensions', {})
         app.extensions[self.key] = self.instances
 
 
     def by_name(self, name=''):
         try:
-            if len(name) == 0 and len(current_app.extensions[MediaManager.key].keys()) == 1:
-                name = list(current_app.extensions[MediaManager.key].keys())[0]
-            return current_app.extensions[self.key][name.lower()]
+            instances = current_app.extensions[self.key]
         except RuntimeError:
-            if len(name) == 0 and len(self.instances.keys()) == 1:
-                name = list(self.instances.keys())[0]
-            return self.instances[name.lower()]
-        except KeyError:
-            msg = "Input argument: \'%s\' must one of %s" % (name, self.instances.keys())
-            raise KeyError(msg)
+            # Working outside of application context
+            instances = self.instances
+        return instances.get_manager(name)
 
     def configure(self, app):
-
-        def get_name_config(pattern):
-            for element in self.allowed_configs:
-                if pattern.endswith(element):
-                    l = pattern.replace('_' + element, '')
-                    if l.startswith(CONF_PREFIX):
-                        name = l.replace(CONF_PREFIX, '')
-                    else:
-                        name = None
-                    return name, element
-            return '', ''
-
-
         mm = app.config.get('MEDIA_MANAGER', None)
-        mm_instances = {}
-        # Media Manager configuration is not exists, try to parse app.config to search for named configuration elements
+        # Media Manager configuration is not exists, parse app.config to search for named configuration elements
+        parse_elements = mm is None
+        pattern = _config_pattern(tuple(self.allowed_configs))
+
         global_config = {
             'URL' : self.default_url,
             'ROOT': join(app.instance_path, 'media'),
@@ -141,67 +244,63 @@ class MediaManager(object):
             'STORAGE': MediaManager.default_storage,
             'PUBLIC_VIEW': True
         }
-        if mm is None:
-            mm = {}
-            # Search for individual dict config for different managers
-            for key, value in app.config.items():
-                if key.startswith(CONF_PREFIX):
-                    if key.endswith(tuple(self.allowed_configs)):
-                        name, conf_element = get_name_config(key)
-                        if name is not None:
-                            """ Example:
-                                MM_PHOTO_MEDIA_URL = # configuration
-                            """
-                            if name in mm:
-                                mm[name][conf_element] = value
-                            else:
-                                mm[name] = {}
-                        else:
-                            """ Example:
-                                MM_URL = # configuration
-                            """
-                            _, conf_element = get_name_config(key)
-                            global_config[conf_element] = value
+        named_configs = {}
+        dict_configs = {}
 
+        # Collect every configuration in a single pass over app.config
         for key, value in app.config.items():
-            if key.startswith(CONF_PREFIX):
-                if isinstance(value, dict):
-                    """ Example:
-                        MM_PHOTO_MEDIA = {
-                            # configuration
-                        }
-                    """
-                    name = key.replace(CONF_PREFIX, '').lower()
-                    mm_instances[name] = _config_from_dict(app, name, { **global_config, **value } )
-
-        # Media manager configuration(s) can be encapsulated in a dictionary
-        if isinstance(mm, dict):
-            # If Media Manager instance(s) defined as key = name, value = config_dict
-            for conf, value in mm.items():
+            if not key.startswith(CONF_PREFIX):
+                continue
+            if isinstance(value, dict):
                 """ Example:
-                    MEDIA_MANAGER = {
+                    MM_PHOTO_MEDIA = {
                         # configuration
                     }
                 """
-                if not isinstance(value, dict):
-                    global_config[conf] = value
-
-            for name, config in mm.items():
+                dict_configs[key[len(CONF_PREFIX):].lower()] = value
+                continue
+            if not parse_elements:
+                continue
+            match = pattern.match(key)
+            if match is None:
+                continue
+            name, element = match.group('name', 'element')
+            if name is None:
                 """ Example:
-                    MEDIA_MANAGER = {
-                        'PHOTO': {
-                            # Local configuration
-                        },
-                        'FILES':{
-                            # Local configuration
-                        },
-                        'URL': # Global configuration
-                    }
+                    MM_URL = # configuration
+                """
+                global_config[element] = value
+            else:
+                """ Example:
+                    MM_PHOTO_MEDIA_URL = # configuration
                 """
-                if not isinstance(config, dict):
-                    continue
-                name = name.lower()
-                mm_instances[name] = _config_from_dict(app, name, { **global_config, **config } )
+                named_configs.setdefault(name, {})[element] = value
+
+        if mm is None:
+            mm = named_configs
+
+        # Media manager configuration(s) can be encapsulated in a dictionary
+        if isinstance(mm, dict):
+            """ Example:
+                MEDIA_MANAGER = {
+                    'PHOTO': {
+                        # Local configuration
+                    },
+                    'FILES':{
+                        # Local configuration
+                    },
+                    'URL': # Global configuration
+                }
+            """
+            for conf, value in mm.items():
+                if isinstance(value, dict):
+                    dict_configs[conf.lower()] = value
+                else:
+                    global_config[conf] = value
+
+        mm_instances = {}
+        for name, config in dict_configs.items():
+            mm_instances[name] = _config_from_dict(app, name, { **global_config, **config } )
 
         if len(mm_instances.keys()) == 0:
             mm_instances[self.name] = _config_from_dict(app, self.name, global_config)
@@ -210,12 +309,3 @@ class MediaManager(object):
         app.register_blueprint(mm_bp, url_prefix=global_config.get('PREFIX'))
 
         return mm_instances
-
-
-
-
-
-
-
-
-
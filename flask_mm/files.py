@@ -4,14 +4,17 @@
 # Common Python library imports
 from __future__ import unicode_literals
 
+import io
 import mimetypes
 import os.path
+from functools import lru_cache
 # Pip package imports
 # Internal package imports
 
 __all__ = (
     'TEXT', 'DOCUMENTS', 'IMAGES', 'AUDIO', 'VIDEO', 'DATA', 'SCRIPTS', 'ARCHIVES', 'EXECUTABLES',
-    'DEFAULTS', 'ALL', 'NONE', 'All', 'AllExcept', 'DisallowAll'
+    'DEFAULTS', 'ALL', 'NONE', 'All', 'AllExcept', 'DisallowAll', 'compile_extensions', 'mime',
+    'sniff', 'read_header', 'content_length', 'content_matches'
 )
 
 #: This just contains plain text files (.txt).
@@ -23,8 +26,8 @@ TEXT = ['txt']
 DOCUMENTS = 'rtf odf ods gnumeric abw doc docx xls xlsx'.split()
 
 #: This contains basic image types that are viewable from most browsers (.jpg,
-#: .jpe, .jpeg, .png, .gif, .svg, and .bmp).
-IMAGES = 'jpg jpe jpeg png gif svg bmp'.split()
+#: .jpe, .jpeg, .png, .gif, .svg, .bmp, .webp and .avif).
+IMAGES = 'jpg jpe jpeg png gif svg bmp webp avif'.split()
 
 #: This contains audio file types (.wav, .mp3, .aac, .ogg, .oga, and .flac).
 AUDIO = 'wav mp3 aac ogg oga flac'.split()
@@ -51,10 +54,13 @@ EXECUTABLES = 'so exe dll'.split()
 DEFAULTS = TEXT + DOCUMENTS + IMAGES + DATA
 
 def extension(filename):
-    ext = os.path.splitext(filename)[1]
-    if ext.startswith('.'):
-        # os.path.splitext retains . separator
-        ext = ext[1:]
+    # Same result as os.path.splitext, without splitting the whole path
+    name, dot, ext = filename.rpartition('.')
+    if not dot or '/' in ext or os.sep in ext:
+        return ''
+    # The leading dots of a name (e.g. .bashrc) don't start an extension
+    if not name.rpartition('/')[2].rpartition(os.sep)[2].strip('.'):
+        return ''
     return ext.lower()
 
 
@@ -74,11 +80,43 @@ def lower_extension(filename):
     return filename
 
 
+#: Mime types which are missing from the mimetypes database of older Python versions
+MIME_TYPES = {
+    'webp': 'image/webp',
+    'avif': 'image/avif',
+    'yaml': 'application/x-yaml',
+    'yml': 'application/x-yaml',
+}
+
+@lru_cache(maxsize=None)
+def mime_table():
+    '''
+    Return the extension -> mime type table, which is built from the mimetypes database only once.
+    Compression extensions (e.g. .gz) are left out, their type depends on the inner extension.
+    '''
+    mimetypes.init()
+    table = dict((ext[1:].lower(), mimetype) for ext, mimetype in mimetypes.types_map.items()
+                 if ext not in mimetypes.encodings_map)
+    table.update(MIME_TYPES)
+    return table
+
+@lru_cache(maxsize=256)
+def _guess_mime(ext):
+    return mimetypes.guess_type('file.' + ext)[0]
+
 def mime(filename, default=None):
     '''
     A basic helper to guess mime type from a filename or url
     '''
-    return mimetypes.guess_type(filename)[0] or default
+    ext = extension(filename)
+    try:
+        return mime_table()[ext]
+    except KeyError:
+        pass
+    if '.' + ext in mimetypes.encodings_map:
+        # e.g. .tar.gz
+        return mimetypes.guess_type(filename)[0] or default
+    return _guess_mime(ext) or default
 
 
 class All(object):
@@ -116,7 +154,226 @@ class AllExcept(object):
         AllExcept(SCRIPTS + EXECUTABLES)
     '''
     def __init__(self, items):
-        self.items = items
+        self.items = frozenset(items)
 
     def __contains__(self, item):
-        return item not in self.items
\ No newline at end of file
+        return item not in self.items
+
+
+def compile_extensions(extensions):
+    '''
+    Compile allowed extensions for fast lookups: containers become lowercase frozensets,
+    policy objects (`All`, `AllExcept`, `DisallowAll` or custom ones) are kept.
+    '''
+    if extensions is None or isinstance(extensions, frozenset):
+        return extensions
+    if isinstance(extensions, (list, tuple, set)):
+        return frozenset(ext.lower() for ext in extensions)
+    return extensions
+
+
+#: Number of leading bytes read to detect the type of a content
+SNIFF_SIZE = 4096
+
+#: Magic bytes of the detected types as (type, offset, magic) in the order they are tried
+SIGNATURES = [
+    ('jpeg', 0, b'\xff\xd8\xff'),
+    ('png', 0, b'\x89PNG\r\n\x1a\n'),
+    ('gif', 0, b'GIF87a'),
+    ('gif', 0, b'GIF89a'),
+    ('tiff', 0, b'II*\x00'),
+    ('tiff', 0, b'MM\x00*'),
+    ('ico', 0, b'\x00\x00\x01\x00'),
+    ('pdf', 0, b'%PDF-'),
+    ('rtf', 0, b'{\\rtf'),
+    ('ole', 0, b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'),
+    ('zip', 0, b'PK\x03\x04'),
+    ('zip', 0, b'PK\x05\x06'),
+    ('gzip', 0, b'\x1f\x8b'),
+    ('bzip2', 0, b'BZh'),
+    ('xz', 0, b'\xfd7zXZ\x00'),
+    ('7z', 0, b"7z\xbc\xaf'\x1c"),
+    ('tar', 257, b'ustar'),
+    ('ogg', 0, b'OggS'),
+    ('flac', 0, b'fLaC'),
+    ('mp3', 0, b'ID3'),
+    ('mpeg', 0, b'\x00\x00\x01\xba'),
+    ('mpeg', 0, b'\x00\x00\x01\xb3'),
+    ('asf', 0, b'0&\xb2u\x8ef\xcf\x11'),
+    ('exe', 0, b'MZ'),
+    ('elf', 0, b'\x7fELF'),
+]
+
+#: Types of the RIFF container by their form type
+RIFF_TYPES = {b'WEBP': 'webp', b'WAVE': 'wav', b'AVI ': 'avi'}
+
+#: Types of the ISO base media container by their major brand, the other brands are MP4 videos
+FTYP_BRANDS = {b'avif': 'avif', b'avis': 'avif', b'heic': 'heic', b'heix': 'heic', b'mif1': 'heic'}
+
+#: Atoms which can start a QuickTime movie, older ones have no ftyp atom
+QUICKTIME_ATOMS = frozenset([b'moov', b'mdat', b'wide', b'free', b'skip', b'pnot'])
+
+#: Signatures shorter than this are also the start of some texts (e.g. MZ, ID3 or BZh), they are ignored in text
+WEAK_SIGNATURE_SIZE = 4
+
+#: Bytes of texts, the control characters but tabs, new lines and escapes are binary
+TEXT_BYTES = frozenset([7, 8, 9, 10, 12, 13, 27]) | frozenset(range(0x20, 0x100)) - frozenset([0x7f])
+
+#: Extensions which are allowed for the content of each detected type
+SIGNATURE_EXTENSIONS = {
+    'jpeg': frozenset(['jpg', 'jpe', 'jpeg']),
+    'png': frozenset(['png']),
+    'gif': frozenset(['gif']),
+    'bmp': frozenset(['bmp']),
+    'tiff': frozenset(['tif', 'tiff']),
+    'ico': frozenset(['ico']),
+    'webp': frozenset(['webp']),
+    'avif': frozenset(['avif']),
+    'heic': frozenset(['heic', 'heif']),
+    'pdf': frozenset(['pdf']),
+    'rtf': frozenset(['rtf']),
+    'ole': frozenset(['doc', 'xls', 'ppt', 'msi']),
+    # Office and OpenDocument files are zip archives
+    'zip': frozenset(['zip', 'docx', 'xlsx', 'pptx', 'odt', 'odf', 'ods', 'odp', 'jar', 'apk', 'epub']),
+    'gzip': frozenset(['gz', 'tgz', 'gnumeric', 'abw']),
+    'bzip2': frozenset(['bz2', 'tbz', 'tbz2']),
+    'xz': frozenset(['xz', 'txz']),
+    '7z': frozenset(['7z']),
+    'tar': frozenset(['tar']),
+    'ogg': frozenset(['ogg', 'oga', 'ogv']),
+    'flac': frozenset(['flac']),
+    'mp3': frozenset(['mp3', 'mp2']),
+    'aac': frozenset(['aac']),
+    'wav': frozenset(['wav']),
+    'avi': frozenset(['avi']),
+    'mpeg': frozenset(['mpg', 'mp2', 'mpeg', 'mpe', 'mpv']),
+    'mp4': frozenset(['mp4', 'm4p', 'm4v', 'm4a', 'mov']),
+    'mov': frozenset(['mov', 'qt']),
+    'asf': frozenset(['wmv', 'wma', 'asf']),
+    'exe': frozenset(['exe', 'dll']),
+    'elf': frozenset(['so']),
+}
+
+#: Detected types which are images
+IMAGE_SIGNATURES = frozenset(['jpeg', 'png', 'gif', 'bmp', 'tiff', 'ico', 'webp', 'avif', 'heic'])
+
+#: Extensions whose content has to be recognized
+SNIFFED_EXTENSIONS = frozenset(ext for extensions in SIGNATURE_EXTENSIONS.values() for ext in extensions)
+
+#: Extensions of documents which are gzip compressed by default, and plain XML otherwise
+PLAIN_EXTENSIONS = frozenset(['gnumeric', 'abw'])
+
+def is_text(header):
+    '''Check whether the leading bytes of a content are text, i.e. have no binary control characters'''
+    return all(byte in TEXT_BYTES for byte in header)
+
+def sniff(header, length=None):
+    '''
+    Detect the type of a content from its leading bytes (see ``SNIFF_SIZE``), ``length`` is the size of the whole
+    content when it is known. Return a key of ``SIGNATURE_EXTENSIONS``, or None for unknown types (e.g. text files).
+    '''
+    header = bytes(header)
+    if header[:4] == b'RIFF':
+        return RIFF_TYPES.get(header[8:12])
+    if header[4:8] == b'ftyp':
+        return FTYP_BRANDS.get(header[8:12], 'mp4')
+    if header[4:8] in QUICKTIME_ATOMS and quicktime_atom(header, length):
+        return 'mov'
+    # Only two bytes of magic, the reserved fields are checked too so text starting with BM is not a bitmap
+    if header[:2] == b'BM' and header[6:10] == b'\x00\x00\x00\x00':
+        return 'bmp'
+    for kind, offset, magic in SIGNATURES:
+        if header[offset:offset + len(magic)] == magic:
+            if len(magic) < WEAK_SIGNATURE_SIZE and is_text(header):
+                return None
+            return kind
+    return sniff_frame(header)
+
+def quicktime_atom(header, length=None):
+    '''
+    Check the size of the leading atom of a QuickTime movie: 0 (up to the end), 1 (a 64 bits size follows) or
+    a size from the 8 bytes of the atom header up to the content length. When the length is unknown, the size
+    of a text (whose bytes are all printable) is too large to be plausible.
+    '''
+    size = int.from_bytes(header[:4], 'big')
+    if size in (0, 1):
+        return True
+    if length is None:
+        return 8 <= size and not is_text(header[:4])
+    return 8 <= size <= length
+
+def sniff_frame(header):
+    '''
+    Detect MPEG audio from the header of its first frame: 11 bits of frame sync, the version, the layer,
+    the bitrate and the sample rate indexes. Layer 0 is the ADTS header of AAC, with 12 bits of sync.
+    '''
+    if len(header) < 3 or header[0] != 0xff or header[1] & 0xe0 != 0xe0:
+        return None
+    version, layer = (header[1] >> 3) & 0x03, (header[1] >> 1) & 0x03
+    if not layer:
+        return 'aac' if header[1] & 0xf0 == 0xf0 else None
+    if version == 1 or header[2] >> 4 == 0x0f or (header[2] >> 2) & 0x03 == 0x03:
+        # Reserved values
+        return None
+    return 'mp3'
+
+def content_matches(kind, filename):
+    '''
+    Check whether a content of the sniffed type can be stored with the extension of filename.
+    Content of an unknown type only matches extensions which are not recognized by sniffing, and the documents
+    which can be plain text (see ``PLAIN_EXTENSIONS``).
+    '''
+    ext = extension(filename)
+    if kind is None:
+        return ext not in SNIFFED_EXTENSIONS or ext in PLAIN_EXTENSIONS
+    return ext in SIGNATURE_EXTENSIONS[kind]
+
+
+class HeaderReader(io.RawIOBase):
+    '''Read a stream whose header is already consumed: the header is replayed before the rest of the stream'''
+
+    def __init__(self, header, stream):
+        self.header = memoryview(header)
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.header:
+            size = min(len(b), len(self.header))
+            b[:size] = self.header[:size]
+            self.header = self.header[size:]
+            return size
+        data = self.stream.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+def read_header(file, size=SNIFF_SIZE):
+    '''
+    Read the leading bytes of a content (bytes or file) for sniffing. Return the header and a file which still
+    yields the whole content: seekable files are rewound, the header of the other ones is replayed.
+    '''
+    if isinstance(file, (bytes, bytearray, memoryview)):
+        return bytes(memoryview(file)[:size]), file
+    seekable = getattr(file, 'seekable', None)
+    if seekable is not None and seekable():
+        position = file.tell()
+        header = file.read(size)
+        file.seek(position)
+        return header, file
+    header = file.read(size)
+    return header, HeaderReader(header, file)
+
+def content_length(file):
+    '''Return the size of a content (bytes or file), or None when it can't be known without reading it'''
+    if isinstance(file, (bytes, bytearray, memoryview)):
+        return memoryview(file).nbytes
+    seekable = getattr(file, 'seekable', None)
+    if seekable is None or not seekable():
+        return None
+    # The content starts at the current position, as for read_header
+    position = file.tell()
+    length = file.seek(0, io.SEEK_END) - position
+    file.seek(position)
+    return length
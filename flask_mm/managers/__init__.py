@@ -3,21 +3,30 @@
 
 # Common Python library imports
 import os
+import re
 
 # Pip package imports
-from six.moves.urllib.parse import urljoin
+import six
 
-from flask import url_for, request, abort
+from flask import url_for, request, abort, g
 
 from werkzeug import secure_filename, FileStorage, cached_property
+from werkzeug.urls import url_quote
 
 # Internal package imports
-from flask_mm.utils import UuidNameGen
-from flask_mm.files import extension, lower_extension
+from flask_mm.utils import UuidNameGen, get_name_gen
+from flask_mm.files import (extension, lower_extension, compile_extensions, All, DisallowAll, sniff, read_header,
+                            content_length, content_matches, SNIFF_SIZE)
 from flask_mm.storages import BaseStorage
+from flask_mm.signals import manager_operation, instrumented, result_size, content_size
 
 DEFAULT_MANAGER = 'file'
 
+# Filenames made of these characters are not changed by the url quoting of the path converter
+URL_SAFE_FILENAME = re.compile(r'^[A-Za-z0-9_.~/:-]*$')
+# Stands in for the filename while the url prefix of the serving view is built
+URL_PLACEHOLDER = '_'
+
 class BaseManager(object):
 
     def __init__(self, app, name, storage, *args, **kwargs):
@@ -27,36 +36,84 @@ class BaseManager(object):
 
         # Optional parameters
         self.allowed_extensions = kwargs.get('extensions', None)
-        self.namegen = kwargs.get('name_gen', UuidNameGen)
+        self.namegen = get_name_gen(kwargs.get('name_gen', UuidNameGen))
+        self.sniff_content = kwargs.get('sniff_content', False)
+
+        # Storages with their own url have a static prefix, resolve it for both schemes only once
+        if self.storage.has_url:
+            self._storage_urls = (self._clean_url(self.storage.base_url, secure=False),
+                                  self._clean_url(self.storage.base_url, secure=True))
+        else:
+            self._storage_urls = None
 
-    def _clean_url(self, url):
+    def _clean_url(self, url, secure=None):
         if not url.startswith('http://') and not url.startswith('https://'):
-            url = ('https://' if request.is_secure else 'http://') + url
+            if secure is None:
+                secure = request.is_secure
+            url = ('https://' if secure else 'http://') + url
         if not url.endswith('/'):
             url += '/'
         return url
 
+    def _view_url_prefix(self, external):
+        '''
+        Return the url of the serving view without the filename.
+        The url is built by url_for only once per request and manager, then it is cached on flask.g
+        '''
+        prefixes = g.setdefault('_mm_url_prefixes', {})
+        key = (self.name, external)
+        try:
+            return prefixes[key]
+        except KeyError:
+            url = url_for('mm.get_file', mm=self.name, filename=URL_PLACEHOLDER, _external=external)
+            prefix = prefixes[key] = url[:-len(URL_PLACEHOLDER)]
+            return prefix
+
     def url(self, filename, external=False):
-        if isinstance(filename, FileStorage):
+        if not isinstance(filename, six.string_types):
+            # FileStorage
             filename = filename.filename
-        if filename.startswith('/'):
+        if filename[:1] == '/':
             filename = filename[1:]
-        if self.storage.has_url:
-            # TODO: Clean url or not?
-            return urljoin(self._clean_url(self.storage.base_url), self.storage.path(filename))
-        else:
-            return url_for('mm.get_file', mm=self.name, filename=filename, _external=external)
+        if self._storage_urls is not None:
+            return self._storage_urls[request.is_secure] + self.storage.path(filename)
+        if not URL_SAFE_FILENAME.match(filename):
+            filename = url_quote(filename, safe='/:')
+        return self._view_url_prefix(external) + filename
+
+    def urls(self, filenames, external=False):
+        '''
+        Return the url for each of the given filenames
+        '''
+        return [self.url(filename, external) for filename in filenames]
+
+    @property
+    def allowed_extensions(self):
+        return self._allowed_extensions
+
+    @allowed_extensions.setter
+    def allowed_extensions(self, extensions):
+        # Keep the configured value, checks use the compiled policy
+        self._allowed_extensions = extensions
+        self._extension_policy = compile_extensions(extensions)
 
     def is_file_allowed(self, filename):
-        if not self.allowed_extensions:
+        policy = self._extension_policy
+        if not policy or isinstance(policy, All):
             return True
-        return (extension(filename) in self.allowed_extensions)
+        if isinstance(policy, DisallowAll):
+            return False
+        return extension(filename) in policy
 
     def generate_name(self, filename_or_wfs):
         if isinstance(filename_or_wfs, FileStorage):
             return self.namegen.generate_name(filename_or_wfs.filename)
         return self.namegen.generate_name(filename_or_wfs)
 
+    def generate_names(self, filenames_or_wfs):
+        return self.namegen.generate_names(
+            f.filename if isinstance(f, FileStorage) else f for f in filenames_or_wfs)
+
     def path(self, filename):
         if not hasattr(self.storage, 'path'):
             raise RuntimeError("Direct file access is not supported by " + self.storage.__class__.__name__)
@@ -71,24 +128,57 @@ class BaseManager(object):
     def is_allowed(self, filename):
         return self.is_file_allowed(filename)
 
+    def content_allowed(self, kind, filename):
+        '''Check whether a content of the sniffed type (see :func:`flask_mm.files.sniff`) can be saved as filename'''
+        return content_matches(kind, filename)
+
+    def check_content(self, file_or_wfs, filename):
+        '''
+        Check that the content of an upload matches the extension of filename, only its header is read.
+        Return the upload to store, which yields the whole content again.
+        '''
+        stream = file_or_wfs.stream if isinstance(file_or_wfs, FileStorage) else file_or_wfs
+        if not hasattr(stream, 'read') and not isinstance(stream, (bytes, bytearray, memoryview)):
+            # PIL images are encoded, there is no content to check
+            return file_or_wfs
+        length = content_length(stream)
+        header, rewound = read_header(stream)
+        if len(header) < SNIFF_SIZE:
+            # The header is the whole content
+            length = len(header)
+        kind = sniff(header, length)
+        if not self.content_allowed(kind, filename):
+            raise ValueError('File content (%s) does not match its extension: %s' % (kind or 'unknown', filename))
+        return file_or_wfs if rewound is stream else rewound
+
+    @instrumented(manager_operation, 'read', size=result_size)
     def read(self, filename):
         if not self.exists(filename):
             raise FileNotFoundError(filename)
         return self.storage.read(filename)
 
+    def read_buffer(self, filename):
+        '''Return a context manager yielding the content of a file as a read-only buffer'''
+        if not self.exists(filename):
+            raise FileNotFoundError(filename)
+        return self.storage.read_buffer(filename)
+
     def open(self, filename, mode='r', **kwargs):
         if 'r' in mode and not self.storage.exists(filename):
             raise FileNotFoundError(filename)
         return self.storage.open(filename, mode, **kwargs)
 
+    @instrumented(manager_operation, 'write', size=content_size(1))
     def write(self, filename, content, overwrite=False):
         if not overwrite and self.exists(filename):
             raise FileExistsError(filename)
         return self.storage.write(filename, content)
 
+    @instrumented(manager_operation, 'delete')
     def delete(self, filename):
         return self.storage.delete(filename)
 
+    @instrumented(manager_operation, 'save', size=content_size(0))
     def save(self, file_or_wfs, filename=None, **kwargs):
         if not filename and isinstance(file_or_wfs, FileStorage):
             filename = lower_extension(secure_filename(file_or_wfs.filename))
@@ -98,11 +188,14 @@ class BaseManager(object):
         if not self.is_allowed(filename):
             raise ValueError('File type is not allowed.')
 
+        if kwargs.pop('sniff_content', self.sniff_content):
+            file_or_wfs = self.check_content(file_or_wfs, filename)
+
         self.storage.save(file_or_wfs, filename, **kwargs)
         return filename
 
     def list_files(self):
-        return self.storage.list_file()
+        return self.storage.list_files()
 
     def metadata(self, filename):
         metadata = self.storage.metadata(filename)
@@ -110,6 +203,7 @@ class BaseManager(object):
         # TODO: Impelement url getter
         #metadata['url'] = self.url
 
+    @instrumented(manager_operation, 'serve')
     def serve(self, filename):
         '''Serve a file given its filename'''
         if not self.exists(filename):
@@ -3,19 +3,297 @@
 
 # Common Python library imports
 import io
+import numbers
 import os
+import posixpath
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 
 # Pip package imports
+from flask import request, abort, make_response
 from werkzeug.datastructures import FileStorage
 from werkzeug import secure_filename
 
-from PIL import Image, ImageOps
+from PIL import Image, ImageOps, ImageSequence
+from PIL.ExifTags import TAGS
 
 # Internal package imports
 from . import BaseManager
-from flask_mm.files import IMAGES, DEFAULTS
-from flask_mm.files import lower_extension, extension
+from flask_mm.files import IMAGES, DEFAULTS, IMAGE_SIGNATURES
+from flask_mm.files import lower_extension, extension, sniff
 from flask_mm.postprocess import Postprocess
+from flask_mm.signals import manager_operation, cache_access, instrumented, content_size, is_connected
+from flask_mm.profiling import profile, current_profile, stage_timer, count_image, count_resample, logger as profile_logger
+from flask_mm.storages import BufferReader, SPOOL_SIZE, create_child_storage
+
+#: File extension used for each PIL output format
+FORMAT_EXTENSIONS = {
+    'JPEG': 'jpg',
+    'PNG': 'png',
+    'GIF': 'gif',
+    'WEBP': 'webp',
+    'AVIF': 'avif',
+}
+
+#: Default encoder options for each PIL output format
+ENCODER_OPTIONS = {
+    'JPEG': {'optimize': True, 'progressive': True},
+    'PNG': {'optimize': True},
+    'WEBP': {'method': 4},
+    'AVIF': {'speed': 6},
+}
+
+#: Directory of the kept uploads (see keep_original), which is not served
+SOURCE_PREFIX = '_sources/'
+
+#: Leading bytes read to probe an image, the read grows when the header is longer
+PROBE_SIZE = 64 * 1024
+
+#: Longest header read while probing, images with a longer header are probed from the whole file
+PROBE_MAX_SIZE = 4 * 1024 * 1024
+
+#: EXIF orientation tag, and the orientations which swap the displayed width and height
+ORIENTATION_TAG = 0x0112
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+#: Transposition which displays an image of each EXIF orientation upright
+ORIENTATION_TRANSPOSE = {
+    2: Image.FLIP_LEFT_RIGHT,
+    3: Image.ROTATE_180,
+    4: Image.FLIP_TOP_BOTTOM,
+    5: Image.TRANSPOSE,
+    6: Image.ROTATE_270,
+    7: Image.TRANSVERSE,
+    8: Image.ROTATE_90,
+}
+
+#: PIL output formats which can encode animations
+ANIMATION_FORMATS = ('GIF', 'WEBP', 'PNG')
+
+#: Animation modes: animations are kept in their format (when it supports animations) or converted to WebP.
+#: Animations are flattened to their first frame without a mode.
+ANIMATION_MODES = ('KEEP', 'WEBP')
+
+#: Metadata which can be stripped from the outputs (see strip_metadata) and their PIL info key
+METADATA_KEYS = {
+    'EXIF': 'exif',
+    'ICC': 'icc_profile',
+    'XMP': 'xmp',
+}
+
+def probe_image(data, complete=True, best_effort=False):
+    '''
+    Parse the format, dimensions, orientation and EXIF of an image from its leading bytes.
+    PIL only reads the header when an image is opened, the pixels are not decoded. ``complete`` tells if the data
+    is the whole file, a truncated header is raised as an error when a longer read is needed. With ``best_effort``
+    (the longest read), what is missing from the data is left unknown instead: ``animated`` is None, or the EXIF
+    of a WebP image is empty.
+    '''
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return probe_webp(data, best_effort)
+    with BufferReader(data) as reader:
+        image = Image.open(reader)
+        # PNG would decode the whole image to look for a trailing EXIF chunk
+        if 'exif' in image.info or image.format in ('JPEG', 'MPO', 'TIFF'):
+            exif = image.getexif()
+        else:
+            exif = Image.Exif()
+        # PIL looks for a second GIF frame by seeking, which fails silently when the read ends in the first frame
+        animated = gif_animated(data) if image.format == 'GIF' else None
+        if animated is None:
+            if image.format != 'GIF' or complete:
+                animated = getattr(image, 'is_animated', False)
+            elif not best_effort:
+                raise ValueError('Truncated GIF header')
+        return _probe_result(image.format, image.mode, image.size, exif, animated)
+
+def gif_animated(data):
+    '''
+    Tell if a GIF has several frames by walking its blocks up to the second image descriptor.
+    Return None when the data ends first.
+    '''
+    data = bytes(data)
+    if len(data) < 13:
+        return None
+    offset = 13
+    if data[10] & 0x80:
+        # Global color table
+        offset += 3 << ((data[10] & 0x07) + 1)
+    images = 0
+    while offset < len(data):
+        block = data[offset]
+        if block == 0x2c:
+            if images:
+                return True
+            images += 1
+            if offset + 10 > len(data):
+                return None
+            flags = data[offset + 9]
+            # Image descriptor, local color table and LZW minimum code size
+            offset += 11 + (3 << ((flags & 0x07) + 1) if flags & 0x80 else 0)
+        elif block == 0x21:
+            # Extension label
+            offset += 2
+        else:
+            # Trailer
+            return False
+        # Data sub-blocks, up to the empty one
+        while offset < len(data) and data[offset]:
+            offset += 1 + data[offset]
+        offset += 1
+    return None
+
+def probe_webp(data, best_effort=False):
+    '''
+    Parse the header of a WebP image, PIL needs the whole file to open it.
+    The EXIF chunk follows the image data, the header is truncated until it is in the data (unless best_effort).
+    '''
+    data = bytes(data)
+    if len(data) < 30:
+        raise ValueError('Truncated WebP header')
+    chunk = data[12:16]
+    exif = Image.Exif()
+    if chunk == b'VP8X':
+        flags = data[20]
+        size = (1 + int.from_bytes(data[24:27], 'little'), 1 + int.from_bytes(data[27:30], 'little'))
+        mode = 'RGBA' if flags & 0x10 else 'RGB'
+        animated = bool(flags & 0x02)
+        offset = 30
+        while offset + 8 <= len(data):
+            length = int.from_bytes(data[offset + 4:offset + 8], 'little')
+            if data[offset:offset + 4] == b'EXIF' and offset + 8 + length <= len(data):
+                exif.load(data[offset + 8:offset + 8 + length])
+                break
+            # Chunks are padded to an even length
+            offset += 8 + length + (length & 1)
+        else:
+            if flags & 0x08 and not best_effort:
+                # The image has an EXIF chunk, a longer read is needed for its orientation
+                raise ValueError('Truncated WebP header')
+    elif chunk == b'VP8 ' and data[23:26] == b'\x9d\x01\x2a':
+        # Lossy bitstream, 14 bits dimensions after the start code
+        size = (int.from_bytes(data[26:28], 'little') & 0x3fff, int.from_bytes(data[28:30], 'little') & 0x3fff)
+        mode, animated = 'RGB', False
+    elif chunk == b'VP8L' and data[20] == 0x2f:
+        # Lossless bitstream, 14 bits dimensions minus one and the alpha hint
+        bits = int.from_bytes(data[21:25], 'little')
+        size = ((bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1)
+        mode = 'RGBA' if bits >> 28 & 1 else 'RGB'
+        animated = False
+    else:
+        raise ValueError('Invalid WebP header')
+    return _probe_result('WEBP', mode, size, exif, animated)
+
+def _probe_result(format, mode, size, exif, animated):
+    width, height = size
+    orientation = exif.get(ORIENTATION_TAG, 1)
+    transposed = orientation in TRANSPOSED_ORIENTATIONS
+    tags = {}
+    for tag, value in exif.items():
+        if isinstance(value, (str, int)):
+            tags[TAGS.get(tag, tag)] = value
+        elif isinstance(value, numbers.Real):
+            # Rationals
+            tags[TAGS.get(tag, tag)] = float(value)
+    return {
+        'format': format,
+        'mime': Image.MIME.get(format),
+        'mode': mode,
+        'width': width,
+        'height': height,
+        'orientation': orientation,
+        # Dimensions of the image as it is displayed
+        'display_width': height if transposed else width,
+        'display_height': width if transposed else height,
+        'animated': animated,
+        'exif': tags,
+    }
+
+def stripped_metadata(strip_metadata):
+    '''
+    Return the names of the metadata to strip from the outputs: strip_metadata is True (all of them),
+    False (none) or a list of ``METADATA_KEYS``.
+    '''
+    if strip_metadata is True:
+        return frozenset(METADATA_KEYS)
+    if not strip_metadata:
+        return frozenset()
+    names = frozenset(name.upper() for name in strip_metadata)
+    if not names <= set(METADATA_KEYS):
+        raise ValueError('Metadata to strip must be some of %s' % ', '.join(sorted(METADATA_KEYS)))
+    return names
+
+def reduced_size(size, max_size):
+    '''Return the size of an image of the given size after it is resized to max_size (see ImageManager.resize)'''
+    if not max_size:
+        return size
+    width, height, force = max_size
+    if size[0] <= width and size[1] <= height:
+        return size
+    if force:
+        return width, height
+    scale = min(width / float(size[0]), height / float(size[1]))
+    return max(1, int(size[0] * scale)), max(1, int(size[1] * scale))
+
+def apply_orientation(image, orientation):
+    '''
+    Transpose an image by its EXIF orientation, the orientation tag is removed from the EXIF of the result
+    '''
+    method = ORIENTATION_TRANSPOSE.get(orientation)
+    if method is None:
+        return image
+    oriented = image.transpose(method)
+    count_image(oriented)
+    if oriented.info.get('exif'):
+        exif = Image.Exif()
+        exif.load(oriented.info['exif'])
+        exif.pop(ORIENTATION_TAG, None)
+        oriented.info['exif'] = exif.tobytes()
+    return oriented
+
+def format_extension(format):
+    '''Return the file extension used for a PIL format'''
+    return FORMAT_EXTENSIONS.get(format, format.lower())
+
+@lru_cache(maxsize=None)
+def source_extensions():
+    '''
+    Return the extensions of the kept uploads, which can be in any format PIL decodes.
+    The formats of FORMAT_EXTENSIONS come first, they are the most common.
+    '''
+    Image.init()
+    extensions = list(OrderedDict.fromkeys(FORMAT_EXTENSIONS.values()))
+    for format in Image.OPEN:
+        ext = format_extension(format)
+        if ext not in extensions:
+            extensions.append(ext)
+    return tuple(extensions)
+
+def is_format_available(format):
+    '''
+    Check if PIL is able to encode the given format (e.g. AVIF requires an optional plugin)
+    '''
+    if not format:
+        return False
+    Image.init()
+    return format.upper() in Image.SAVE
+
+def accepts_format(format):
+    '''
+    Check if the current request explicitly accepts the given image format.
+    Wildcards like image/* are ignored, because they are sent by clients which cannot decode WebP or AVIF.
+    '''
+    mimetype = 'image/' + format.lower()
+    return any(value == mimetype and quality > 0 for value, quality in request.accept_mimetypes)
+
+def is_seekable(stream):
+    seekable = getattr(stream, 'seekable', None)
+    return seekable is not None and seekable()
 
 class ImageManager(BaseManager):
 
@@ -30,138 +308,627 @@ class ImageManager(BaseManager):
         self.crop_type = kwargs.get('crop_type', 'TOP')
         self.preprocess = kwargs.pop('preprocess', None)
         self.postprocess = kwargs.pop('postprocess', None)
+        self.output_format = kwargs.get('output_format', None)
+        self.thumbnail_format = kwargs.get('thumbnail_format', None)
+        self.alternate_formats = kwargs.get('alternate_formats', [])
+        self.encoder_options = kwargs.get('encoder_options', {})
+        self.strip_metadata = kwargs.get('strip_metadata', True)
+        # Fail on invalid names at configuration time
+        stripped_metadata(self.strip_metadata)
+        self.exif_orientation = kwargs.get('exif_orientation', True)
+        self.animation = kwargs.get('animation', None)
+        if self.animation and self.animation.upper() not in ANIMATION_MODES:
+            raise ValueError('Animation must be one of %s' % ', '.join(ANIMATION_MODES))
+        self.animated_thumbnail = kwargs.get('animated_thumbnail', False)
+        self.max_frames = kwargs.get('max_frames', 1000)
+        # Pixels of the reduced frames, which are all kept in the memory for the encoder
+        self.max_animation_pixels = kwargs.get('max_animation_pixels', 50 * 1000 * 1000)
+        # Milliseconds
+        self.max_duration = kwargs.get('max_duration', 5 * 60 * 1000)
+        self.generate_variants = kwargs.get('generate_variants', False)
+        # Only the stored encodings are negotiated by default (none without alternate formats), every request would
+        # look for the missing ones otherwise. Any modern encoding can be generated on demand.
+        default_negotiate = ['AVIF', 'WEBP'] if self.generate_variants else self.alternate_formats
+        self.negotiate_formats = kwargs.get('negotiate_formats', default_negotiate) or []
+        self.profile = kwargs.get('profile', False)
+        self.spool_size = kwargs.get('spool_size', SPOOL_SIZE)
+        self.keep_original = kwargs.get('keep_original', False)
+        # The kept uploads are not served: they are stored under a prefix which the view refuses, in the image
+        # storage or in a storage of their own (e.g. a private S3 bucket)
+        self.source_prefix = kwargs.get('source_prefix', SOURCE_PREFIX)
+        if not self.source_prefix or not self.source_prefix.endswith('/'):
+            raise ValueError('Source prefix must be a directory, e.g. %s' % SOURCE_PREFIX)
+        source_storage = kwargs.get('source_storage')
+        self.source_storage = self.storage if source_storage is None else \
+            create_child_storage(source_storage, kwargs, exclude=('source_storage',), name='the source storage')
+        # Uploads which are not images are rejected before decoding
+        self.sniff_content = kwargs.get('sniff_content', True)
+        self.probe_size = kwargs.get('probe_size', PROBE_SIZE)
+        # filename -> probe result, invalidated when the image is written or deleted
+        self._probes = OrderedDict()
+        self._probes_size = kwargs.get('probe_cache_size', 1024)
+        self._probes_lock = threading.Lock()
+        self._probe_executor = ThreadPoolExecutor(max_workers=kwargs.get('probe_workers', 16))
 
         if allowed_extensions == DEFAULTS:
             allowed_extensions = IMAGES
         self.allowed_extensions = allowed_extensions
 
+    def content_allowed(self, kind, filename):
+        # Images are encoded again, so any image type is fine whatever its extension
+        if kind in IMAGE_SIGNATURES:
+            return True
+        return super(ImageManager, self).content_allowed(kind, filename)
+
     def url_thumbnail(self, filename):
         if isinstance(filename, FileStorage):
             return filename.filename
         return self.namegen.thumbgen_filename(filename)
 
 
+    @instrumented(manager_operation, 'delete')
     def delete(self, filename):
-        super(ImageManager, self).delete(filename)
+        self.storage.delete(filename)
+        self._forget_probe(filename)
+        self.delete_variants(filename)
         self.delete_thumbnail(filename)
+        if self.keep_original:
+            self.delete_source(filename)
+
+    def write(self, filename, content, overwrite=False):
+        self._forget_probe(filename)
+        return super(ImageManager, self).write(filename, content, overwrite)
+
+    def probe(self, filename):
+        '''
+        Return the format, dimensions (``width``, ``height`` and the ``display_`` ones, which follow the EXIF
+        orientation), orientation and EXIF tags of a stored image. Only the leading bytes of the file are read
+        (a ranged request on S3), and the pixels are not decoded. Results are cached by the version of the file
+        (see BaseStorage.version), so a file changed by an other process is probed again.
+        '''
+        version = self.storage.version(filename)
+        with self._probes_lock:
+            cached = self._probes.get(filename)
+            info = cached[1] if cached is not None and cached[0] == version else None
+            if info is not None:
+                self._probes.move_to_end(filename)
+        if is_connected(cache_access):
+            cache_access.send(self, cache='probe', key=filename, hit=info is not None)
+        if info is not None:
+            return info
+        if self.storage.flights is None:
+            info = self._probe(filename)
+        else:
+            info = self.storage.flights.do(('probe', filename), self._probe, filename)
+        if self._probes_size:
+            with self._probes_lock:
+                self._probes[filename] = (version, info)
+                while len(self._probes) > self._probes_size:
+                    self._probes.popitem(last=False)
+        return info
+
+    def probe_many(self, filenames):
+        '''
+        Probe several images concurrently, e.g. to get the dimensions of every image of a gallery page at once.
+        Return a filename -> probe result dictionary, the result is None for missing or invalid images.
+        '''
+        filenames = list(filenames)
+        return dict(zip(filenames, self._probe_executor.map(self._probe_or_none, filenames)))
+
+    def _probe_or_none(self, filename):
+        try:
+            return self.probe(filename)
+        except Exception:
+            return None
+
+    def _probe(self, filename):
+        size = min(self.probe_size, PROBE_MAX_SIZE)
+        while True:
+            data = self.storage.read_head(filename, size)
+            # The whole file has been read, or the longest header
+            complete = len(data) < size
+            last = complete or size >= PROBE_MAX_SIZE
+            try:
+                return probe_image(data, complete=complete, best_effort=last)
+            except Exception as e:
+                kind = sniff(data)
+                if last or (kind is not None and kind not in IMAGE_SIGNATURES):
+                    # A longer read can't make an image of an other type of file
+                    raise ValueError('Invalid image: %s' % e)
+            # The header is longer than the data (e.g. a large EXIF), read more
+            size = min(size * 4, PROBE_MAX_SIZE)
+
+    def _forget_probe(self, filename):
+        with self._probes_lock:
+            self._probes.pop(filename, None)
 
     def get_thumbnail(self, filename):
         return self.namegen.thumbgen_filename(filename)
 
     def delete_thumbnail(self, filename):
-        self.storage.delete(self.namegen.thumbgen_filename(filename))
+        thumbnail = self.namegen.thumbgen_filename(filename)
+        self.storage.delete(thumbnail)
+        self.delete_variants(thumbnail)
+
+    def get_variant(self, filename, format):
+        return self.namegen.variant_filename(filename, FORMAT_EXTENSIONS.get(format.upper(), format.lower()))
+
+    def get_variants(self, filename):
+        '''
+        Return the stored alternate encodings of an image as a format -> filename dictionary
+        '''
+        variants = {}
+        for format in FORMAT_EXTENSIONS:
+            variant = self.get_variant(filename, format)
+            if self.storage.exists(variant):
+                variants[format] = variant
+        return variants
+
+    def delete_variants(self, filename):
+        for variant in self.get_variants(filename).values():
+            self.storage.delete(variant)
+
+    def get_source(self, filename):
+        '''
+        Return the byte-exact upload of an image, which was kept because the image itself was transformed. It is
+        stored in ``source_storage`` under ``source_prefix``. The image is returned when it is the upload itself,
+        or the upload was not kept.
+        '''
+        for ext in source_extensions():
+            source = self.source_filename(filename, ext)
+            if self.source_storage.exists(source):
+                return source
+        return filename
+
+    def source_filename(self, filename, ext):
+        '''Return the name of the kept upload of an image, under the source prefix'''
+        return self.source_prefix + self.namegen.source_filename(filename, ext)
+
+    def is_source(self, filename):
+        return posixpath.normpath(filename).startswith(self.source_prefix)
+
+    def read_source(self, filename):
+        '''Return the content of the upload of an image (see get_source)'''
+        source = self.get_source(filename)
+        if source == filename:
+            return self.read(filename)
+        return self.source_storage.read(source)
+
+    def delete_source(self, filename):
+        source = self.get_source(filename)
+        if source != filename:
+            self.source_storage.delete(source)
+
+    def negotiate(self, filename):
+        '''
+        Return the stored encoding of an image which fits the best for the current request's Accept header.
+        Missing encodings are created from the original when generate_variants is enabled.
+        '''
+        for format in self.negotiate_formats:
+            format = format.upper()
+            if not accepts_format(format):
+                continue
+            if extension(filename) == FORMAT_EXTENSIONS.get(format):
+                return filename
+            variant = self.get_variant(filename, format)
+            exists = self.storage.exists(variant)
+            if is_connected(cache_access):
+                cache_access.send(self, cache='variant', key=variant, hit=exists)
+            if exists:
+                return variant
+            if self.generate_variants and is_format_available(format):
+                if self.storage.flights is None:
+                    return self.generate_variant(filename, format)
+                # Concurrent requests for a missing variant wait for a single encoding
+                return self.storage.flights.do_shared(('variant', variant), self._generate_missing_variant, filename, format)
+        return filename
 
+    def negotiable(self, filename):
+        '''Check whether an image can be served in an other encoding than its own, depending on the request'''
+        ext = extension(filename)
+        return any(FORMAT_EXTENSIONS.get(format.upper()) != ext for format in self.negotiate_formats)
+
+    def _generate_missing_variant(self, filename, format):
+        variant = self.get_variant(filename, format)
+        # Generated meanwhile by an other process, which held the lock
+        if self.storage.exists(variant):
+            return variant
+        return self.generate_variant(filename, format)
+
+    def generate_variant(self, filename, format, **kwargs):
+        '''
+        Encode an already stored image to the given format and store it as a variant
+        '''
+        format = format.upper()
+        quality = kwargs.pop('image_quality', self.image_quality)
+        encoder_options = kwargs.pop('encoder_options', self.encoder_options)
+
+        with self.storage.read_buffer(filename) as buffer, BufferReader(buffer) as reader:
+            image = Image.open(reader)
+            image.load()
+        variant = self.get_variant(filename, format)
+        self.storage.save(self._encode(image, format, self._get_save_options(image, format, quality, encoder_options, kwargs)),
+                          variant)
+        return variant
+
+    @instrumented(manager_operation, 'serve')
+    def serve(self, filename):
+        '''Serve an image given its filename, in the best encoding accepted by the client'''
+        if self.is_source(filename) or not self.exists(filename):
+            abort(404)
+        if not self.negotiable(filename):
+            return self.storage.serve(filename)
+        response = make_response(self.storage.serve(self.negotiate(filename)))
+        # Caches keep an encoding per Accept header only when there can be several
+        response.vary.add('Accept')
+        return response
+
+    @instrumented(manager_operation, 'save', size=content_size(0))
     def save(self, file_or_wfs, filename=None, **kwargs):
+        if kwargs.pop('profile', self.profile) and current_profile() is None:
+            # Profile this pipeline on its own, the result is logged
+            with profile() as recorded:
+                filename = self._save(file_or_wfs, filename, **kwargs)
+            profile_logger.info('Image pipeline profile of %s: %r', filename, recorded,
+                                extra={'profile': recorded.as_dict()})
+            return filename
+        return self._save(file_or_wfs, filename, **kwargs)
+
+    @contextmanager
+    def open_input(self, file_or_wfs, spool_size=None):
+        '''
+        Normalize an upload (FileStorage, file, bytes) into a seekable file, so the payload is read only once.
+        Streams which can't seek are copied to a temporary file, which is kept in the memory up to spool_size
+        bytes. None is yielded for PIL images.
+        '''
+        if isinstance(file_or_wfs, FileStorage):
+            file_or_wfs = file_or_wfs.stream
+        if isinstance(file_or_wfs, (bytes, bytearray, memoryview)):
+            # Already in the memory, read it in place
+            with BufferReader(file_or_wfs) as reader:
+                yield reader
+        elif hasattr(file_or_wfs, 'read'):
+            if is_seekable(file_or_wfs):
+                yield file_or_wfs
+                return
+            spool_size = self.spool_size if spool_size is None else spool_size
+            with tempfile.SpooledTemporaryFile(max_size=spool_size) as spool:
+                shutil.copyfileobj(file_or_wfs, spool)
+                spool.seek(0)
+                yield spool
+        else:
+            yield None
+
+    def _save(self, file_or_wfs, filename=None, **kwargs):
+        spool_size = kwargs.pop('spool_size', self.spool_size)
+        # Filename will be extracted from FileStorage, otherwise it has to be provided.
+        if isinstance(file_or_wfs, FileStorage) and not filename:
+            filename = lower_extension(secure_filename(file_or_wfs.filename))
+        sniff_content = kwargs.pop('sniff_content', self.sniff_content)
+        with self.open_input(file_or_wfs, spool_size) as stream:
+            if stream is None:
+                return self._save_image(file_or_wfs, filename, None, **kwargs)
+            if sniff_content and filename:
+                # Reject mismatching uploads before decoding, the input is seekable so the header is only peeked
+                self.check_content(stream, filename)
+            # Try to open the uploaded image file with PIL
+            try:
+                image = Image.open(stream)
+            except Exception as e:
+                raise ValueError("Invalid image: %s" % e)
+            return self._save_image(image, filename, stream, **kwargs)
+
+    def _save_image(self, image, filename, stream, **kwargs):
         size = kwargs.pop('size', self.max_size)
         thumbnail_size = kwargs.pop('thumbnail_size', self.thumbnail_size)
         create_thumbnail = kwargs.pop('create_thumbnail', True)
         quality = kwargs.pop('image_quality', self.image_quality)
         generate_name = kwargs.pop('generate_name', True)
+        output_format = kwargs.pop('output_format', self.output_format)
+        thumbnail_format = kwargs.pop('thumbnail_format', self.thumbnail_format)
+        alternate_formats = kwargs.pop('alternate_formats', self.alternate_formats)
+        encoder_options = kwargs.pop('encoder_options', self.encoder_options)
+        # The upload can only be kept when it is available as a stream (PIL images are encoded anyway)
+        keep_original = kwargs.pop('keep_original', self.keep_original) and stream is not None
+        exif_orientation = kwargs.pop('exif_orientation', self.exif_orientation)
+        animation = kwargs.pop('animation', self.animation)
+        animated_thumbnail = kwargs.pop('animated_thumbnail', self.animated_thumbnail)
+        max_frames = kwargs.pop('max_frames', self.max_frames)
+        max_duration = kwargs.pop('max_duration', self.max_duration)
+        max_animation_pixels = kwargs.pop('max_animation_pixels', self.max_animation_pixels)
 
         # TODO: Implement preprocess
         preprocess = kwargs.pop('preprocess', self.preprocess)
         postprocess = kwargs.pop('postprocess', self.postprocess)
 
-        # Try to open the uploaded image file with PIL
-        if file_or_wfs and isinstance(file_or_wfs, FileStorage):
-            try:
-                #image = Image.open(io.BytesIO(file_or_wfs.stream.read()))
-                image = Image.open(file_or_wfs)
-                filename = lower_extension(secure_filename(file_or_wfs.filename)) if not filename else filename
-            except Exception as e:
-                raise ValueError("Invalid image: %s" % e)
-        else:
-            try:
-                image = Image.open(io.BytesIO(file_or_wfs))
-            except TypeError:
-                image = file_or_wfs
+        timer = stage_timer(self)
 
-        # Filename will be extracted from FileStorage, otherwise it has to be provided.
         if not filename:
             raise ValueError('filename is required')
 
-        # If Image max size is defined, resize the image if neccessery
-        if image and size:
-            image = self.resize(image, size)
-
-        # Calcualte the save format for the image
-        format_filename, format = self._get_save_format(filename, image)
-
-        # If generate filename is requested, use the given name generator
+        # PIL opens images lazily, decode it here to measure decoding on its own
+        image.load()
+        timer.mark('decode', filename, image)
+        decoded = image
+        orientation = image.getexif().get(ORIENTATION_TAG, 1) if exif_orientation else 1
+
+        frames = None
+        if animation and getattr(image, 'is_animated', False):
+            frames = self._reduce_frames(image, size, orientation, max_frames, max_duration, max_animation_pixels)
+            image, orientation = frames[0], 1
+            timer.mark('resize', filename, image)
+            format_filename, format = self._get_animation_format(filename, decoded.format, animation, output_format)
+        else:
+            # If Image max size is defined, resize the image if neccessery
+            if image and size:
+                resized = self.resize(image, size, orientation)
+                if resized is not image:
+                    # The orientation has been applied to the reduced image
+                    orientation = 1
+                image = resized
+                timer.mark('resize', filename, image)
+
+            # Calcualte the save format for the image
+            format_filename, format = self._get_save_format(filename, image, output_format)
+
+        # If generate filename is requested, use the given name generator, the caller's name is kept as it is
         if generate_name:
             filename = self.generate_name(format_filename)
 
+        # The image is stored at full size, so it has to be transposed at full size
+        if orientation in ORIENTATION_TRANSPOSE:
+            timer.reset()
+            image = apply_orientation(image, orientation)
+            timer.mark('orient', filename, image)
+
         # TODO: Implement preprocessing of the image
 
         # If create thumbnail is requested, generate a thumbnail and save it
         if create_thumbnail and thumbnail_size:
-            # Resize the thumbnail
-            image_thumb = self.resize(image, thumbnail_size)
+            # Resize the thumbnail, animations have a still thumbnail of their first frame by default
+            thumb_frames = None
+            if frames is not None and animated_thumbnail:
+                thumb_frames = [self.resize(frame, thumbnail_size) for frame in frames]
+                image_thumb = thumb_frames[0]
+            else:
+                image_thumb = self.resize(image, thumbnail_size)
+            timer.mark('thumbnail', filename, image_thumb)
+            # The thumbnail keeps the name of the image, only the encoding can differ
+            thumb_format = thumbnail_format.upper() if is_format_available(thumbnail_format) else format
             # Save the thumbnail image
-            super(ImageManager, self).save(self._convert(image_thumb, format), self.generate_thumbnail_name(filename),
-                                           format=format, quality=quality, **kwargs)
+            self._save_rendition(image_thumb, self.generate_thumbnail_name(filename), thumb_format,
+                                 alternate_formats, quality, encoder_options, timer, frames=thumb_frames, **kwargs)
         # Perform the postprocess if defined
         if postprocess:
             assert isinstance(postprocess,
                               Postprocess), "Postprocess must be a subclass of flask_mm.postrocess.Postprocess"
-            image = postprocess.process(image)
+            timer.reset()
+            if frames is not None:
+                frames = [postprocess.process(frame) for frame in frames]
+                image = frames[0]
+            else:
+                image = postprocess.process(image)
+            timer.mark('postprocess', filename, image)
+
+        original = None
+        if keep_original:
+            if (image is decoded and format == decoded.format and
+                    not self._get_stripped_metadata(format, encoder_options, kwargs)):
+                # Nothing has been transformed (stripping metadata is a transformation too), the upload is stored as
+                # the image instead of encoding it again
+                original = stream
+            else:
+                source = self.source_filename(filename, format_extension(decoded.format))
+                self._store_original(stream, source, decoded, timer)
 
         # Save the image with the specified options
-        filename = super(ImageManager, self).save(self._convert(image, format), filename, format=format, quality=quality, **kwargs)
+        filename = self._save_rendition(image, filename, format, alternate_formats, quality, encoder_options, timer,
+                                        original=original, frames=frames, **kwargs)
+
+        return filename
 
+    def _store_original(self, stream, filename, image, timer):
+        '''Store the upload byte-exact, streamed from the normalized input'''
+        timer.reset()
+        stream.seek(0)
+        self.source_storage.save(stream, filename)
+        timer.mark('store', filename, image)
+
+    def _save_rendition(self, image, filename, format, alternate_formats, quality, encoder_options, timer,
+                        original=None, frames=None, **kwargs):
+        """
+            Save an image in the given format, then store every alternate encoding next to it.
+            The alternates are named by the name generator's variant_filename, e.g. image.jpg.webp
+            When the original upload is given, it is stored as the image without encoding.
+            The frames of an animation are encoded in the formats which support animations, the others get the image.
+        """
+        if not self.is_allowed(filename):
+            raise ValueError('File type is not allowed.')
+        self._forget_probe(filename)
+
+        renditions = [(format, filename)]
+        for alternate in (alternate_formats or []):
+            alternate = alternate.upper()
+            if alternate == format or not is_format_available(alternate):
+                continue
+            renditions.append((alternate, self.get_variant(filename, alternate)))
+
+        for format, name in renditions:
+            if original is not None and name == filename:
+                self._store_original(original, name, image, timer)
+                continue
+            timer.reset()
+            options = self._get_save_options(image, format, quality, encoder_options, kwargs)
+            if frames is not None and len(frames) > 1 and format in ANIMATION_FORMATS:
+                options.update(save_all=True, append_images=frames[1:],
+                               duration=[frame.info.get('duration', 0) for frame in frames])
+                loop = frames[0].info.get('loop')
+                if loop is not None:
+                    options['loop'] = loop
+                elif format != 'GIF':
+                    # Played once like the source, WebP and PNG animations loop forever by default
+                    options['loop'] = 1
+            buffer = self._encode(image, format, options)
+            size = buffer.getbuffer().nbytes
+            timer.mark('encode', name, image, size)
+            self.storage.save(buffer, name)
+            timer.mark('store', name, image, size)
         return filename
 
+    def _encode(self, image, format, options):
+        '''
+        Encode an image into an in-memory buffer, which is rewound for the storage
+        '''
+        buffer = io.BytesIO()
+        self._convert(image, format).save(buffer, **options)
+        buffer.seek(0)
+        return buffer
+
+    def _get_save_options(self, image, format, quality, encoder_options, kwargs):
+        """
+            Merge the encoder options for a format. The precedence is (lowest first):
+            module defaults, image_quality, the configured encoder_options[format], save() keyword arguments
+        """
+        options = dict(ENCODER_OPTIONS.get(format, {}))
+        options['quality'] = quality
+        options.update((encoder_options or {}).get(format, {}))
+        options.pop('strip_metadata', None)
+        stripped = self._get_stripped_metadata(format, encoder_options, kwargs)
+        for name, key in METADATA_KEYS.items():
+            if name in stripped:
+                # An empty value, some encoders (PNG, TIFF) fall back to image.info when the option is missing
+                options.setdefault(key, b'')
+                continue
+            if not image.info.get(key):
+                continue
+            value = image.info[key]
+            if key == 'exif':
+                # Serialized again without the embedded thumbnail
+                exif = Image.Exif()
+                exif.load(value)
+                value = exif.tobytes()
+            options.setdefault(key, value)
+        options.update((key, value) for key, value in kwargs.items() if key != 'strip_metadata')
+        options['format'] = format
+        return options
+
+    def _get_stripped_metadata(self, format, encoder_options, kwargs):
+        '''Return the metadata stripped from the outputs of a format, save() keyword arguments come first'''
+        options = (encoder_options or {}).get(format, {})
+        return stripped_metadata(kwargs.get('strip_metadata', options.get('strip_metadata', self.strip_metadata)))
+
     def generate_thumbnail_name(self, filename_or_wfs):
         if isinstance(filename_or_wfs, FileStorage):
             return self.namegen.thumbgen_filename(filename_or_wfs.filename)
         return self.namegen.thumbgen_filename(filename_or_wfs)
 
-    def _get_save_format(self, filename, image):
+    def _get_save_format(self, filename, image, output_format=None):
+        if is_format_available(output_format):
+            output_format = output_format.upper()
+            name, ext = os.path.splitext(filename)
+            return "%s.%s" % (name, FORMAT_EXTENSIONS.get(output_format, output_format.lower())), output_format
         if image.format not in self.keep_image_formats:
             name, ext = os.path.splitext(filename)
             filename = "%s.jpg" % name
             return filename, "JPEG"
         return filename, image.format
 
+    def _get_animation_format(self, filename, source_format, animation, output_format=None):
+        '''Return the filename and the format of an animation, which is encoded in a format supporting animations'''
+        if is_format_available(output_format) and output_format.upper() in ANIMATION_FORMATS:
+            format = output_format.upper()
+        elif animation.upper() == 'KEEP' and source_format in ANIMATION_FORMATS:
+            format = source_format
+        else:
+            format = 'WEBP' if is_format_available('WEBP') else 'GIF'
+        name, ext = os.path.splitext(filename)
+        return "%s.%s" % (name, FORMAT_EXTENSIONS.get(format, format.lower())), format
+
+    def _reduce_frames(self, image, size, orientation, max_frames, max_duration, max_pixels):
+        '''
+        Decode the frames of an animation one by one and reduce each of them to size right away,
+        so a single frame is kept at full size. The frame count and the pixels of the reduced frames
+        are checked before any frame is decoded.
+        '''
+        if max_frames and image.n_frames > max_frames:
+            raise ValueError('Animation has too many frames: %d (max %d)' % (image.n_frames, max_frames))
+        if max_pixels:
+            # The size applies to the displayed image
+            displayed = image.size[::-1] if orientation in TRANSPOSED_ORIENTATIONS else image.size
+            width, height = reduced_size(displayed, size)
+            if image.n_frames * width * height > max_pixels:
+                raise ValueError('Animation is too large: %d frames of %dx%d' % (image.n_frames, width, height))
+        frames = []
+        duration = 0
+        for frame in ImageSequence.Iterator(image):
+            duration += frame.info.get('duration', 0)
+            if max_duration and duration > max_duration:
+                raise ValueError('Animation is too long (max %d ms)' % max_duration)
+            # The converted frame doesn't depend on the decoder state (palette, disposal of the previous frame)
+            frame = frame.convert('RGBA')
+            count_image(frame)
+            reduced = self.resize(frame, size, orientation) if size else frame
+            if reduced is frame:
+                reduced = apply_orientation(frame, orientation)
+            frames.append(reduced)
+        return frames
+
     def _convert(self, image, format):
         if image.mode not in ("RGB", "RGBA"):
             image =  image.convert("RGBA")
+            count_image(image)
 
         if image.mode == "RGBA" and format in ['JPG', 'JPEG']:
             background = Image.new("RGB", image.size, (255, 255, 255))
             background.paste(image, mask=image.split()[-1])  # 3 is the alpha channel
+            count_image(background)
             return background
 
         return image
 
-    def resize(self, image, size):
+    def resize(self, image, size, orientation=1):
         """
             Resizes the image
             :param image: The image object
             :param size: size is PIL tuple (width, heigth, force) ex: (200,100,True)
+            :param orientation: EXIF orientation, the size applies to the displayed image. The reduced image is
+                transposed, an image which is small enough is returned as is (without the orientation applied).
         """
         (width, height, force) = size
+        transposed = orientation in TRANSPOSED_ORIENTATIONS
+        image_width, image_height = image.size[::-1] if transposed else image.size
 
-        if image.size[0] > width or image.size[1] > height:
+        if image_width > width or image_height > height:
             if force:
                 #return ImageOps.fit(image, (width, height), Image.ANTIALIAS)
-                return resize_and_crop(image, width, height, self.crop_type.lower())
+                return resize_and_crop(image, width, height, self.crop_type.lower(), orientation)
             else:
                 thumb = image.copy()
-                thumb.thumbnail((width, height), Image.ANTIALIAS)
-                return thumb
+                count_image(thumb)
+                thumb.thumbnail((height, width) if transposed else (width, height), Image.ANTIALIAS)
+                count_resample(image, thumb)
+                return apply_orientation(thumb, orientation)
 
         return image
 
-def resize_and_crop(image, width, height, crop_type='middle'):
+def resize_and_crop(image, width, height, crop_type='middle', orientation=1):
+    # The image is resampled in its stored orientation, then the reduced image is transposed to be cropped
+    transposed = orientation in TRANSPOSED_ORIENTATIONS
+    image_width, image_height = image.size[::-1] if transposed else image.size
+
+    def scale(size):
+        img = image.resize(size[::-1] if transposed else size, Image.ANTIALIAS)
+        count_resample(image, img)
+        return apply_orientation(img, orientation)
+
     # Get current and desired ratio for the images
-    img_ratio = image.size[0] / float(image.size[1])
+    img_ratio = image_width / float(image_height)
     ratio = width / float(height)
     # The image is scaled/cropped vertically or horizontally depending on the ratio
     if ratio > img_ratio:
         #img = image.copy()
         #img.thumbnail( (width, int(height * image.size[1] / image.size[0])), Image.ANTIALIAS )
-        img = image.resize((width, int(height * image.size[1] / image.size[0])), Image.ANTIALIAS)
+        img = scale((width, int(height * image_height / image_width)))
         # Crop in the top, middle or bottom
         if crop_type == 'top':
             box = (0, 0, img.size[0], height)
@@ -171,9 +938,11 @@ def resize_and_crop(image, width, height, crop_type='middle'):
             box = (0, img.size[1] - height, img.size[0], img.size[1])
         else:
             raise ValueError('ERROR: invalid value for crop_type')
-        return img.crop(box)
+        img = img.crop(box)
+        count_image(img)
+        return img
     elif ratio < img_ratio:
-        img = image.resize((int(height * image.size[0] / image.size[1]), height), Image.ANTIALIAS)
+        img = scale((int(height * image_width / image_height), height))
         # Crop in the top, middle or bottom
         if crop_type == 'top':
             box = (0, 0, width, img.size[1])
@@ -183,7 +952,8 @@ def resize_and_crop(image, width, height, crop_type='middle'):
             box = (img.size[0] - width, 0, img.size[0], img.size[1])
         else:
             raise ValueError('ERROR: invalid value for crop_type')
-        return img.crop(box)
+        img = img.crop(box)
+        count_image(img)
+        return img
     else:
-        return image.resize((width, height),
-                         Image.ANTIALIAS)
+        return scale((width, height))
@@ -8,6 +8,7 @@ import six
 from PIL import Image, ImageEnhance
 
 # Internal package imports
+from flask_mm.profiling import count_image, count_resample
 
 class Postprocess(object):
 
@@ -44,6 +45,7 @@ class Watermarker(Postprocess):
         # determine the actual value that the parameters provided will render
         scale = determine_scale(self.scale, target, self.watermark_image)
         watermark_image = self.watermark_image.resize(scale, resample=Image.ANTIALIAS)
+        count_resample(self.watermark_image, watermark_image)
         rotation = determine_rotation(self.rotation, watermark_image)
         position = determine_position(self.position, target, watermark_image)
         opacity = self.opacity
@@ -52,7 +54,9 @@ class Watermarker(Postprocess):
         if opacity < 1:
             watermark_image = reduce_opacity(watermark_image, opacity)
 
-        watermark_image = watermark_image.resize(scale, resample=Image.ANTIALIAS)
+        resized = watermark_image.resize(scale, resample=Image.ANTIALIAS)
+        count_resample(watermark_image, resized)
+        watermark_image = resized
 
         if greyscale and watermark_image.mode != 'LA':
             watermark_image = watermark_image.convert('LA')
@@ -73,8 +77,10 @@ class Watermarker(Postprocess):
 
         if target.mode != 'RGBA':
             target = target.convert('RGBA')
+            count_image(target)
 
         layer = Image.new('RGBA', target.size, (0, 0, 0, 0))
+        count_image(layer)
         if self.tile:
             first_y = int(position[1] % watermark_image.size[1] - watermark_image.size[1])
             first_x = int(position[0] % watermark_image.size[0] - watermark_image.size[0])
@@ -86,7 +92,9 @@ class Watermarker(Postprocess):
             layer.paste(watermark_image, position)
 
         # composite the watermark with the layer
-        return Image.composite(layer, target, layer)
+        result = Image.composite(layer, target, layer)
+        count_image(result)
+        return result
 
 def _percent(var):
     """
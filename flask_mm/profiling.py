@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Common Python library imports
+import logging
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from time import perf_counter
+
+# Pip package imports
+
+# Internal package imports
+from flask_mm.signals import image_stage, is_connected, stage_timer as signal_stage_timer
+
+__all__ = ('PipelineProfile', 'profile', 'current_profile', 'count', 'count_image', 'count_resample', 'stage_timer')
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+# tracemalloc is process wide, it is shared by the profiles of every thread: started by the first profile which
+# traces the memory (unless something else traces it), and stopped by the last one
+_tracing_lock = threading.Lock()
+_tracing_profiles = 0
+_started_tracing = False
+
+
+class PipelineProfile(object):
+    '''
+    Stage by stage breakdown of an image pipeline.
+
+    ``stages`` holds the duration, output dimensions and encoded size of each stage, ``counters`` the number of
+    resample calls, intermediate image allocations, their estimated size in bytes and the processed pixels.
+    ``peak_memory`` is the peak of the memory traced by tracemalloc. Pixel buffers are allocated by Pillow outside
+    of the Python allocator, those are only covered by the ``allocated_bytes`` estimation. The peak is process
+    wide: it includes the allocations of the other threads, and while profiles overlap it is measured since the
+    earliest of them started.
+    '''
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.stages = []
+        self.counters = {
+            'resample': 0,
+            'allocations': 0,
+            'allocated_bytes': 0,
+            'pixels': 0,
+        }
+        self.duration = None
+        self.peak_memory = None
+        self._start = None
+
+    def start(self):
+        global _tracing_profiles, _started_tracing
+        if self.trace_memory:
+            with _tracing_lock:
+                if tracemalloc.is_tracing():
+                    # The peak of the running profiles is kept, Python < 3.9 can not reset the peak at all
+                    if not _tracing_profiles and hasattr(tracemalloc, 'reset_peak'):
+                        tracemalloc.reset_peak()
+                else:
+                    tracemalloc.start()
+                    _started_tracing = True
+                _tracing_profiles += 1
+        self._start = perf_counter()
+
+    def stop(self):
+        global _tracing_profiles, _started_tracing
+        self.duration = perf_counter() - self._start
+        if self.trace_memory:
+            with _tracing_lock:
+                self.peak_memory = tracemalloc.get_traced_memory()[1]
+                _tracing_profiles -= 1
+                if not _tracing_profiles and _started_tracing:
+                    tracemalloc.stop()
+                    _started_tracing = False
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def count_image(self, image):
+        '''
+        Count a newly allocated intermediate image
+        '''
+        width, height = image.size
+        self.count('allocations')
+        self.count('allocated_bytes', width * height * len(image.getbands()))
+
+    def timer(self, sender):
+        return ProfileTimer(self, sender)
+
+    def stage_duration(self, stage):
+        return sum(s['duration'] for s in self.stages if s['stage'] == stage)
+
+    def as_dict(self):
+        return {
+            'duration': self.duration,
+            'peak_memory': self.peak_memory,
+            'counters': dict(self.counters),
+            'stages': [dict(s) for s in self.stages],
+        }
+
+    def __repr__(self):
+        stages = ', '.join('%s=%.4fs' % (s['stage'], s['duration']) for s in self.stages)
+        return '<PipelineProfile %s peak_memory=%s %s>' % (stages, self.peak_memory, self.counters)
+
+
+class ProfileTimer(object):
+    '''
+    Stage timer which records the stages into a PipelineProfile, and sends image_stage if it has receivers.
+    '''
+
+    def __init__(self, profile, sender):
+        self.profile = profile
+        self.sender = sender
+        self.last = perf_counter()
+
+    def mark(self, stage, filename=None, image=None, size=None):
+        duration = perf_counter() - self.last
+        width, height = image.size if image is not None else (None, None)
+        self.profile.stages.append({
+            'stage': stage,
+            'filename': filename,
+            'duration': duration,
+            'size': size,
+            'width': width,
+            'height': height,
+        })
+        if stage == 'decode' and image is not None:
+            self.profile.count('pixels', width * height)
+            self.profile.count_image(image)
+        if is_connected(image_stage):
+            image_stage.send(self.sender, stage=stage, filename=filename, duration=duration,
+                             size=size, width=width, height=height)
+        self.last = perf_counter()
+
+    def reset(self):
+        self.last = perf_counter()
+
+
+def current_profile():
+    '''
+    Return the PipelineProfile which is being recorded in the current thread, or None
+    '''
+    return getattr(_local, 'profile', None)
+
+
+@contextmanager
+def profile(trace_memory=True):
+    '''
+    Record a PipelineProfile of the image pipelines running inside the block.
+    ::
+        with profile() as p:
+            manager.save(upload)
+        print(p.stage_duration('decode'), p.counters['resample'], p.peak_memory)
+    '''
+    previous = current_profile()
+    recorded = _local.profile = PipelineProfile(trace_memory=trace_memory)
+    recorded.start()
+    try:
+        yield recorded
+    finally:
+        recorded.stop()
+        _local.profile = previous
+
+
+def count(name, value=1):
+    '''
+    Increase a counter of the current profile, this does nothing when no profile is recorded.
+    '''
+    recorded = getattr(_local, 'profile', None)
+    if recorded is not None:
+        recorded.count(name, value)
+
+
+def count_image(image):
+    '''
+    Count an intermediate image allocation in the current profile, this does nothing when no profile is recorded.
+    '''
+    recorded = getattr(_local, 'profile', None)
+    if recorded is not None:
+        recorded.count_image(image)
+
+
+def count_resample(source, result):
+    '''
+    Count a resample call from source to the newly allocated result image in the current profile,
+    this does nothing when no profile is recorded.
+    '''
+    recorded = getattr(_local, 'profile', None)
+    if recorded is not None:
+        recorded.count('resample')
+        recorded.count('pixels', source.size[0] * source.size[1])
+        recorded.count_image(result)
+
+
+def stage_timer(sender):
+    '''
+    Return the stage timer of the current profile, or the signal based stage timer when no profile is recorded.
+    '''
+    recorded = getattr(_local, 'profile', None)
+    if recorded is not None:
+        return recorded.timer(sender)
+    return signal_stage_timer(sender)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Common Python library imports
+from functools import wraps
+from time import perf_counter
+
+import six
+
+# Pip package imports
+from flask.signals import Namespace
+
+# Internal package imports
+
+__all__ = (
+    'manager_operation', 'storage_operation', 'image_stage', 'cache_access',
+    'is_connected', 'instrumented', 'stage_timer', 'sizeof'
+)
+
+_signals = Namespace()
+
+#: Sent after a manager operation (save, read, write, delete, serve) with
+#: ``operation``, ``filename``, ``duration`` (seconds) and ``size`` (bytes, or None if unknown).
+manager_operation = _signals.signal('mm-manager-operation')
+
+#: Sent after a storage backend operation with
+#: ``operation``, ``filename``, ``duration`` (seconds) and ``size`` (bytes, or None if unknown).
+storage_operation = _signals.signal('mm-storage-operation')
+
+#: Sent after each stage of the image pipeline (decode, resize, thumbnail, postprocess, encode, store) with
+#: ``stage``, ``filename``, ``duration`` (seconds), ``size`` (bytes, or None), ``width`` and ``height``.
+image_stage = _signals.signal('mm-image-stage')
+
+#: Sent on lookups of generated content (e.g. negotiated image variants) with ``cache``, ``key`` and ``hit``.
+cache_access = _signals.signal('mm-cache-access')
+
+
+def is_connected(signal):
+    '''
+    Check if a signal has any receivers. It is always False when blinker is not installed.
+    '''
+    return bool(getattr(signal, 'receivers', None))
+
+
+def sizeof(content):
+    '''
+    Return the size of a content in bytes, if it can be known without reading it
+    '''
+    if isinstance(content, (six.binary_type, bytearray)):
+        return len(content)
+    if isinstance(content, memoryview):
+        return content.nbytes
+    if hasattr(content, 'getbuffer'):
+        return content.getbuffer().nbytes
+    return getattr(content, 'content_length', None) or None
+
+
+def result_size(args, result):
+    return sizeof(result)
+
+
+def content_size(index):
+    def size(args, result):
+        return sizeof(args[index]) if len(args) > index else None
+    return size
+
+
+def instrumented(signal, operation, size=None):
+    '''
+    Decorate a manager or storage method to send ``signal`` after every call.
+    The filename is the string result of the call, or the first positional argument.
+    ``size(args, result)`` can return the number of processed bytes.
+    Without receivers the method is called directly, so the overhead is a single check.
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not getattr(signal, 'receivers', None):
+                return func(self, *args, **kwargs)
+            start = perf_counter()
+            result = func(self, *args, **kwargs)
+            duration = perf_counter() - start
+            if isinstance(result, six.string_types):
+                filename = result
+            else:
+                filename = args[0] if args else kwargs.get('filename')
+            signal.send(self, operation=operation, filename=filename, duration=duration,
+                        size=size(args, result) if size else None)
+            return result
+        return wrapper
+    return decorator
+
+
+class StageTimer(object):
+    '''
+    Measure the consecutive stages of a pipeline, each stage lasts from the previous mark.
+    '''
+
+    def __init__(self, sender):
+        self.sender = sender
+        self.last = perf_counter()
+
+    def mark(self, stage, filename=None, image=None, size=None):
+        duration = perf_counter() - self.last
+        width, height = image.size if image is not None else (None, None)
+        image_stage.send(self.sender, stage=stage, filename=filename, duration=duration,
+                         size=size, width=width, height=height)
+        # Time spent in the receivers does not count to the next stage
+        self.last = perf_counter()
+
+    def reset(self):
+        self.last = perf_counter()
+
+
+class NullStageTimer(object):
+
+    def mark(self, stage, filename=None, image=None, size=None):
+        pass
+
+    def reset(self):
+        pass
+
+NULL_STAGE_TIMER = NullStageTimer()
+
+
+def stage_timer(sender):
+    '''
+    Return a StageTimer if image_stage has receivers, otherwise a timer which does nothing.
+    '''
+    if is_connected(image_stage):
+        return StageTimer(sender)
+    return NULL_STAGE_TIMER
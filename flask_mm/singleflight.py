@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Common Python library imports
+import hashlib
+import os
+import threading
+from functools import partial, wraps
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+
+# Pip package imports
+
+# Internal package imports
+
+#: Number of lock files, keys are hashed to them so the lock directory doesn't grow with the keys
+LOCK_STRIPES = 64
+
+# Stripe locked by the current thread, nested calls don't lock an other one (which could deadlock)
+_held = threading.local()
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight(object):
+    '''
+    Coalesce concurrent calls with the same key: the first caller does the work, the others wait for its result
+    (or exception) instead of repeating it.
+    With a lock directory, the work of ``do_shared`` is also serialized across processes by file locks, keys are
+    hashed to ``stripes`` lock files.
+    '''
+
+    def __init__(self, lock_dir=None, stripes=LOCK_STRIPES):
+        if lock_dir is not None:
+            if fcntl is None:
+                raise ValueError('File locks are not supported on this platform')
+            os.makedirs(lock_dir, exist_ok=True)
+        self.lock_dir = lock_dir
+        self.stripes = stripes
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        '''Coalesce the concurrent calls of this process'''
+        return self._do(key, func, args, kwargs, False)
+
+    def do_shared(self, key, func, *args, **kwargs):
+        '''
+        Coalesce the concurrent calls of this process, and serialize them across processes. Callers in the other
+        processes run the work after the lock is released, so it has to check first whether it is done already.
+        '''
+        return self._do(key, func, args, kwargs, True)
+
+    def _do(self, key, func, args, kwargs, shared):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = self._run(key, func, args, kwargs) if shared else func(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def _run(self, key, func, args, kwargs):
+        if self.lock_dir is None or getattr(_held, 'stripe', None) is not None:
+            return func(*args, **kwargs)
+        # Lock files are kept, removing them would race with the processes waiting for them
+        stripe = int(hashlib.sha1(repr(key).encode('utf8')).hexdigest()[:8], 16) % self.stripes
+        with open(os.path.join(self.lock_dir, '%d.lock' % stripe), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            _held.stripe = stripe
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _held.stripe = None
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def __len__(self):
+        '''Number of calls in flight'''
+        return len(self.calls)
+
+def coalesced(func=None, shared=False):
+    '''
+    Decorate a storage method taking a filename, so concurrent calls for the same file are coalesced by the
+    storage's single flight group. Coalescing can be disabled by the coalesce option of the storage.
+    Shared calls are serialized across processes too (see ``SingleFlight.do_shared``), only methods which skip
+    the work done meanwhile by an other process benefit from it.
+    '''
+    if func is None:
+        return partial(coalesced, shared=shared)
+    @wraps(func)
+    def wrapper(self, filename):
+        if self.flights is None:
+            return func(self, filename)
+        do = self.flights.do_shared if shared else self.flights.do
+        return do((func.__name__, filename), func, self, filename)
+    return wrapper
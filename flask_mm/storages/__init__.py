@@ -4,16 +4,25 @@
 # Common Python library imports
 from __future__ import unicode_literals
 
+import io
+import os
 import six
+import tempfile
 import zipfile
 import zlib
+from contextlib import contextmanager
 # Pip package imports
 
 # Internal package imports
 from flask_mm import files
+from flask_mm.singleflight import SingleFlight, LOCK_STRIPES
+from flask_mm.signals import storage_operation, instrumented
 
 DEFAULT_STORAGE = 'local'
 
+#: Payloads up to this size are kept in the memory, larger ones are spooled to a temporary file
+SPOOL_SIZE = 8 * 1024 * 1024
+
 class BaseStorage(object):
 
     root = None
@@ -21,6 +30,11 @@ class BaseStorage(object):
 
     def __init__(self, *args, **kwargs):
         self.public_view = kwargs.get('public_view', True)
+        self.spool_size = kwargs.get('spool_size', SPOOL_SIZE)
+        # Concurrent fetches of the same file are coalesced. With a lock directory, the work which is skipped when it
+        # is done already (cache fills, variants) is serialized across processes too
+        self.flights = SingleFlight(kwargs.get('lock_dir'), kwargs.get('lock_stripes', LOCK_STRIPES)) \
+            if kwargs.get('coalesce', True) else None
 
     @property
     def has_url(self):
@@ -39,6 +53,22 @@ class BaseStorage(object):
     def read(self, filename):
         raise NotImplementedError('Read operation is not implemented')
 
+    @contextmanager
+    def read_buffer(self, filename):
+        '''
+        Yield the content of a file as a read-only buffer, which is valid only inside the ``with`` block.
+        Backends override it to avoid copying the content to the heap.
+        '''
+        yield memoryview(self.read(filename))
+
+    def read_head(self, filename, size):
+        '''
+        Return the first size bytes of a file (the whole file when it is shorter).
+        Backends override it with a ranged read when opening a file fetches it completely.
+        '''
+        with self.open(filename, 'rb') as f:
+            return f.read(size)
+
     def write(self, filename, content):
         raise NotImplementedError('Write operation is not implemented')
 
@@ -56,12 +86,14 @@ class BaseStorage(object):
         self.write(filename, file_or_wfs.read())
         return filename
 
+    @instrumented(storage_operation, 'metadata')
     def metadata(self, filename):
         meta = self.get_metadata(filename)
         # Fix backend mime misdetection
         meta['mime'] = meta.get('mime') or files.mime(filename, self.DEFAULT_MIME)
         return meta
 
+    @instrumented(storage_operation, 'archive_files')
     def archive_files(self, out_filename, filenames, *args, **kwargs):
         if not isinstance(filenames, (tuple, list)):
             filenames = [filenames]
@@ -71,15 +103,45 @@ class BaseStorage(object):
 
         return out_filename
 
+    def spool_archive(self, out_filename, filenames):
+        '''
+        Build an archive in a spooled temporary file from read buffers, then write it.
+        Used by storages which don't provide direct file access.
+        '''
+        with tempfile.SpooledTemporaryFile(max_size=self.spool_size) as spool:
+            with zipfile.ZipFile(spool, 'w', zipfile.ZIP_DEFLATED) as zipper:
+                for filename in filenames:
+                    with self.read_buffer(filename) as buffer:
+                        zipper.writestr(filename, buffer)
+            spool.seek(0)
+            self.write(out_filename, spool)
+        return out_filename
+
     def get_metadata(self, filename):
         raise NotImplementedError('Copy operation is not implemented')
 
+    def version(self, filename):
+        '''
+        Return a token which changes when a file is written, e.g. its size and modification time. Backends override
+        it with a cheaper lookup than the metadata, whose checksum can read the whole file.
+        '''
+        metadata = self.get_metadata(filename)
+        return (metadata['size'], metadata['modified'], metadata['checksum'])
+
     def serve(self, filename):
         raise NotImplementedError('serve operation is not implemented')
 
     def path(self, filename):
         raise NotImplementedError('path operation is not implemented')
 
+    def upload_content(self, file_or_wfs, **kwargs):
+        '''Return the content of an upload (FileStorage, file or PIL image) as bytes'''
+        if hasattr(file_or_wfs, 'read'):
+            return file_or_wfs.read()
+        buffer = io.BytesIO()
+        file_or_wfs.save(buffer, **kwargs)
+        return buffer.getvalue()
+
     def as_binary(self, content, encoding='utf8'):
         if hasattr(content, 'read'):
             return content.read()
@@ -88,9 +150,89 @@ class BaseStorage(object):
         else:
             return content
 
-    def list_file(self):
+    def list_files(self):
         raise NotImplementedError('list_files operation is not implemented')
 
+class BufferReader(io.RawIOBase):
+    '''Read-only, seekable file over a buffer (e.g. from ``read_buffer``), which doesn't copy the buffer'''
+
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer).cast('B')
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.buffer[self.position:self.position + len(b)]
+        size = len(data)
+        b[:size] = data
+        self.position += size
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.buffer)
+        if offset < 0:
+            raise ValueError('Negative seek position %d' % offset)
+        self.position = offset
+        return offset
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        # Release the view, so the underlying buffer (e.g. a memory map) can be closed
+        self.buffer.release()
+        super(BufferReader, self).close()
+
+def create_child_storage(config, kwargs, exclude=(), name='child storage'):
+    '''
+    Create a storage wrapped by an other storage (e.g. a replica or a shard). The configuration of the wrapping
+    storage is overridden by the child's configuration (e.g. {'STORAGE': 'local', 'ROOT': '/mnt/disk2'}), which
+    has to name the storage and its location: the ROOT, or a BUCKET_NAME of its own.
+    Storage instances are returned as they are.
+    '''
+    if isinstance(config, BaseStorage):
+        return config
+    # Imported here, the storages are loaded by the package
+    from flask_mm import load_entry_point
+    keys = set(k.upper() for k in config)
+    if 'STORAGE' not in keys:
+        raise ValueError('The configuration of %s is missing STORAGE' % name)
+    if 'ROOT' not in keys and 'BUCKET_NAME' not in keys:
+        # The root of the wrapping storage would be shared
+        raise ValueError('The configuration of %s is missing ROOT' % name)
+    options = dict((k, v) for k, v in kwargs.items() if k not in exclude)
+    options.update((k.lower(), v) for k, v in config.items())
+    return load_entry_point('mm.storages', options.pop('storage'))(**options)
+
+def create_child_storages(configs, kwargs, exclude=(), name='child storage'):
+    '''
+    Create the storages wrapped by an other storage (see create_child_storage), the children are named by their
+    position in errors (e.g. shard 1). Children can not share a location.
+    '''
+    storages, locations = [], {}
+    for i, config in enumerate(configs):
+        child = '%s %d' % (name, i)
+        storages.append(create_child_storage(config, kwargs, exclude, child))
+        if isinstance(config, BaseStorage):
+            continue
+        options = dict((k.lower(), v) for k, v in config.items())
+        location = [options.get(key, kwargs.get(key)) for key in ('storage', 'bucket_name', 'root')]
+        if isinstance(location[2], str):
+            location[2] = os.path.normpath(location[2])
+        location = tuple(location)
+        if location in locations:
+            raise ValueError('%s has the same ROOT as %s' % (child, locations[location]))
+        locations[location] = child
+    return storages
+
 def as_unicode(s):
     if isinstance(s, bytes):
         return s.decode('utf-8')
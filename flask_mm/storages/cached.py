@@ -0,0 +1,474 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Common Python library imports
+import heapq
+import io
+import itertools
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+
+# Pip package imports
+from flask import send_file, abort
+
+# Internal package imports
+from flask_mm.storages import BaseStorage
+from flask_mm.storages.local import LocalStorage
+from flask_mm.singleflight import coalesced
+from flask_mm.signals import storage_operation, cache_access, instrumented, result_size, content_size, is_connected
+from .. import files
+
+#: Eviction policies of the cache tiers: least recently used, least frequently used
+EVICTION_LRU = 'lru'
+EVICTION_LFU = 'lfu'
+EVICTION_POLICIES = (EVICTION_LRU, EVICTION_LFU)
+
+#: Write policies: write the origin before returning, or write the cache and upload to the origin in the background
+WRITE_THROUGH = 'through'
+WRITE_BACK = 'back'
+WRITE_POLICIES = (WRITE_THROUGH, WRITE_BACK)
+
+class CacheTier(object):
+    '''
+    Size bounded index of cached objects, which evicts by the LRU or LFU policy.
+    LFU ties are broken by recency. Pinned objects (e.g. not yet written back) are never evicted.
+    '''
+
+    def __init__(self, name, max_size, eviction=EVICTION_LRU):
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError('Eviction must be one of %s' % (EVICTION_POLICIES, ))
+        self.name = name
+        self.max_size = max_size
+        self.eviction = eviction
+        self.size = 0
+        # filename -> [size, hits, last access], ordered from the least recently used
+        self.entries = OrderedDict()
+        self.pinned = set()
+        self.lock = threading.RLock()
+        self._clock = itertools.count()
+        # LFU: (hits, last access, filename) heap, items of outdated entries are skipped
+        self._heap = []
+
+    def __contains__(self, filename):
+        return filename in self.entries
+
+    def touch(self, filename):
+        '''Record an access, return True on a cache hit'''
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is not None:
+                entry[1] += 1
+                self.entries.move_to_end(filename)
+                self._access(filename, entry)
+        if is_connected(cache_access):
+            cache_access.send(self, cache=self.name, key=filename, hit=entry is not None)
+        return entry is not None
+
+    def add(self, filename, size, pin=False):
+        '''Add an object to the index, return the filenames which have to be evicted to make space for it'''
+        with self.lock:
+            self._remove(filename)
+            entry = self.entries[filename] = [size, 1, None]
+            self._access(filename, entry)
+            self.size += size
+            if pin:
+                self.pinned.add(filename)
+            evicted = []
+            while self.size > self.max_size:
+                victim = self._victim(filename)
+                if victim is None:
+                    break
+                self._remove(victim)
+                evicted.append(victim)
+            return evicted
+
+    def _access(self, filename, entry):
+        entry[2] = next(self._clock)
+        if self.eviction == EVICTION_LFU:
+            heapq.heappush(self._heap, (entry[1], entry[2], filename))
+            if len(self._heap) > 2 * len(self.entries) + 64:
+                # Drop the outdated items
+                self._heap = [(e[1], e[2], f) for f, e in self.entries.items()]
+                heapq.heapify(self._heap)
+
+    def _victim(self, keep):
+        if self.eviction == EVICTION_LFU:
+            skipped = []
+            victim = None
+            while self._heap:
+                item = heapq.heappop(self._heap)
+                hits, access, filename = item
+                entry = self.entries.get(filename)
+                if entry is None or entry[1] != hits or entry[2] != access:
+                    continue
+                if filename == keep or filename in self.pinned:
+                    skipped.append(item)
+                    continue
+                victim = filename
+                break
+            for item in skipped:
+                heapq.heappush(self._heap, item)
+            return victim
+        return next((f for f in self.entries if f != keep and f not in self.pinned), None)
+
+    def unpin(self, filename):
+        with self.lock:
+            self.pinned.discard(filename)
+
+    def remove(self, filename):
+        with self.lock:
+            return self._remove(filename)
+
+    def _remove(self, filename):
+        entry = self.entries.pop(filename, None)
+        self.pinned.discard(filename)
+        if entry is None:
+            return False
+        self.size -= entry[0]
+        return True
+
+class MemoryTier(CacheTier):
+    '''In-memory cache of small objects'''
+
+    def __init__(self, max_size, max_object_size, eviction=EVICTION_LRU):
+        super(MemoryTier, self).__init__('memory', max_size, eviction)
+        self.max_object_size = max_object_size
+        self.data = {}
+
+    def get(self, filename):
+        if not self.touch(filename):
+            return None
+        return self.data.get(filename)
+
+    def put(self, filename, content):
+        if len(content) > self.max_object_size:
+            self.remove(filename)
+            return
+        with self.lock:
+            self.data[filename] = content
+            for evicted in self.add(filename, len(content)):
+                self.data.pop(evicted, None)
+
+    def remove(self, filename):
+        with self.lock:
+            self.data.pop(filename, None)
+            return super(MemoryTier, self).remove(filename)
+
+class DiskTier(CacheTier):
+    '''Local disk cache, the index is rebuilt from the files which are already cached'''
+
+    def __init__(self, root, max_size, eviction=EVICTION_LRU):
+        super(DiskTier, self).__init__('disk', max_size, eviction)
+        # Partially fetched files are never visible in the cache
+        self.storage = LocalStorage(root, atomic_writes=True)
+        for filename in self.storage.list_files():
+            self.add(filename, os.path.getsize(self.storage.path(filename)))
+
+    def put(self, filename, file, pin=False):
+        self.storage.save(file, filename)
+        self._added(filename, pin)
+
+    def write(self, filename, content, pin=False):
+        self.storage.write(filename, content)
+        self._added(filename, pin)
+
+    def _added(self, filename, pin):
+        for evicted in self.add(filename, os.path.getsize(self.storage.path(filename)), pin):
+            self._delete(evicted)
+
+    def remove(self, filename):
+        if super(DiskTier, self).remove(filename):
+            self._delete(filename)
+
+    def _delete(self, filename):
+        try:
+            self.storage.delete(filename)
+        except FileNotFoundError:
+            pass
+
+class CachedStorage(BaseStorage):
+    '''
+    Read-through cache in front of an other storage (the origin), e.g. S3 with a local disk cache and an
+    in-memory cache for small, hot objects. Reads are served by the nearest tier, writes and deletes invalidate
+    the tiers. The origin is an mm.storages entry point name, which is created with the same configuration,
+    or a storage instance.
+    '''
+
+    def __init__(self, origin, *args, **kwargs):
+        super(CachedStorage, self).__init__(*args, **kwargs)
+        if isinstance(origin, BaseStorage):
+            self.origin = origin
+        else:
+            # Imported here, the storages are loaded by the package
+            from flask_mm import load_entry_point
+            storage = load_entry_point('mm.storages', origin)
+            if issubclass(storage, CachedStorage):
+                raise ValueError('The origin of a cached storage can not be a cached storage')
+            self.origin = storage(**kwargs)
+
+        eviction = kwargs.get('cache_eviction', EVICTION_LRU)
+        self.write_policy = kwargs.get('cache_write', WRITE_THROUGH)
+        if self.write_policy not in WRITE_POLICIES:
+            raise ValueError('Cache write must be one of %s' % (WRITE_POLICIES, ))
+
+        memory_size = kwargs.get('cache_memory_size', 64 * 1024 * 1024)
+        self.memory = MemoryTier(memory_size, kwargs.get('cache_object_size', 256 * 1024),
+                                 eviction) if memory_size else None
+        cache_root = kwargs.get('cache_root')
+        self.disk = DiskTier(cache_root, kwargs.get('cache_disk_size', 1024 * 1024 * 1024),
+                             eviction) if cache_root else None
+        if self.write_policy == WRITE_BACK and self.disk is None:
+            raise ValueError('Write back caching requires a disk cache (cache_root)')
+
+        # Origin metadata, invalidated with the content
+        self._metadata = OrderedDict()
+        self._metadata_size = kwargs.get('cache_metadata_size', 1024)
+        # filename -> pending upload to the origin (write back)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=kwargs.get('cache_write_workers', 4)) \
+            if self.write_policy == WRITE_BACK else None
+
+    @property
+    def root(self):
+        return self.disk.storage.root if self.disk is not None else self.origin.root
+
+    def path(self, filename):
+        '''Return the path of a file in the disk cache, the file is fetched from the origin if needed'''
+        if self.disk is None:
+            return self.origin.path(filename)
+        if self.origin.exists(filename):
+            self._fetch(filename)
+        return self.disk.storage.path(filename)
+
+    def _fetch(self, filename):
+        '''Make sure that a file is cached on the disk, it is streamed from the origin on a miss'''
+        if not self.disk.touch(filename):
+            self._fill(filename)
+
+    def _read_disk(self, operation, filename, *args):
+        '''
+        Read a file from the disk cache, it is fetched on a miss. A concurrent eviction can delete the file between
+        the cache hit and the read, the origin is read then.
+        '''
+        self._fetch(filename)
+        try:
+            return getattr(self.disk.storage, operation)(filename, *args)
+        except FileNotFoundError:
+            return getattr(self.origin, operation)(filename, *args)
+
+    @coalesced(shared=True)
+    def _fill(self, filename):
+        # An other process sharing the cache directory could have fetched it while this one waited for the lock
+        if os.path.exists(self.disk.storage.path(filename)):
+            self.disk._added(filename, False)
+            return
+        with self.origin.open(filename, 'rb') as f:
+            self.disk.put(filename, f)
+
+    def _invalidate(self, filename):
+        if self.memory is not None:
+            self.memory.remove(filename)
+        if self.disk is not None:
+            self.disk.remove(filename)
+        self._metadata.pop(filename, None)
+
+    @instrumented(storage_operation, 'exists')
+    def exists(self, filename):
+        if self.memory is not None and filename in self.memory:
+            return True
+        if self.disk is not None and filename in self.disk:
+            return True
+        return self.origin.exists(filename)
+
+    @instrumented(storage_operation, 'read', size=result_size)
+    def read(self, filename):
+        if self.memory is not None:
+            content = self.memory.get(filename)
+            if content is not None:
+                return content
+        if self.disk is not None:
+            content = self._read_disk('read', filename)
+        else:
+            content = self.origin.read(filename)
+        if self.memory is not None:
+            self.memory.put(filename, content)
+        return content
+
+    @contextmanager
+    def read_buffer(self, filename):
+        if self.memory is not None:
+            content = self.memory.get(filename)
+            if content is not None:
+                yield memoryview(content)
+                return
+        if self.disk is None:
+            with self.origin.read_buffer(filename) as buffer:
+                yield buffer
+            return
+        self._fetch(filename)
+        with ExitStack() as stack:
+            try:
+                buffer = stack.enter_context(self.disk.storage.read_buffer(filename))
+            except FileNotFoundError:
+                # Evicted since it was fetched
+                buffer = stack.enter_context(self.origin.read_buffer(filename))
+            yield buffer
+
+    def read_head(self, filename, size):
+        if self.memory is not None:
+            content = self.memory.get(filename)
+            if content is not None:
+                return content[:size]
+        if self.disk is not None and self.disk.touch(filename):
+            try:
+                return self.disk.storage.read_head(filename, size)
+            except FileNotFoundError:
+                # Evicted since it was touched
+                pass
+        # A partial read doesn't fill the cache
+        return self.origin.read_head(filename, size)
+
+    def open(self, filename, mode='r', encoding='utf8'):
+        if 'r' not in mode or '+' in mode:
+            # Written files go straight to the origin
+            self.flush(filename)
+            self._invalidate(filename)
+            return self.origin.open(filename, mode, encoding=encoding)
+        if self.disk is not None:
+            return self._read_disk('open', filename, mode, encoding)
+        content = self.read(filename)
+        if 'b' in mode:
+            return io.BytesIO(content)
+        return io.StringIO(content.decode(encoding))
+
+    @instrumented(storage_operation, 'write', size=content_size(1))
+    def write(self, filename, content):
+        content = self.as_binary(content)
+        self._supersede(filename)
+        self._invalidate(filename)
+        if self.write_policy == WRITE_BACK:
+            self.disk.write(filename, content, pin=True)
+            with self._pending_lock:
+                self._pending[filename] = self._executor.submit(self._write_back, filename)
+        else:
+            self.origin.write(filename, content)
+            # Freshly written files are likely to be read soon
+            if self.disk is not None:
+                self.disk.write(filename, content)
+        if self.memory is not None:
+            self.memory.put(filename, content)
+
+    def _write_back(self, filename):
+        with self.disk.storage.open(filename, 'rb') as f:
+            self.origin.save(f, filename)
+        # A failed upload stays pinned and pending, so the file is not evicted before it is written back
+        self.disk.unpin(filename)
+        # The lock makes sure that the future has been registered already
+        with self._pending_lock:
+            self._pending.pop(filename, None)
+
+    def flush(self, filename=None):
+        '''
+        Wait until pending write backs (of a single file or every file) are written to the origin.
+        Failed uploads are retried once, the error is raised when the retry fails too.
+        '''
+        with self._pending_lock:
+            if filename is not None:
+                pending = [(filename, self._pending[filename])] if filename in self._pending else []
+            else:
+                pending = list(self._pending.items())
+        error = None
+        for name, future in pending:
+            try:
+                future.result()
+            except Exception:
+                try:
+                    self._write_back(name)
+                except Exception as e:
+                    error = error or e
+        if error is not None:
+            raise error
+        return len(pending)
+
+    def _supersede(self, filename):
+        '''Wait for the pending write back of a file which is written again, a failed one is replaced'''
+        future = self._pending.get(filename)
+        if future is not None:
+            try:
+                future.result()
+            except Exception:
+                pass
+
+    @instrumented(storage_operation, 'save', size=content_size(0))
+    def save(self, file_or_wfs, filename, **kwargs):
+        filename = filename or getattr(file_or_wfs, 'filename', None)
+        self.write(filename, self.upload_content(file_or_wfs, **kwargs))
+        return filename
+
+    @instrumented(storage_operation, 'delete')
+    def delete(self, filename):
+        self.flush(filename)
+        self._invalidate(filename)
+        self.origin.delete(filename)
+
+    @instrumented(storage_operation, 'copy')
+    def copy(self, filename, target):
+        self.flush(filename)
+        self._invalidate(target)
+        self.origin.copy(filename, target)
+
+    @instrumented(storage_operation, 'move')
+    def move(self, filename, target):
+        self.flush(filename)
+        self._invalidate(filename)
+        self._invalidate(target)
+        self.origin.move(filename, target)
+
+    @instrumented(storage_operation, 'archive_files')
+    def archive_files(self, out_filename, filenames, *args, **kwargs):
+        if not isinstance(filenames, (tuple, list)):
+            filenames = [filenames]
+        return self.spool_archive(out_filename, filenames)
+
+    def list_files(self):
+        self.flush()
+        return self.origin.list_files()
+
+    def get_metadata(self, filename):
+        try:
+            meta = self._metadata[filename]
+            self._metadata.move_to_end(filename)
+            return dict(meta)
+        except KeyError:
+            pass
+        self.flush(filename)
+        meta = self.origin.get_metadata(filename)
+        if self._metadata_size:
+            self._metadata[filename] = meta
+            while len(self._metadata) > self._metadata_size:
+                try:
+                    self._metadata.popitem(last=False)
+                except KeyError:
+                    pass
+        return dict(meta)
+
+    def version(self, filename):
+        # The origin is up to date once the pending upload is done, as for the metadata
+        self.flush(filename)
+        return self.origin.version(filename)
+
+    @instrumented(storage_operation, 'serve')
+    def serve(self, filename):
+        '''Serve files from the nearest tier'''
+        if not self.public_view:
+            abort(400)
+        if self.disk is not None:
+            self._fetch(filename)
+            return self.disk.storage.serve(filename)
+        if self.memory is not None:
+            return send_file(io.BytesIO(self.read(filename)), mimetype=files.mime(filename, self.DEFAULT_MIME))
+        return self.origin.serve(filename)
@@ -6,7 +6,11 @@ import errno
 import hashlib
 import os
 import io
+import mmap
 import shutil
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 
 # Pip package imports
@@ -17,11 +21,21 @@ from werkzeug.datastructures import FileStorage
 
 # Internal package imports
 from flask_mm.storages import BaseStorage, as_unicode
+from flask_mm.signals import storage_operation, instrumented, result_size, content_size
 from .. import files
 
 
 CHUNK_SIZE = 2 ** 16
 
+# Files being written atomically are named with this prefix until they are moved in place
+TEMP_PREFIX = '.mmtmp-'
+
+#: Durability levels: no fsync, fsync the written file, fsync the file and its directory (the rename survives a crash)
+DURABILITY_NONE = 'none'
+DURABILITY_FILE = 'file'
+DURABILITY_DIR = 'dir'
+DURABILITY_LEVELS = (DURABILITY_NONE, DURABILITY_FILE, DURABILITY_DIR)
+
 def sha1(file):
     hasher = hashlib.sha1()
     blk_size_to_read = hasher.block_size * CHUNK_SIZE
@@ -32,6 +46,69 @@ def sha1(file):
         hasher.update(read_data)
     return hasher.hexdigest()
 
+def fsync_dir(dirname):
+    '''Flush a directory entry (e.g. a rename) to disk, this is not supported on every platform'''
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(dirname, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class DurableFile(object):
+    '''
+    File opened for writing, which is written to a temporary file in the same directory and moved in place by
+    ``os.replace`` on close when ``atomic`` is set. Readers never see a partially written file, and a failed write
+    leaves the previous file untouched. ``durability`` controls the fsync calls before the file is considered written.
+    '''
+
+    def __init__(self, path, mode='wb', encoding=None, atomic=True, durability=DURABILITY_NONE):
+        # The name is the final path, as for a regular file (e.g. PIL detects the format from it)
+        self.name = path
+        self.atomic = atomic
+        self.durability = durability
+        if atomic:
+            self.temp_name = os.path.join(os.path.dirname(path), TEMP_PREFIX + os.urandom(8).hex())
+            # The file is created with the same permissions as by open(), unlike tempfile.mkstemp
+            fd = os.open(self.temp_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+            self.file = io.open(fd, mode, encoding=encoding)
+        else:
+            self.temp_name = path
+            self.file = io.open(path, mode, encoding=encoding)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def close(self):
+        if self.file.closed:
+            return
+        if self.durability != DURABILITY_NONE:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.file.close()
+        if self.atomic:
+            os.replace(self.temp_name, self.name)
+        if self.durability == DURABILITY_DIR:
+            fsync_dir(os.path.dirname(self.name))
+
+    def discard(self):
+        '''Close the file without moving it in place'''
+        if self.file.closed:
+            return
+        self.file.close()
+        if self.atomic:
+            os.remove(self.temp_name)
+
 class LocalStorage(BaseStorage):
 
     def __init__(self, root, *args, **kwargs):
@@ -40,6 +117,20 @@ class LocalStorage(BaseStorage):
 
         # Optional parameters
         self.permission = kwargs.get('permission', 0o666)
+        # Files can be spread into nested shard directories, e.g. root/3f/a0/<filename> for a depth of 2
+        self.shard_depth = kwargs.get('shard_depth', 0)
+        self.shard_width = kwargs.get('shard_width', 2)
+        if self.shard_depth * self.shard_width > 8:
+            raise ValueError('The shard directories can use at most 8 hex digits (shard_depth * shard_width)')
+        self.atomic_writes = kwargs.get('atomic_writes', False)
+        self.durability = kwargs.get('durability', DURABILITY_NONE)
+        if self.durability not in DURABILITY_LEVELS:
+            raise ValueError('Durability must be one of %s' % (DURABILITY_LEVELS, ))
+        # Directories known to exist, so writes into them skip the stat call. The oldest entry is evicted first.
+        self.dir_cache_size = kwargs.get('dir_cache_size', 1024)
+        self._known_dirs = OrderedDict()
+        # The root is resolved only once, unless it is computed by a callable
+        self._static_base_path = None if callable(root) else root
 
         if not self.exists(self.base_path):
             self.ensure_path(self.base_path)
@@ -49,12 +140,18 @@ class LocalStorage(BaseStorage):
     def root(self):
         return os.path.normpath(self.base_path)
 
+    @instrumented(storage_operation, 'exists')
     def exists(self, filename):
         dest = self.path(filename)
         return os.path.exists(dest)
 
     def ensure_path(self, filename):
-        dirname = os.path.dirname(self.path(filename))
+        self._ensure_dir(os.path.dirname(self.path(filename)))
+
+    def _ensure_dir(self, dirname):
+        known_dirs = self._known_dirs
+        if dirname in known_dirs:
+            return
         if not os.path.exists(dirname):
             try:
                 os.makedirs(dirname, self.permission | 0o111)
@@ -63,80 +160,211 @@ class LocalStorage(BaseStorage):
                 # directory has been created elsewhere
                 if e.errno != errno.EEXIST:
                     raise
+        if self.dir_cache_size:
+            known_dirs[dirname] = True
+            if len(known_dirs) > self.dir_cache_size:
+                try:
+                    known_dirs.popitem(last=False)
+                except KeyError:
+                    # Evicted by an other thread
+                    pass
+
+    def _forget_dirs(self, dirname):
+        '''Remove a deleted directory and its subdirectories from the known directories'''
+        prefix = dirname.rstrip(os.sep) + os.sep
+        for known in list(self._known_dirs):
+            if known == dirname or known.startswith(prefix):
+                self._known_dirs.pop(known, None)
 
     def open(self, filename, mode='r', encoding='utf8'):
         dest = self.path(filename)
         if 'w' in mode:
             self.ensure_path(filename)
+            return self._open_write(dest, mode, None if 'b' in mode else encoding)
         if 'b' in mode:
             return open(dest, mode)
         else:
             return io.open(dest, mode, encoding=encoding)
 
+    def _open_write(self, dest, mode='wb', encoding=None):
+        '''Open a file for writing, its directory is expected to be ensured already'''
+        try:
+            return self._create(dest, mode, encoding)
+        except FileNotFoundError:
+            # The directory was removed since it has been cached (e.g. by an other process), create it again
+            dirname = os.path.dirname(dest)
+            self._known_dirs.pop(dirname, None)
+            self._ensure_dir(dirname)
+            return self._create(dest, mode, encoding)
+
+    def _create(self, dest, mode, encoding):
+        if (self.atomic_writes or self.durability != DURABILITY_NONE) and '+' not in mode:
+            return DurableFile(dest, mode, encoding, atomic=self.atomic_writes, durability=self.durability)
+        return io.open(dest, mode, encoding=encoding)
+
+    @instrumented(storage_operation, 'read', size=result_size)
     def read(self, filename):
         with self.open(filename, 'rb') as f:
             return f.read()
 
+    @contextmanager
+    def open_mmap(self, filename):
+        '''
+        Yield a read-only memory map of a file, which is closed at the end of the ``with`` block.
+        Empty files can't be mapped, an empty in-memory file is yielded for them.
+        '''
+        with open(self.path(filename), 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                yield io.BytesIO()
+                return
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield mapped
+            finally:
+                mapped.close()
+
+    @contextmanager
+    def read_buffer(self, filename):
+        '''Yield a memoryview over a memory map of a file, without copying it to the heap'''
+        with self.open_mmap(filename) as mapped:
+            view = mapped.getbuffer() if isinstance(mapped, io.BytesIO) else memoryview(mapped)
+            try:
+                yield view
+            finally:
+                view.release()
+
+    @instrumented(storage_operation, 'write', size=content_size(1))
     def write(self, filename, content):
-        self.ensure_path(filename)
         with self.open(filename, 'wb') as f:
             return f.write(self.as_binary(content))
 
+    @instrumented(storage_operation, 'delete')
     def delete(self, filename):
         dest = self.path(filename)
         if os.path.isdir(dest):
             shutil.rmtree(dest, ignore_errors=True)
+            self._forget_dirs(dest)
         else:
             os.remove(dest)
 
+    @instrumented(storage_operation, 'save', size=content_size(0))
     def save(self, file_or_wfs, filename, **kwargs):
         self.ensure_path(filename)
         dest = self.path(filename)
-        if isinstance(file_or_wfs, FileStorage):
-            file_or_wfs.save(dest, **kwargs)
-        else:
-            with open(dest, 'wb') as out:
+        with self._open_write(dest) as out:
+            if isinstance(file_or_wfs, FileStorage):
+                file_or_wfs.save(out, **kwargs)
+            else:
                 try:
                     shutil.copyfileobj(file_or_wfs, out)
                 except AttributeError:
                     file_or_wfs.save(out, **kwargs)
         return filename
 
+    @instrumented(storage_operation, 'copy')
     def copy(self, filename, target):
         src = self.path(filename)
         dest = self.path(target)
         self.ensure_path(target)
-        shutil.copy2(src, dest)
+        if self.atomic_writes:
+            with self._open_write(dest) as out, open(src, 'rb') as f:
+                shutil.copyfileobj(f, out)
+                out.flush()
+                shutil.copystat(src, out.temp_name)
+        else:
+            shutil.copy2(src, dest)
 
+    @instrumented(storage_operation, 'move')
     def move(self, filename, target):
         src = self.path(filename)
         dest = self.path(target)
         self.ensure_path(target)
         shutil.move(src, dest)
 
-    def list_files(self):
+    def _walk(self):
+        '''Yield the path of every file relative to the root'''
         for dirpath, dirnames, filenames in os.walk(self.root):
             prefix = os.path.relpath(dirpath, self.root)
             for f in filenames:
+                if f.startswith(TEMP_PREFIX):
+                    # Atomic write in progress (or left behind by a crash)
+                    continue
                 yield os.path.join(prefix, f) if prefix != '.' else f
 
+    def list_files(self):
+        if not self.shard_depth:
+            for relpath in self._walk():
+                yield relpath
+            return
+        for relpath in self._walk():
+            # Files which are not in their shard directory (e.g. not yet rehomed) are listed by their path
+            yield self._split_shard(relpath, self.shard_depth) or relpath
+
+    def shard(self, filename, depth=None):
+        '''Return the shard directories of a filename, which are derived from the hash of the filename'''
+        depth = self.shard_depth if depth is None else depth
+        digest = '%08x' % zlib.crc32(filename.encode('utf-8'))
+        width = self.shard_width
+        return os.path.join(*[digest[i * width:(i + 1) * width] for i in range(depth)])
+
+    def _split_shard(self, relpath, depth):
+        '''Return the filename of a path relative to the root, if the file is in its shard directories'''
+        parts = relpath.split(os.sep, depth)
+        if len(parts) <= depth:
+            return None
+        filename = parts[depth]
+        if os.path.join(*parts[:depth]) == self.shard(filename, depth):
+            return filename
+        return None
+
+    def relpath(self, filename):
+        '''Return the path of a filename relative to the root'''
+        if not self.shard_depth:
+            return filename
+        return os.path.join(self.shard(filename), filename)
+
     def path(self, filename):
         '''Return the full path for a given filename in the storage'''
-        if callable(self.base_path):
-            return os.path.join(self.base_path(), filename)
-        return os.path.join(self.base_path, filename)
+        base_path = self._static_base_path
+        if base_path is None:
+            base_path = self.base_path()
+        return os.path.join(base_path, self.relpath(filename))
+
+    def rehome_files(self, previous_depth=0):
+        '''
+        Move every file into the shard directories of the current layout.
+        Files are expected to be in the shard directories of ``previous_depth`` (0: directly under the root).
+        Returns the number of moved files.
+        '''
+        moved = 0
+        # The file list is collected before moving anything, because moves would change the walked directories
+        for relpath in list(self._walk()):
+            if self.shard_depth and self._split_shard(relpath, self.shard_depth) is not None:
+                continue
+            filename = (self._split_shard(relpath, previous_depth) if previous_depth else None) or relpath
+            if self.relpath(filename) == relpath:
+                continue
+            self.ensure_path(filename)
+            os.replace(os.path.join(self.root, relpath), self.path(filename))
+            moved += 1
+        return moved
 
+    @instrumented(storage_operation, 'serve')
     def serve(self, filename):
         if not self.public_view:
             abort(400)
         '''Serve files for storages with direct file access'''
-        return send_from_directory(self.root, filename)
+        return send_from_directory(self.root, self.relpath(filename))
+
+    def version(self, filename):
+        stat = os.stat(self.path(filename))
+        return (stat.st_size, stat.st_mtime_ns)
 
     def get_metadata(self, filename):
         '''Fetch all available metadata'''
         dest = self.path(filename)
-        with open(dest, 'rb', buffering=0) as f:
-            checksum = 'sha1:{0}'.format(sha1(f))
+        with self.read_buffer(filename) as buffer:
+            checksum = 'sha1:{0}'.format(hashlib.sha1(buffer).hexdigest())
         return {
             'checksum': checksum,
             'size': os.path.getsize(dest),
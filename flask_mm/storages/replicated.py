@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Common Python library imports
+import io
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from contextlib import contextmanager
+from time import perf_counter
+
+# Pip package imports
+
+# Internal package imports
+from flask_mm.storages import BaseStorage, create_child_storages
+from flask_mm.signals import storage_operation, instrumented, result_size, content_size
+
+#: Reads are hedged only when the latency quantile is estimated from at least this many samples
+HEDGE_MIN_SAMPLES = 20
+
+class Replica(object):
+    '''
+    A replicated storage with its recent latencies and health.
+    A replica is unhealthy for ``retry_after`` seconds after an error, missing files are not errors.
+    '''
+
+    def __init__(self, storage, window=100, retry_after=30):
+        self.storage = storage
+        self.latencies = deque(maxlen=window)
+        self.retry_after = retry_after
+        self.failed_until = 0.0
+
+    def call(self, operation, *args, **kwargs):
+        start = perf_counter()
+        try:
+            result = getattr(self.storage, operation)(*args, **kwargs)
+        except FileNotFoundError:
+            raise
+        except Exception:
+            self.failed_until = time.monotonic() + self.retry_after
+            raise
+        self.latencies.append(perf_counter() - start)
+        return result
+
+    @property
+    def healthy(self):
+        return time.monotonic() >= self.failed_until
+
+    @property
+    def latency(self):
+        '''Mean latency, unmeasured replicas are preferred to get samples from them'''
+        latencies = list(self.latencies)
+        return sum(latencies) / len(latencies) if latencies else 0.0
+
+    def quantile(self, q):
+        latencies = sorted(self.latencies)
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return latencies[int(q * (len(latencies) - 1))]
+
+class ReplicatedWriter(io.BytesIO):
+    '''File opened for writing on a replicated storage, the content is written to the replicas on close'''
+
+    def __init__(self, storage, filename):
+        super(ReplicatedWriter, self).__init__()
+        self.storage = storage
+        self.filename = filename
+
+    def close(self):
+        if not self.closed:
+            self.storage.write(self.filename, self.getvalue())
+        super(ReplicatedWriter, self).close()
+
+class ReplicatedStorage(BaseStorage):
+    '''
+    Mirror files on several storages (e.g. two local volumes, or local and S3).
+    Writes go to every replica in parallel and succeed when ``write_quorum`` replicas succeeded.
+    Reads go to the fastest healthy replica, and are hedged to the next one when the fastest is slower than its
+    ``hedge_quantile`` latency. Replicas are configured as a list of configuration overrides (e.g.
+    ``{'STORAGE': 'local', 'ROOT': '/mnt/disk2'}``) or storage instances.
+    '''
+
+    def __init__(self, replicas, *args, **kwargs):
+        super(ReplicatedStorage, self).__init__(*args, **kwargs)
+        retry_after = kwargs.get('replica_retry', 30)
+        self.replicas = [Replica(storage, retry_after=retry_after)
+                         for storage in create_child_storages(replicas, kwargs, exclude=('replicas', ), name='replica')]
+        if not self.replicas:
+            raise ValueError('At least one replica is required')
+        self.write_quorum = kwargs.get('write_quorum') or len(self.replicas)
+        if not 0 < self.write_quorum <= len(self.replicas):
+            raise ValueError('Write quorum must be between 1 and the number of replicas (%d)' % len(self.replicas))
+        self.hedge = kwargs.get('hedge', True)
+        self.hedge_quantile = kwargs.get('hedge_quantile', 0.95)
+        if any(isinstance(replica.storage, ReplicatedStorage) for replica in self.replicas):
+            raise ValueError('A replica can not be a replicated storage')
+        self._executor = ThreadPoolExecutor(max_workers=kwargs.get('replica_workers', 4 * len(self.replicas)))
+
+    @property
+    def root(self):
+        return self.replicas[0].storage.root
+
+    def _ordered(self):
+        '''Return the replicas ordered by health, then by latency'''
+        return sorted(self.replicas, key=lambda r: (not r.healthy, r.latency))
+
+    def _read(self, operation, filename, *args):
+        '''
+        Call a read operation on the fastest replica. When it is slower than usual, the next replica is called too
+        and the first result wins. Failing replicas are skipped.
+        '''
+        replicas = self._ordered()
+        error = None
+        index = 0
+        while index < len(replicas):
+            primary = replicas[index]
+            index += 1
+            timeout = primary.quantile(self.hedge_quantile) if self.hedge and index < len(replicas) else None
+            if timeout is None:
+                try:
+                    return primary.call(operation, filename, *args)
+                except Exception as e:
+                    error = e
+                    continue
+            running = {self._executor.submit(primary.call, operation, filename, *args)}
+            done, _ = wait(running, timeout=timeout)
+            if not done:
+                running.add(self._executor.submit(replicas[index].call, operation, filename, *args))
+                index += 1
+            while running:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        return future.result()
+                    except Exception as e:
+                        error = e
+        raise error
+
+    def _write(self, operation, *args, **kwargs):
+        '''Call a write operation on every replica in parallel, and wait until the quorum is reached'''
+        missing_ok = kwargs.pop('missing_ok', False)
+        futures = [self._executor.submit(replica.call, operation, *args, **kwargs) for replica in self.replicas]
+        succeeded = 0
+        errors = []
+        for future in as_completed(futures):
+            try:
+                future.result()
+                succeeded += 1
+            except FileNotFoundError as e:
+                if missing_ok:
+                    succeeded += 1
+                else:
+                    errors.append(e)
+            except Exception as e:
+                errors.append(e)
+            if succeeded >= self.write_quorum:
+                # The other replicas are written in the background
+                return
+            if len(errors) > len(self.replicas) - self.write_quorum:
+                raise errors[0]
+
+    @instrumented(storage_operation, 'exists')
+    def exists(self, filename):
+        # A file written with a quorum can be missing from the other replicas only
+        for replica in self._ordered()[:len(self.replicas) - self.write_quorum + 1]:
+            try:
+                if replica.call('exists', filename):
+                    return True
+            except Exception:
+                continue
+        return False
+
+    @instrumented(storage_operation, 'read', size=result_size)
+    def read(self, filename):
+        return self._read('read', filename)
+
+    def read_head(self, filename, size):
+        return self._read('read_head', filename, size)
+
+    @contextmanager
+    def read_buffer(self, filename):
+        replica = self._replica_with(filename)
+        with replica.storage.read_buffer(filename) as buffer:
+            yield buffer
+
+    def _replica_with(self, filename):
+        '''Return the fastest replica which has a file'''
+        for replica in self._ordered():
+            try:
+                if replica.call('exists', filename):
+                    return replica
+            except Exception:
+                continue
+        raise FileNotFoundError(filename)
+
+    def open(self, filename, mode='r', encoding='utf8'):
+        if 'r' in mode and '+' not in mode:
+            return self._replica_with(filename).storage.open(filename, mode, encoding=encoding)
+        if 'b' in mode:
+            return ReplicatedWriter(self, filename)
+        return io.TextIOWrapper(ReplicatedWriter(self, filename), encoding=encoding)
+
+    @instrumented(storage_operation, 'write', size=content_size(1))
+    def write(self, filename, content):
+        self._write('write', filename, self.as_binary(content))
+
+    @instrumented(storage_operation, 'save', size=content_size(0))
+    def save(self, file_or_wfs, filename, **kwargs):
+        filename = filename or getattr(file_or_wfs, 'filename', None)
+        # Read once, the replicas are written from the same content
+        self._write('write', filename, self.upload_content(file_or_wfs, **kwargs))
+        return filename
+
+    @instrumented(storage_operation, 'delete')
+    def delete(self, filename):
+        self._write('delete', filename, missing_ok=True)
+
+    @instrumented(storage_operation, 'copy')
+    def copy(self, filename, target):
+        self._write('copy', filename, target)
+
+    @instrumented(storage_operation, 'move')
+    def move(self, filename, target):
+        self._write('move', filename, target)
+
+    @instrumented(storage_operation, 'archive_files')
+    def archive_files(self, out_filename, filenames, *args, **kwargs):
+        if not isinstance(filenames, (tuple, list)):
+            filenames = [filenames]
+        return self.spool_archive(out_filename, filenames)
+
+    def list_files(self):
+        return self._ordered()[0].storage.list_files()
+
+    def get_metadata(self, filename):
+        return self._read('get_metadata', filename)
+
+    def version(self, filename):
+        return self._read('version', filename)
+
+    def path(self, filename):
+        try:
+            return self._replica_with(filename).storage.path(filename)
+        except FileNotFoundError:
+            return self._ordered()[0].storage.path(filename)
+
+    @instrumented(storage_operation, 'serve')
+    def serve(self, filename):
+        '''Serve files from the fastest replica which has them'''
+        return self._replica_with(filename).storage.serve(filename)
@@ -3,10 +3,14 @@
 
 # Common Python library imports
 import errno
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 import os
 import mimetypes
 import io
+import mmap
+import shutil
+import tempfile
 import zipfile
 import codecs
 
@@ -21,9 +25,27 @@ from werkzeug.datastructures import FileStorage
 
 # Internal package imports
 from flask_mm.storages import BaseStorage, as_unicode
+from flask_mm.singleflight import coalesced
+from flask_mm.signals import storage_operation, instrumented, result_size, content_size
 from .. import files
 
 
+#: Objects above this size can't be copied by a single CopyObject request
+COPY_OBJECT_LIMIT = 5 * 1024 ** 3
+
+#: Error codes of missing objects, HEAD requests have no body to carry the NoSuchKey code
+MISSING_CODES = frozenset(('NoSuchKey', 'NotFound', '404'))
+
+@contextmanager
+def not_found(filename):
+    '''Raise FileNotFoundError for missing objects, as the other storages do'''
+    try:
+        yield
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in MISSING_CODES:
+            raise FileNotFoundError(errno.ENOENT, 'No such object', filename)
+        raise
+
 class S3Storage(BaseStorage):
 
     BASE_URL = "{bucket_name}.s3.{region}.amazonaws.com/"
@@ -39,10 +61,15 @@ class S3Storage(BaseStorage):
         # Optional parameters
         self.base_path = kwargs.get('root')
         self.policy = kwargs.get('policy')
+        # S3 compatible services (or a local stand-in) can be used through a custom endpoint
+        self.endpoint_url = kwargs.get('endpoint_url')
+        # Server side copies: parallel requests of batches and part size of multipart copies
+        self.copy_workers = kwargs.get('copy_workers', 16)
+        self.copy_part_size = kwargs.get('copy_part_size', 512 * 1024 * 1024)
 
         self.s3 = self.session.resource('s3',
                                         config=self.s3config,
-                                        #endpoint_url='', #TODO: Get url
+                                        endpoint_url=self.endpoint_url,
                                         region_name=aws_region,
                                         aws_access_key_id=aws_access_key,
                                         aws_secret_access_key=aws_secret_access_key)
@@ -101,6 +128,7 @@ class S3Storage(BaseStorage):
             return self.base_path() + self.separator + filename
         return self.base_path + self.separator + filename
 
+    @instrumented(storage_operation, 'exists')
     def exists(self, filename):
         try:
             self.bucket.Object(self.path(filename)).load()
@@ -112,17 +140,56 @@ class S3Storage(BaseStorage):
     def open(self, filename, mode='r', encoding='utf8'):
         obj = self.bucket.Object(self.path(filename))
         if 'r' in mode:
-            f = obj.get()['Body']
+            with not_found(filename):
+                f = obj.get()['Body']
             yield f if 'b' in mode else codecs.getreader(encoding)(f)
         else:  # mode == 'w'
             f = io.BytesIO() if 'b' in mode else io.StringIO()
             yield f
             obj.put(Body=f.getvalue())
 
+    @instrumented(storage_operation, 'read', size=result_size)
+    @coalesced
     def read(self, filename):
-        obj = self.bucket.Object(self.path(filename)).get()
+        with not_found(filename):
+            obj = self.bucket.Object(self.path(filename)).get()
         return obj['Body'].read()
 
+    def read_head(self, filename, size):
+        try:
+            with not_found(filename):
+                obj = self.bucket.Object(self.path(filename)).get(Range='bytes=0-%d' % (size - 1))
+        except ClientError as e:
+            # The range of an empty object is not satisfiable
+            if e.response.get('Error', {}).get('Code') == 'InvalidRange':
+                return b''
+            raise
+        return obj['Body'].read()
+
+    @contextmanager
+    def read_buffer(self, filename):
+        '''
+        Yield the content of an object as a read-only buffer. Objects up to ``spool_size`` are read into the
+        memory, larger ones are spooled to a temporary file and memory mapped.
+        '''
+        with not_found(filename):
+            obj = self.bucket.Object(self.path(filename)).get()
+        length = obj['ContentLength']
+        if not length or length <= self.spool_size:
+            yield memoryview(obj['Body'].read())
+            return
+        with tempfile.TemporaryFile() as spool:
+            shutil.copyfileobj(obj['Body'], spool)
+            spool.flush()
+            mapped = mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
+            view = memoryview(mapped)
+            try:
+                yield view
+            finally:
+                view.release()
+                mapped.close()
+
+    @instrumented(storage_operation, 'write', size=content_size(1))
     def write(self, filename, content):
         return self.bucket.put_object(
             Key=self.path(filename),
@@ -130,10 +197,12 @@ class S3Storage(BaseStorage):
             ACL = self.object_acl,
         )
 
+    @instrumented(storage_operation, 'delete')
     def delete(self, filename):
         for obj in self.bucket.objects.filter(Prefix=self.path(filename)):
             obj.delete()
 
+    @instrumented(storage_operation, 'save', size=content_size(0))
     def save(self, file_or_wfs, filename, **kwargs):
         if isinstance(file_or_wfs, FileStorage):
             # Get the filename
@@ -152,6 +221,19 @@ class S3Storage(BaseStorage):
                 ACL=self.object_acl,
                 # ContentType=?? TODO: How to get the content type?
             )
+        elif hasattr(file_or_wfs, 'read'):
+            seekable = getattr(file_or_wfs, 'seekable', None)
+            if seekable is not None and seekable():
+                # Any other file, e.g. a spooled upload, is streamed from its current position
+                self.bucket.put_object(
+                    Body=file_or_wfs,
+                    Key=self.path(filename),
+                    ACL=self.object_acl,
+                )
+            else:
+                # Streams which can't be rewound for the checksum (e.g. the body of an other object) are uploaded
+                # in parts by the managed transfer
+                self.bucket.upload_fileobj(file_or_wfs, self.path(filename), ExtraArgs={'ACL': self.object_acl})
         elif isinstance(file_or_wfs, PIL.Image.Image):
             in_mem_file = io.BytesIO()
             file_or_wfs.save(in_mem_file, **kwargs)
@@ -173,6 +255,7 @@ class S3Storage(BaseStorage):
                 )
         return filename
 
+    @instrumented(storage_operation, 'archive_files')
     def archive_files(self, out_filename, filenames, *args, **kwargs):
         if not isinstance(filenames, (tuple, list)):
             filenames = [filenames]
@@ -180,29 +263,96 @@ class S3Storage(BaseStorage):
         with zipfile.ZipFile(mem_zip, 'w', zipfile.ZIP_DEFLATED) as zf:
             try:
                 for filename in filenames:
-                    d = self.read(filename)
-                    zf.writestr(filename, d)
+                    # Stream the object into the archive, instead of reading it into the memory first
+                    body = self.bucket.Object(self.path(filename)).get()['Body']
+                    with zf.open(filename, 'w') as dest:
+                        shutil.copyfileobj(body, dest)
             except Exception as e:
                 print("Error occured: ", e)
         # Write the zipfile content to s3
         self.write(out_filename, mem_zip.getvalue())
         return out_filename
 
+    @instrumented(storage_operation, 'copy')
     def copy(self, filename, target):
-        src = {
-            'Bucket': self.bucket.name,
-            'Key': self.path(filename),
-        }
-        self.bucket.copy(src, target)
+        '''Copy an object on the server side, no content is transferred through this host'''
+        self._copy(self.path(filename), self.path(target))
 
+    @instrumented(storage_operation, 'move')
     def move(self, filename, target):
-        # TODO: Implement move. Does it make sense? This storage handle only 1 bucket
-        raise NotImplementedError('Move operation is not implemented')
+        '''Copy an object on the server side, then delete the source'''
+        self._move(self.path(filename), self.path(target))
+
+    def copy_files(self, pairs):
+        '''Copy (filename, target) pairs concurrently on the server side'''
+        return self._batch(self._copy, pairs)
+
+    def move_files(self, pairs):
+        '''Move (filename, target) pairs concurrently on the server side, e.g. to reorganize a prefix'''
+        return self._batch(self._move, pairs)
+
+    def _batch(self, operation, pairs):
+        with ThreadPoolExecutor(max_workers=self.copy_workers) as executor:
+            futures = [executor.submit(operation, self.path(filename), self.path(target))
+                       for filename, target in pairs]
+            for future in futures:
+                future.result()
+        return len(futures)
+
+    def _move(self, key, target_key):
+        self._copy(key, target_key)
+        self.s3.meta.client.delete_object(Bucket=self.bucket_name, Key=key)
+
+    def _copy(self, key, target_key):
+        client = self.s3.meta.client
+        try:
+            with not_found(key):
+                client.copy_object(Bucket=self.bucket_name, Key=target_key, ACL=self.object_acl,
+                                   CopySource={'Bucket': self.bucket_name, 'Key': key})
+        except ClientError as e:
+            # Objects over 5GB have to be copied in parts
+            if e.response.get('Error', {}).get('Code') != 'InvalidRequest':
+                raise
+            head = client.head_object(Bucket=self.bucket_name, Key=key)
+            if head['ContentLength'] <= COPY_OBJECT_LIMIT:
+                raise
+            self._multipart_copy(key, target_key, head)
+
+    def _multipart_copy(self, key, target_key, head):
+        '''Copy a large object by UploadPartCopy requests, which are sent in parallel'''
+        client = self.s3.meta.client
+        options = {'ACL': self.object_acl, 'Metadata': head.get('Metadata', {})}
+        if head.get('ContentType'):
+            options['ContentType'] = head['ContentType']
+        upload_id = client.create_multipart_upload(Bucket=self.bucket_name, Key=target_key, **options)['UploadId']
+        size = head['ContentLength']
+        part_size = self.copy_part_size
+        ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+
+        def copy_part(number, first, last):
+            result = client.upload_part_copy(Bucket=self.bucket_name, Key=target_key, UploadId=upload_id,
+                                             PartNumber=number, CopySourceRange='bytes=%d-%d' % (first, last),
+                                             CopySource={'Bucket': self.bucket_name, 'Key': key})
+            return {'ETag': result['CopyPartResult']['ETag'], 'PartNumber': number}
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.copy_workers) as executor:
+                parts = list(executor.map(lambda part: copy_part(*part),
+                                          [(i + 1, first, last) for i, (first, last) in enumerate(ranges)]))
+            client.complete_multipart_upload(Bucket=self.bucket_name, Key=target_key, UploadId=upload_id,
+                                             MultipartUpload={'Parts': parts})
+        except Exception:
+            client.abort_multipart_upload(Bucket=self.bucket_name, Key=target_key, UploadId=upload_id)
+            raise
 
     def list_files(self):
-        for f in self.bucket.objects.all():
-            yield f.key
+        '''List the files under the root prefix, by their name relative to it'''
+        prefix = self.path('')
+        objects = self.bucket.objects.filter(Prefix=prefix) if prefix else self.bucket.objects.all()
+        for f in objects:
+            yield f.key[len(prefix):]
 
+    @instrumented(storage_operation, 'serve')
     def serve(self, filename):
         '''Serve files for storages with direct file access'''
         """
@@ -225,10 +375,18 @@ class S3Storage(BaseStorage):
         url = "https://{bucket_name}.s3.{region}.amazonaws.com/{filename}".format(bucket_name=self.bucket_name, region=self.region, filename=self.path(filename))
         return url
 
+    def version(self, filename):
+        '''Size and ETag of an object, from a HEAD request'''
+        obj = self.bucket.Object(self.path(filename))
+        with not_found(filename):
+            obj.load()
+        return (obj.content_length, obj.e_tag)
 
     def get_metadata(self, filename):
         '''Fetch all availabe metadata'''
         obj = self.bucket.Object(self.path(filename))
+        with not_found(filename):
+            obj.load()
         checksum = 'md5:{0}'.format(obj.e_tag[1:-1])
         mime = obj.content_type.split(';', 1)[0] if obj.content_type else None
         return {
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Common Python library imports
+import bisect
+import hashlib
+from contextlib import contextmanager
+from itertools import chain
+
+# Pip package imports
+
+# Internal package imports
+from flask_mm.storages import BaseStorage, create_child_storages
+from flask_mm.signals import storage_operation, instrumented, result_size, content_size
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf8')).digest()[:8], 'big')
+
+class HashRing(object):
+    '''
+    Consistent hash ring, each node is placed on the ring at ``vnodes`` points.
+    Adding a node moves only the keys which are taken over by the new node.
+    '''
+
+    def __init__(self, nodes, vnodes=64):
+        points = sorted((ring_hash('%s#%d' % (node, i)), node) for node in nodes for i in range(vnodes))
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def get(self, key):
+        index = bisect.bisect(self.hashes, ring_hash(key))
+        return self.nodes[index % len(self.nodes)]
+
+class ShardedStorage(BaseStorage):
+    '''
+    Spread files over several storages (e.g. local volumes, buckets or prefixes) by consistent hashing of the
+    filename. Shards are configured as a list of configuration overrides (e.g.
+    ``{'STORAGE': 'local', 'ROOT': '/mnt/disk2'}``) or storage instances, a shard is identified by its position:
+    new shards have to be appended, then the files can be moved to their new shard by ``rebalance``.
+    '''
+
+    def __init__(self, shards, *args, **kwargs):
+        super(ShardedStorage, self).__init__(*args, **kwargs)
+        self.shards = create_child_storages(shards, kwargs, exclude=('shards', ), name='shard')
+        if not self.shards:
+            raise ValueError('At least one shard is required')
+        self.ring = HashRing(range(len(self.shards)), kwargs.get('shard_vnodes', 64))
+        # Until rebalancing is done, files which are not found on their shard are searched on the others
+        self.shard_fallback = kwargs.get('shard_fallback', False)
+
+    def shard(self, filename):
+        '''Return the storage which owns a filename'''
+        return self.shards[self.ring.get(filename)]
+
+    def _locate(self, filename):
+        shard = self.shard(filename)
+        if not self.shard_fallback or shard.exists(filename):
+            return shard
+        for other in self.shards:
+            if other is not shard and other.exists(filename):
+                return other
+        return shard
+
+    @property
+    def root(self):
+        return self.shards[0].root
+
+    @instrumented(storage_operation, 'exists')
+    def exists(self, filename):
+        return self._locate(filename).exists(filename)
+
+    @instrumented(storage_operation, 'read', size=result_size)
+    def read(self, filename):
+        return self._locate(filename).read(filename)
+
+    def read_head(self, filename, size):
+        return self._locate(filename).read_head(filename, size)
+
+    @contextmanager
+    def read_buffer(self, filename):
+        with self._locate(filename).read_buffer(filename) as buffer:
+            yield buffer
+
+    def open(self, filename, mode='r', encoding='utf8'):
+        if 'r' in mode:
+            return self._locate(filename).open(filename, mode, encoding=encoding)
+        return self.shard(filename).open(filename, mode, encoding=encoding)
+
+    @instrumented(storage_operation, 'write', size=content_size(1))
+    def write(self, filename, content):
+        return self.shard(filename).write(filename, content)
+
+    @instrumented(storage_operation, 'save', size=content_size(0))
+    def save(self, file_or_wfs, filename, **kwargs):
+        filename = filename or getattr(file_or_wfs, 'filename', None)
+        return self.shard(filename).save(file_or_wfs, filename, **kwargs)
+
+    @instrumented(storage_operation, 'delete')
+    def delete(self, filename):
+        return self._locate(filename).delete(filename)
+
+    @instrumented(storage_operation, 'copy')
+    def copy(self, filename, target):
+        source, destination = self._locate(filename), self.shard(target)
+        if source is destination:
+            return source.copy(filename, target)
+        with source.open(filename, 'rb') as f:
+            destination.save(f, target)
+
+    @instrumented(storage_operation, 'move')
+    def move(self, filename, target):
+        source, destination = self._locate(filename), self.shard(target)
+        if source is destination:
+            return source.move(filename, target)
+        with source.open(filename, 'rb') as f:
+            destination.save(f, target)
+        source.delete(filename)
+
+    @instrumented(storage_operation, 'archive_files')
+    def archive_files(self, out_filename, filenames, *args, **kwargs):
+        if not isinstance(filenames, (tuple, list)):
+            filenames = [filenames]
+        return self.spool_archive(out_filename, filenames)
+
+    def list_files(self):
+        return chain.from_iterable(shard.list_files() for shard in self.shards)
+
+    def rebalance(self):
+        '''Move every file to the shard which owns it, e.g. after a shard has been added, return their number'''
+        moved = 0
+        for shard in self.shards:
+            for filename in list(shard.list_files()):
+                owner = self.shard(filename)
+                if owner is shard:
+                    continue
+                with shard.open(filename, 'rb') as f:
+                    owner.save(f, filename)
+                shard.delete(filename)
+                moved += 1
+        return moved
+
+    def get_metadata(self, filename):
+        return self._locate(filename).get_metadata(filename)
+
+    def version(self, filename):
+        return self._locate(filename).version(filename)
+
+    def path(self, filename):
+        return self._locate(filename).path(filename)
+
+    @instrumented(storage_operation, 'serve')
+    def serve(self, filename):
+        return self._locate(filename).serve(filename)
@@ -4,8 +4,9 @@
 # Common Python library imports
 from __future__ import unicode_literals
 
-import re
+import os
 import os.path as op
+import time
 
 # Pip package imports
 import uuid
@@ -14,15 +15,24 @@ import uuid
 
 class UuidNameGen(object):
 
-    uuid_type = uuid.uuid1
+    # uuid4 is generated from os.urandom, without the global lock and the MAC address of uuid1
+    uuid_type = uuid.uuid4
     separator = "_sep_"
     thumb_name = "_thumb"
     wm_name ="_wm"
+    source_name = "_src"
 
     @classmethod
     def generate_name(cls, filename):
         return str(cls.uuid_type()) + cls.separator + filename
 
+    @classmethod
+    def generate_names(cls, filenames):
+        """
+            Generate a unique name for each of the given filenames, e.g. for bulk imports
+        """
+        return [cls.generate_name(filename) for filename in filenames]
+
     @classmethod
     def get_original_name(cls, name):
         """
@@ -40,9 +50,9 @@ class UuidNameGen(object):
             :return:
                 Returns the user's original filename removes <UUID>_sep_
         """
-        re_match = re.findall(".*%s(.*)" % cls.separator, name)
-        if re_match:
-            return re_match[0]
+        _, separator, original = name.rpartition(cls.separator)
+        if separator:
+            return original
         else:
             return "Not valid"
 
@@ -58,4 +68,64 @@ class UuidNameGen(object):
     @classmethod
     def watermark_filename(cls, filename):
         name, ext = op.splitext(filename)
-        return name + cls.wm_name + ext
\ No newline at end of file
+        return name + cls.wm_name + ext
+
+    @classmethod
+    def source_filename(cls, filename, ext):
+        name, _ = op.splitext(filename)
+        return name + cls.source_name + '.' + ext
+
+    @classmethod
+    def variant_filename(cls, filename, ext):
+        return filename + '.' + ext
+
+class UlidNameGen(UuidNameGen):
+    """
+        ULID-style name generator: a 48 bit millisecond timestamp followed by 80 random bits, hex encoded to
+        32 characters. The names sort by creation time, which keeps recent uploads close in indexes and listings.
+        Generation takes no lock and does not depend on the MAC address.
+    """
+
+    random_bytes = 10
+
+    @classmethod
+    def _encode(cls, timestamp, randomness):
+        return (timestamp + randomness).hex()
+
+    @classmethod
+    def generate_id(cls):
+        timestamp = int(time.time() * 1000).to_bytes(6, 'big')
+        return cls._encode(timestamp, os.urandom(cls.random_bytes))
+
+    @classmethod
+    def generate_name(cls, filename):
+        return cls.generate_id() + cls.separator + filename
+
+    @classmethod
+    def generate_names(cls, filenames):
+        """
+            Generate a unique name for each of the given filenames with a single timestamp and random read
+        """
+        filenames = list(filenames)
+        timestamp = int(time.time() * 1000).to_bytes(6, 'big')
+        size = cls.random_bytes
+        randomness = os.urandom(size * len(filenames))
+        return [cls._encode(timestamp, randomness[i * size:(i + 1) * size]) + cls.separator + filename
+                for i, filename in enumerate(filenames)]
+
+#: Name generators which can be selected by name with the NAME_GEN configuration
+NAME_GENERATORS = {
+    'uuid': UuidNameGen,
+    'ulid': UlidNameGen,
+}
+
+def get_name_gen(name_gen):
+    '''
+    Resolve a name generator, given either by its registered name or as a class
+    '''
+    if not isinstance(name_gen, str):
+        return name_gen
+    try:
+        return NAME_GENERATORS[name_gen.lower()]
+    except KeyError:
+        raise ValueError("Unknown name generator: '%s', must be one of %s" % (name_gen, list(NAME_GENERATORS.keys())))
@@ -3,20 +3,46 @@
 
 # Common Python library imports
 # Pip package imports
-from flask import abort, Blueprint
+import click
+from flask import abort, Blueprint, current_app
 
 # Internal package imports
-from . import by_name
+from . import MediaManager
 
 mm_bp = Blueprint('mm', __name__)
 
 @mm_bp.route('/<string:mm>/<path:filename>')
 def get_file(mm, filename):
     try:
-        print("MM: ", mm)
-        storage = by_name(mm)
-        print(storage)
+        manager = current_app.extensions[MediaManager.key].get_manager(mm)
     except KeyError:
         abort(404)
     else:
-        return storage.serve(filename)
\ No newline at end of file
+        return manager.serve(filename)
+
+@mm_bp.cli.command('rehome')
+@click.argument('name', default='')
+@click.option('--previous-depth', default=0, help='Shard depth the files are currently stored with.')
+def rehome(name, previous_depth):
+    '''Move the files of a storage into the shard directories of its current layout.'''
+    try:
+        manager = current_app.extensions[MediaManager.key].get_manager(name)
+    except KeyError as e:
+        raise click.ClickException(str(e))
+    if not hasattr(manager.storage, 'rehome_files'):
+        raise click.ClickException('%s does not support sharding' % manager.storage.__class__.__name__)
+    moved = manager.storage.rehome_files(previous_depth)
+    click.echo('Moved %d file(s)' % moved)
+
+@mm_bp.cli.command('rebalance')
+@click.argument('name', default='')
+def rebalance(name):
+    '''Move the files of a sharded storage to the shards which own them, e.g. after a shard has been added.'''
+    try:
+        manager = current_app.extensions[MediaManager.key].get_manager(name)
+    except KeyError as e:
+        raise click.ClickException(str(e))
+    if not hasattr(manager.storage, 'rebalance'):
+        raise click.ClickException('%s is not a sharded storage' % manager.storage.__class__.__name__)
+    moved = manager.storage.rebalance()
+    click.echo('Moved %d file(s)' % moved)
@@ -56,6 +56,9 @@ setup(
         'mm.storages': [
             'local = flask_mm.storages.local:LocalStorage',
             's3 = flask_mm.storages.s3:S3Storage',
+            'cached = flask_mm.storages.cached:CachedStorage',
+            'replicated = flask_mm.storages.replicated:ReplicatedStorage',
+            'sharded = flask_mm.storages.sharded:ShardedStorage',
             #'gridfs = flask_fs.backends.gridfs:GridFsBackend [gridfs]',
             #'swift = flask_fs.backends.swift:SwiftBackend [swift]',
             #'mock = flask_fs.backends.mock:MockBackend',
@@ -17,6 +17,8 @@ import pytest
 # Internal package imports
 import flask_mm as mm
 
+from .s3server import s3_endpoint
+
 PNG_FILE = os.path.join(os.path.dirname(__file__), 'flask.png')
 JPG_FILE = os.path.join(os.path.dirname(__file__), 'flask.jpg')
 
@@ -116,4 +118,4 @@ def pngfile():
 
 @pytest.fixture
 def jpgfile():
-    return JPG_FILE
\ No newline at end of file
+    return JPG_FILE
@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Common Python library imports
+from __future__ import unicode_literals
+
+# Pip package imports
+import pytest
+
+# Internal package imports
+
+@pytest.fixture(scope='session')
+def s3_endpoint():
+    '''
+    Start a local S3 stand-in (moto server), shared by the tests and the benchmarks
+    '''
+    server_module = pytest.importorskip('moto.server')
+    server = server_module.ThreadedMotoServer(ip_address='127.0.0.1', port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    yield 'http://%s:%s' % (host, port)
+    server.stop()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Common Python library imports
+from __future__ import unicode_literals
+
+import os
+import zipfile
+
+# Pip package imports
+import pytest
+
+# Internal package imports
+import flask_mm as mm
+from flask_mm.storages.local import LocalStorage
+from flask_mm.storages.cached import CachedStorage, CacheTier
+
+class CountingStorage(LocalStorage):
+    '''Local origin which counts the files opened for reading'''
+
+    def __init__(self, *args, **kwargs):
+        super(CountingStorage, self).__init__(*args, **kwargs)
+        self.reads = 0
+
+    def open(self, filename, mode='r', encoding='utf8'):
+        if 'r' in mode:
+            self.reads += 1
+        return super(CountingStorage, self).open(filename, mode, encoding)
+
+class FailingStorage(LocalStorage):
+    '''Local origin whose uploads fail until it is fixed'''
+
+    failing = True
+
+    def save(self, file_or_wfs, filename, **kwargs):
+        if self.failing:
+            raise IOError('Origin failure')
+        return super(FailingStorage, self).save(file_or_wfs, filename, **kwargs)
+
+@pytest.fixture
+def origin(tmp_path):
+    return CountingStorage(str(tmp_path / 'origin'))
+
+def cached(origin, tmp_path, **kwargs):
+    kwargs.setdefault('cache_root', str(tmp_path / 'cache'))
+    return CachedStorage(origin, **kwargs)
+
+class TestCacheTier:
+
+    def test_lru(self):
+        tier = CacheTier('test', 2)
+        tier.add('a', 1)
+        tier.add('b', 1)
+        tier.touch('a')
+        assert tier.add('c', 1) == ['b']
+
+    def test_lfu(self):
+        tier = CacheTier('test', 2, eviction='lfu')
+        tier.add('a', 1)
+        tier.add('b', 1)
+        tier.touch('a')
+        tier.touch('a')
+        tier.touch('b')
+        assert tier.add('c', 1) == ['b']
+
+    def test_pinned(self):
+        tier = CacheTier('test', 2)
+        tier.add('a', 1, pin=True)
+        tier.add('b', 1)
+        assert tier.add('c', 1) == ['b']
+
+    def test_lfu_many(self):
+        tier = CacheTier('test', 100, eviction='lfu')
+        for i in range(100):
+            tier.add(i, 1)
+            for _ in range(i % 7):
+                tier.touch(i)
+        evicted = tier.add('new', 10)
+        assert sorted(evicted) == [0, 7, 14, 21, 28, 35, 42, 49, 56, 63]
+
+    def test_invalid_eviction(self):
+        with pytest.raises(ValueError):
+            CacheTier('test', 2, eviction='fifo')
+
+class TestCachedStorage:
+
+    def test_read_through(self, origin, tmp_path):
+        origin.write('file.test', b'test')
+        st = cached(origin, tmp_path)
+        assert st.read('file.test') == b'test'
+        assert st.read('file.test') == b'test'
+        assert origin.reads == 1
+        assert os.path.exists(str(tmp_path / 'cache' / 'file.test'))
+
+    def test_memory_only(self, origin, tmp_path):
+        origin.write('file.test', b'test')
+        st = cached(origin, tmp_path, cache_root=None)
+        assert st.read('file.test') == b'test'
+        with st.read_buffer('file.test') as buffer:
+            assert bytes(buffer) == b'test'
+        assert origin.reads == 1
+
+    def test_read_head(self, origin, tmp_path):
+        origin.write('file.test', b'test')
+        st = cached(origin, tmp_path)
+        assert st.read_head('file.test', 2) == b'te'
+        # Partial reads are not cached
+        assert 'file.test' not in st.disk
+        st.read('file.test')
+        assert st.read_head('file.test', 2) == b'te'
+        assert origin.reads == 2
+
+    def test_evicted_after_touch(self, origin, tmp_path, monkeypatch):
+        origin.write('file.test', b'test')
+        st = cached(origin, tmp_path, cache_memory_size=0)
+        st.read('file.test')
+        touch = st.disk.touch
+
+        def touch_and_evict(filename):
+            # An other thread evicts the file between the cache hit and the read
+            hit = touch(filename)
+            st.disk.remove(filename)
+            return hit
+        monkeypatch.setattr(st.disk, 'touch', touch_and_evict)
+
+        assert st.read('file.test') == b'test'
+        assert st.read_head('file.test', 2) == b'te'
+        with st.read_buffer('file.test') as buffer:
+            assert bytes(buffer) == b'test'
+        with st.open('file.test', 'rb') as f:
+            assert f.read() == b'test'
+
+    def test_large_objects_skip_memory(self, origin, tmp_path):
+        origin.write('file.test', b'test')
+        st = cached(origin, tmp_path, cache_object_size=2)
+        st.read('file.test')
+        assert 'file.test' not in st.memory
+        assert 'file.test' in st.disk
+
+    def test_disk_eviction(self, origin, tmp_path):
+        st = cached(origin, tmp_path, cache_disk_size=6, cache_memory_size=0)
+        for name in ('a.test', 'b.test', 'c.test'):
+            st.write(name, b'test')
+        assert sorted(os.listdir(str(tmp_path / 'cache'))) == ['c.test']
+        assert st.read('a.test') == b'test'
+
+    def test_write_invalidates(self, origin, tmp_path):
+        st = cached(origin, tmp_path)
+        st.write('file.test', b'test')
+        assert st.read('file.test') == b'test'
+        st.write('file.test', b'test2')
+        assert st.read('file.test') == b'test2'
+        assert origin.read('file.test') == b'test2'
+        st.delete('file.test')
+        assert not st.exists('file.test')
+        assert not os.path.exists(str(tmp_path / 'cache' / 'file.test'))
+
+    def test_open_write(self, origin, tmp_path):
+        st = cached(origin, tmp_path)
+        st.write('file.test', b'test')
+        with st.open('file.test', 'wb') as f:
+            f.write(b'test2')
+        with st.open('file.test', 'rb') as f:
+            assert f.read() == b'test2'
+
+    def test_write_back(self, origin, tmp_path):
+        st = cached(origin, tmp_path, cache_write='back')
+        st.write('file.test', b'test')
+        assert st.read('file.test') == b'test'
+        st.flush()
+        assert origin.read('file.test') == b'test'
+        assert list(st.list_files()) == ['file.test']
+
+    def test_write_back_failure(self, tmp_path):
+        origin = FailingStorage(str(tmp_path / 'origin'))
+        st = cached(origin, tmp_path, cache_write='back', cache_disk_size=6, cache_memory_size=0)
+        st.write('a.txt', b'test')
+        with pytest.raises(IOError):
+            st.flush()
+        # Not written back yet, so it is never evicted
+        st.write('b.txt', b'test')
+        assert 'a.txt' in st.disk
+        origin.failing = False
+        assert st.flush() == 2
+        assert origin.read('a.txt') == b'test'
+        assert st.flush() == 0
+
+    def test_write_back_requires_disk(self, origin, tmp_path):
+        with pytest.raises(ValueError):
+            cached(origin, tmp_path, cache_root=None, cache_write='back')
+
+    def test_metadata(self, origin, tmp_path):
+        st = cached(origin, tmp_path)
+        st.write('file.test', b'test')
+        assert st.metadata('file.test')['size'] == 4
+        st.write('file.test', b'test2')
+        assert st.metadata('file.test')['size'] == 5
+
+    def test_archive(self, origin, tmp_path):
+        st = cached(origin, tmp_path)
+        st.write('a.test', b'a')
+        st.write('b.test', b'b')
+        st.archive_files('files.zip', ['a.test', 'b.test'])
+        with zipfile.ZipFile(origin.path('files.zip')) as zipper:
+            assert zipper.read('b.test') == b'b'
+
+    def test_rebuild_index(self, origin, tmp_path):
+        st = cached(origin, tmp_path)
+        st.write('file.test', b'test')
+        assert 'file.test' in cached(origin, tmp_path).disk
+
+@pytest.fixture
+def cached_app(app, init_mm, tmp_path):
+    app.Configure(
+        MEDIA_MANAGER = {
+            'STORAGE': 'cached',
+            'ORIGIN': 'local',
+            'MANAGER': 'file',
+            'ROOT': str(tmp_path / 'origin'),
+            'CACHE_ROOT': str(tmp_path / 'cache'),
+        }
+    )
+    init_mm.init_app(app)
+    return app
+
+class TestCachedStorageConfig:
+
+    def test_configure(self, cached_app):
+        st = mm.by_name()
+        assert isinstance(st.storage, CachedStorage)
+        assert isinstance(st.storage.origin, LocalStorage)
+
+    def test_serve(self, cached_app, tmp_path):
+        st = mm.by_name()
+        st.write('file.test', b'test')
+        response = cached_app.test_client().get(st.url('file.test'))
+        assert response.data == b'test'
+        response.close()
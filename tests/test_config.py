@@ -12,6 +12,7 @@ from flask import url_for
 import pytest
 # Internal package imports
 import flask_mm as mm
+from flask_mm.utils import UlidNameGen
 
 def test_default_configuration(app, init_mm):
     app.Configure()
@@ -207,3 +208,46 @@ def test_multiple_config_get_by_without_name(app, init_mm):
         photo = init_mm.by_name()
     with pytest.raises(KeyError):
         video = init_mm.by_name()
+
+def test_single_configuration_first_element(app, init_mm):
+    app.Configure(
+        MM_PHOTO_ROOT=os.path.join(app.instance_path, 'photo'),
+        MM_PHOTO_MANAGER='image',
+        MM_PHOTO_MAX_SIZE=(100, 100, False),
+    )
+    init_mm.init_app(app)
+    photo = init_mm.by_name('photo')
+    assert photo.storage.root == os.path.join(app.instance_path, 'photo')
+    assert photo.max_size == (100, 100, False)
+
+def test_config_pattern_prefers_global_element():
+    pattern = mm._config_pattern(tuple(mm.MediaManager.allowed_configs))
+    assert pattern.match('MM_AWS_ACCESS_KEY').group('name', 'element') == (None, 'AWS_ACCESS_KEY')
+    assert pattern.match('MM_S3_AWS_SECRET_ACCESS_KEY').group('name', 'element') == ('S3', 'AWS_SECRET_ACCESS_KEY')
+    assert pattern.match('MM_PHOTO_MEDIA_URL').group('name', 'element') == ('PHOTO_MEDIA', 'URL')
+    assert pattern.match('MM_SOTRAGE') is None
+
+def test_manager_config_frozen():
+    config = mm.ManagerConfig.from_dict('photo', {'MANAGER': 'file', 'STORAGE': 'local', 'ROOT': 'photo'})
+    assert config.options['root'] == 'photo'
+    with pytest.raises(TypeError):
+        config.options['root'] = 'video'
+    with pytest.raises(AttributeError):
+        config.name = 'video'
+
+def test_unknown_storage(app, init_mm):
+    app.Configure(
+        MEDIA_MANAGER = {
+            'STORAGE': 'notexists',
+        }
+    )
+    with pytest.raises(ValueError):
+        init_mm.init_app(app)
+
+def test_name_gen_configuration(app, init_mm):
+    app.Configure(
+        MM_NAME_GEN='ulid',
+    )
+    init_mm.init_app(app)
+    st = init_mm.by_name()
+    assert st.namegen is UlidNameGen
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Common Python library imports
+from __future__ import unicode_literals
+
+import gzip
+import io
+
+# Pip package imports
+import pytest
+
+# Internal package imports
+import flask_mm as mm
+from flask_mm import files
+
+
+class TestExtensions:
+
+    def test_compile(self):
+        assert files.compile_extensions(['JPG', 'png']) == frozenset(['jpg', 'png'])
+        assert files.compile_extensions(files.ALL) is files.ALL
+        assert files.compile_extensions(None) is None
+
+    def test_all_except(self):
+        policy = files.AllExcept(files.SCRIPTS + files.EXECUTABLES)
+        assert isinstance(policy.items, frozenset)
+        assert 'png' in policy
+        assert 'exe' not in policy
+
+    @pytest.mark.parametrize("extensions, filename, allowed", [
+        (files.DEFAULTS, 'image.PNG', True),
+        (files.DEFAULTS, 'script.exe', False),
+        (files.ALL, 'script.exe', True),
+        (files.NONE, 'image.png', False),
+        (files.AllExcept(['exe']), 'script.exe', False),
+        ([], 'script.exe', True),
+    ])
+    def test_is_file_allowed(self, app, init_mm, extensions, filename, allowed):
+        app.Configure(MM_EXTENSIONS=extensions, MM_ROOT=app.instance_path)
+        init_mm.init_app(app)
+        assert mm.by_name().is_file_allowed(filename) is allowed
+
+    def test_reassign(self, app, init_mm):
+        init_mm.init_app(app)
+        st = mm.by_name()
+        st.allowed_extensions = ['exe']
+        assert st.allowed_extensions == ['exe']
+        assert st.is_file_allowed('script.exe')
+        assert not st.is_file_allowed('image.png')
+
+
+class TestMime:
+
+    @pytest.mark.parametrize("filename, mimetype", [
+        ('image.png', 'image/png'),
+        ('IMAGE.JPG', 'image/jpeg'),
+        ('image.webp', 'image/webp'),
+        ('image.avif', 'image/avif'),
+        ('archive.tar.gz', 'application/x-tar'),
+        ('http://example.com/path/file.json', 'application/json'),
+    ])
+    def test_mime(self, filename, mimetype):
+        assert files.mime(filename) == mimetype
+
+    def test_default(self):
+        assert files.mime('file.unknown') is None
+        assert files.mime('file.unknown', 'application/octet-stream') == 'application/octet-stream'
+        assert files.mime('noextension', 'application/octet-stream') == 'application/octet-stream'
+
+
+class NonSeekable(object):
+
+    def __init__(self, content):
+        self.stream = io.BytesIO(content)
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+
+class TestSniff:
+
+    @pytest.mark.parametrize("header, kind", [
+        (b'\xff\xd8\xff\xe0\x00\x10JFIF', 'jpeg'),
+        (b'\x89PNG\r\n\x1a\n\x00\x00', 'png'),
+        (b'GIF89a\x01\x00', 'gif'),
+        (b'RIFF\x10\x00\x00\x00WEBPVP8 ', 'webp'),
+        (b'\x00\x00\x00\x20ftypavif', 'avif'),
+        (b'\x00\x00\x00\x20ftypisom', 'mp4'),
+        (b'%PDF-1.7\n', 'pdf'),
+        (b'PK\x03\x04\x14\x00', 'zip'),
+        (b'\x00' * 257 + b'ustar\x00', 'tar'),
+        (b'\x00\x00\x00\x08wide\x00\x00', 'mov'),
+        (b'\x00\x00\x10\x00mdat\x00\x00', 'mov'),
+        (b'The free market', None),
+        (b'Our wide range', None),
+        (b'MZ-1000 manual', None),
+        (b'MZ\x90\x00\x03\x00', 'exe'),
+        (b'ID3 tags', None),
+        (b'BZh what', None),
+        (b'BZh91AY&SY\x8a\x0c\x04\x00', 'bzip2'),
+        (b'ID3\x04\x00', 'mp3'),
+        (b'\xff\xfb\x90\x64', 'mp3'),
+        (b'\xff\xe3\x18\xc4', 'mp3'),
+        (b'\xff\xfd\x90\x64', 'mp3'),
+        (b'\xff\xfb\xf0\x64', None),
+        (b'\xff\xf1\x50\x80', 'aac'),
+        (b'BM, a line of text', None),
+        (b'plain text', None),
+        (b'', None),
+    ])
+    def test_sniff(self, header, kind):
+        assert files.sniff(header) == kind
+
+    @pytest.mark.parametrize("kind, filename, matches", [
+        ('png', 'image.PNG', True),
+        ('zip', 'document.docx', True),
+        ('mov', 'movie.mov', True),
+        ('gzip', 'sheet.gnumeric', True),
+        ('gzip', 'document.abw', True),
+        (None, 'document.abw', True),
+        ('exe', 'image.png', False),
+        ('png', 'notes.txt', False),
+        (None, 'notes.txt', True),
+        (None, 'image.png', False),
+    ])
+    def test_content_matches(self, kind, filename, matches):
+        assert files.content_matches(kind, filename) is matches
+
+    def test_atom_size(self):
+        header = b'\x00\x00\x10\x00free' + b'\x00' * 100
+        assert files.sniff(header, length=4096) == 'mov'
+        # The atom would be longer than the content
+        assert files.sniff(header, length=1024) is None
+
+    def test_content_length(self):
+        stream = io.BytesIO(b'x' * 100)
+        stream.seek(10)
+        assert files.content_length(stream) == 90
+        assert stream.tell() == 10
+        assert files.content_length(NonSeekable(b'x')) is None
+
+    def test_read_header_rewinds(self):
+        stream = io.BytesIO(b'%PDF-' + b'x' * 10000)
+        header, rewound = files.read_header(stream)
+        assert len(header) == files.SNIFF_SIZE
+        assert rewound is stream
+        assert stream.tell() == 0
+
+    def test_read_header_replays(self):
+        content = b'%PDF-' + b'x' * 10000
+        header, rewound = files.read_header(NonSeekable(content))
+        assert files.sniff(header) == 'pdf'
+        assert rewound.read() == content
+
+
+class TestCheckContent:
+
+    def test_mismatch(self, app, init_mm, utils, tmp_path):
+        app.Configure(MM_ROOT=str(tmp_path), MM_EXTENSIONS=['pdf'], MM_SNIFF_CONTENT=True)
+        init_mm.init_app(app)
+        st = mm.by_name()
+        with pytest.raises(ValueError):
+            st.save(utils.filestorage('document.pdf', b'MZ\x90\x00'))
+        assert not st.exists('document.pdf')
+
+    def test_match(self, app, init_mm, utils, tmp_path):
+        app.Configure(MM_ROOT=str(tmp_path), MM_EXTENSIONS=['pdf'], MM_SNIFF_CONTENT=True)
+        init_mm.init_app(app)
+        st = mm.by_name()
+        content = b'%PDF-1.7\n' + b'x' * 10000
+        st.save(NonSeekable(content), 'document.pdf')
+        assert st.read('document.pdf') == content
+
+    @pytest.mark.parametrize("filename, content", [
+        ('notes.txt', b'The free market' + b' and more text' * 1000),
+        ('manual.txt', b'MZ-1000 manual\n'),
+        ('sheet.gnumeric', gzip.compress(b'<?xml version="1.0"?>')),
+        ('document.abw', b'<?xml version="1.0"?>'),
+    ])
+    def test_text_and_documents(self, app, init_mm, utils, tmp_path, filename, content):
+        app.Configure(MM_ROOT=str(tmp_path), MM_SNIFF_CONTENT=True)
+        init_mm.init_app(app)
+        st = mm.by_name()
+        st.save(NonSeekable(content), filename)
+        assert st.read(filename) == content
@@ -6,6 +6,7 @@ from __future__ import unicode_literals
 
 import os
 import io
+import tracemalloc
 from PIL import Image
 
 # Pip package imports
@@ -14,7 +15,9 @@ from flask import url_for
 import pytest
 # Internal package imports
 import flask_mm as mm
+from flask_mm.managers.image import probe_image
 from flask_mm.postprocess import Watermarker
+from flask_mm.profiling import profile, PipelineProfile
 
 THUMB_WIDTH = 253
 THUMB_HEIGHT = 220
@@ -132,3 +135,489 @@ class TestImageManager:
             assert st.exists(filename)
             st.delete(filename)
 
+
+@pytest.mark.parametrize("app_manager", [('local', 'image', { 'OUTPUT_FORMAT': 'WEBP',
+                                                              'ENCODER_OPTIONS': { 'WEBP': { 'quality': 75 } } })], indirect=True)
+class TestLocalImageManagerOutputFormat:
+
+    @pytest.mark.parametrize("image", [("tests/flask.jpg"), ("tests/flask.png")])
+    def test_save_output_format(self, app_manager, image, utils):
+        st = mm.by_name()
+
+        with open(image, 'rb') as fp:
+            f = utils.filestorage('flask.jpg', fp)
+            filename = st.save(f)
+        assert filename.endswith('.webp')
+        assert Image.open(st.path(filename)).format == 'WEBP'
+        assert Image.open(st.path(st.generate_thumbnail_name(filename))).format == 'WEBP'
+        st.delete(filename)
+
+    def test_save_output_format_original_name(self, app_manager, utils):
+        st = mm.by_name()
+
+        with open("tests/flask.png", 'rb') as fp:
+            f = utils.filestorage('flask.png', fp)
+            filename = st.save(f, generate_name=False)
+        # The caller's name is kept, only the encoding follows the output format
+        assert filename == 'flask.png'
+        assert Image.open(st.path(filename)).format == 'WEBP'
+        st.delete(filename)
+
+    def test_save_thumbnail_format(self, app_manager, utils):
+        st = mm.by_name()
+
+        with open("tests/flask.png", 'rb') as fp:
+            f = utils.filestorage('flask.png', fp)
+            filename = st.save(f, thumbnail_format='PNG')
+        assert Image.open(st.path(st.generate_thumbnail_name(filename))).format == 'PNG'
+        st.delete(filename)
+
+    def test_save_unavailable_format(self, app_manager, utils):
+        st = mm.by_name()
+
+        with open("tests/flask.png", 'rb') as fp:
+            f = utils.filestorage('flask.png', fp)
+            filename = st.save(f, output_format='NOTAFORMAT')
+        assert filename.endswith('.png')
+        st.delete(filename)
+
+@pytest.mark.parametrize("app_manager", [('local', 'image', { 'ALTERNATE_FORMATS': ['WEBP', 'AVIF'] })], indirect=True)
+class TestLocalImageManagerAlternateFormats:
+
+    @pytest.mark.parametrize("image", [("tests/flask.jpg"), ("tests/flask.png")])
+    def test_save_alternate_formats(self, app_manager, image, utils):
+        st = mm.by_name()
+
+        with open(image, 'rb') as fp:
+            f = utils.filestorage('flask.jpg', fp)
+            filename = st.save(f)
+        thumbnail = st.generate_thumbnail_name(filename)
+        assert 'WEBP' in st.get_variants(filename)
+        assert 'WEBP' in st.get_variants(thumbnail)
+        assert Image.open(st.path(st.get_variant(filename, 'WEBP'))).format == 'WEBP'
+
+        st.delete(filename)
+        assert not st.exists(st.get_variant(filename, 'WEBP'))
+        assert not st.exists(st.get_variant(thumbnail, 'WEBP'))
+
+@pytest.mark.parametrize("app_manager", [('local', 'image', { 'MAX_SIZE': (400, 400, False), 'PROFILE': True })], indirect=True)
+class TestLocalImageManagerProfile:
+
+    def test_profile_context(self, app_manager, utils):
+        st = mm.by_name()
+
+        with open("tests/flask.png", 'rb') as fp:
+            f = utils.filestorage('flask.png', fp)
+            with profile() as p:
+                filename = st.save(f, postprocess=POSTPROCESS_PARAMS)
+
+        assert [s['stage'] for s in p.stages] == ['decode', 'resize', 'thumbnail', 'encode', 'store',
+                                                  'postprocess', 'encode', 'store']
+        assert p.stage_duration('decode') > 0
+        assert p.counters['resample'] == 4
+        assert p.counters['pixels'] >= 2 * 3000 * 1174
+        assert p.counters['allocations'] > 0
+        assert p.peak_memory > 0
+        assert p.as_dict()['stages'][0]['width'] == 3000
+        st.delete(filename)
+
+    def test_overlapping_profiles(self, app_manager):
+        # Profiles of concurrent requests share tracemalloc, the first one to stop keeps it running
+        first, second = PipelineProfile(), PipelineProfile()
+        first.start()
+        second.start()
+        first.stop()
+        assert tracemalloc.is_tracing()
+        data = bytearray(1024 * 1024)
+        second.stop()
+        assert not tracemalloc.is_tracing()
+        assert second.peak_memory >= len(data)
+
+    def test_profile_config(self, app_manager, utils, caplog):
+        st = mm.by_name()
+
+        with open("tests/flask.png", 'rb') as fp:
+            f = utils.filestorage('flask.png', fp)
+            with caplog.at_level('INFO', logger='flask_mm.profiling'):
+                filename = st.save(f)
+
+        records = [r for r in caplog.records if r.name == 'flask_mm.profiling']
+        assert len(records) == 1
+        assert records[0].profile['counters']['resample'] == 2
+        assert records[0].profile['peak_memory'] > 0
+        st.delete(filename)
+
+class NonSeekableStream(io.RawIOBase):
+    '''Stream which can be read only once, like a socket'''
+
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self.data.readinto(b)
+
+@pytest.mark.parametrize("app_manager", [('local', 'image', { 'SPOOL_SIZE': 1024 })], indirect=True)
+class TestLocalImageManagerInput:
+
+    def test_save_from_bytes(self, app_manager):
+        st = mm.by_name()
+
+        with open("tests/flask.png", 'rb') as fp:
+            filename = st.save(fp.read(), 'flask.png')
+        assert st.exists(filename)
+        st.delete(filename)
+
+    def test_save_from_stream(self, app_manager, utils):
+        st = mm.by_name()
+
+        with open("tests/flask.png", 'rb') as fp:
+            f = utils.filestorage('flask.png', NonSeekableStream(fp.read()))
+        filename = st.save(f)
+        assert st.exists(filename)
+        st.delete(filename)
+
+    def test_open_input_spooled(self, app_manager):
+        st = mm.by_name()
+
+        with st.open_input(NonSeekableStream(b'x' * 2048)) as stream:
+            assert stream._rolled
+            assert stream.read() == b'x' * 2048
+        with st.open_input(NonSeekableStream(b'x' * 16)) as stream:
+            assert not stream._rolled
+        with st.open_input(b'test') as stream:
+            assert stream.read() == b'test'
+        with st.open_input(Image.new('RGB', (1, 1))) as stream:
+            assert stream is None
+
+    def test_save_invalid(self, app_manager):
+        st = mm.by_name()
+
+        with pytest.raises(ValueError):
+            st.save(b'test', 'test.png')
+
+    def test_save_not_an_image(self, app_manager, monkeypatch):
+        st = mm.by_name()
+        opened = []
+        monkeypatch.setattr(Image, 'open', lambda *args: opened.append(args))
+
+        with pytest.raises(ValueError):
+            st.save(b'%PDF-1.7\n', 'test.png')
+        # Rejected without trying to decode
+        assert not opened
+
+@pytest.mark.parametrize("app_manager", [('local', 'image', { 'KEEP_ORIGINAL': True, 'ALTERNATE_FORMATS': ['WEBP'] })],
+                         indirect=True)
+class TestLocalImageManagerKeepOriginal:
+
+    def test_save_verbatim(self, app_manager, utils):
+        st = mm.by_name()
+
+        with open("tests/flask.png", 'rb') as fp:
+            data = fp.read()
+        with profile() as p:
+            filename = st.save(utils.filestorage('flask.png', data), strip_metadata=False)
+        assert st.read(filename) == data
+        assert st.get_source(filename) == filename
+        assert st.exists(st.get_variant(filename, 'WEBP'))
+        assert st.exists(st.get_thumbnail(filename))
+        # Only the thumbnail and the alternate encodings are encoded
+        assert [s['stage'] for s in p.stages].count('encode') == 3
+        st.delete(filename)
+
+    def test_strip_metadata(self, app_manager, utils):
+        st = mm.by_name()
+
+        exif = Image.Exif()
+        exif[0x010f] = 'Camera'
+        data = encode(Image.new('RGB', (40, 40), 'red'), 'JPEG', exif=exif)
+        filename = st.save(utils.filestorage('image.jpg', data))
+        # The metadata is stripped from the image, the upload is kept as it is
+        assert not Image.open(io.BytesIO(st.read(filename))).getexif()
+        assert st.read_source(filename) == data
+        st.delete(filename)
+
+    def test_save_transformed(self, app_manager, utils):
+        st = mm.by_name()
+
+        with open("tests/flask.png", 'rb') as fp:
+            data = fp.read()
+        filename = st.save(utils.filestorage('flask.png', data), size=(400, 400, False))
+        source = st.get_source(filename)
+        assert source != filename
+        assert source.startswith('_sources/') and source.endswith('_src.png')
+        assert st.read_source(filename) == data
+        assert st.read(filename) != data
+        st.delete(filename)
+        assert not st.exists(source)
+
+    def test_save_other_format(self, app_manager, utils):
+        st = mm.by_name()
+
+        data = encode(Image.new('RGB', (40, 40), 'red'), 'BMP')
+        filename = st.save(utils.filestorage('image.bmp', data))
+        source = st.get_source(filename)
+        assert source.endswith('_src.bmp')
+        assert st.read_source(filename) == data
+        st.delete(filename)
+        assert not st.exists(source)
+
+    def test_source_not_served(self, app_manager, utils):
+        st = mm.by_name()
+
+        filename = st.save(utils.filestorage('image.jpg', encode(Image.new('RGB', (40, 40), 'red'), 'JPEG')))
+        client = app_manager.test_client()
+        assert client.get(url_for('mm.get_file', mm=st.name, filename=filename)).status_code == 200
+        for source in (st.get_source(filename), 'x/../' + st.get_source(filename)):
+            assert client.get(url_for('mm.get_file', mm=st.name, filename=source)).status_code == 404
+        st.delete(filename)
+
+    def test_source_storage(self, app_manager, utils, tmp_path):
+        st = mm.by_name()
+        manager = st.__class__(None, 'sources', st.storage, keep_original=True,
+                               source_storage={'STORAGE': 'local', 'ROOT': str(tmp_path)})
+
+        data = encode(Image.new('RGB', (40, 40), 'red'), 'BMP')
+        filename = manager.save(utils.filestorage('image.bmp', data))
+        source = manager.get_source(filename)
+        assert (tmp_path / source).read_bytes() == data
+        assert not st.storage.exists(source)
+        assert manager.read_source(filename) == data
+        manager.delete(filename)
+        assert not (tmp_path / source).exists()
+
+    def test_invalid_source_prefix(self, app_manager):
+        with pytest.raises(ValueError):
+            mm.by_name().__class__(None, 'test', mm.by_name().storage, source_prefix='sources')
+
+def encode(image, format, **kwargs):
+    buffer = io.BytesIO()
+    image.save(buffer, format, **kwargs)
+    return buffer.getvalue()
+
+@pytest.mark.parametrize("app_manager", [('local', 'image', { 'PROBE_SIZE': 1024 })], indirect=True)
+class TestLocalImageManagerProbe:
+
+    @pytest.mark.parametrize("format", ['JPEG', 'PNG', 'WEBP'])
+    def test_probe(self, app_manager, format):
+        st = mm.by_name()
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        st.write('probe.img', overwrite=True, content=encode(Image.effect_noise((300, 200), 50).convert('RGB'), format, exif=exif))
+
+        info = st.probe('probe.img')
+        assert info['format'] == format
+        assert (info['width'], info['height']) == (300, 200)
+        assert info['orientation'] == 6
+        assert (info['display_width'], info['display_height']) == (200, 300)
+        st.storage.delete('probe.img')
+
+    @pytest.mark.parametrize("count", [1, 2])
+    def test_animated_gif(self, app_manager, count):
+        st = mm.by_name()
+        # The first frame is longer than the probe read
+        frames = [Image.effect_noise((100, 100), 50 + i).convert('P') for i in range(count)]
+        st.write('probe.gif', encode(frames[0], 'GIF', save_all=True, append_images=frames[1:]), overwrite=True)
+
+        assert st.probe('probe.gif')['animated'] == (count > 1)
+        st.storage.delete('probe.gif')
+
+    def test_animation_unknown(self, app_manager):
+        frames = [Image.effect_noise((100, 100), 50 + i).convert('P') for i in range(2)]
+        data = encode(frames[0], 'GIF', save_all=True, append_images=frames[1:])[:1024]
+        with pytest.raises(ValueError):
+            probe_image(data, complete=False)
+        # The longest header read ends in the first frame
+        assert probe_image(data, complete=False, best_effort=True)['animated'] is None
+
+    def test_partial_read(self, app_manager, monkeypatch):
+        st = mm.by_name()
+        st.write('probe.jpg', overwrite=True, content=encode(Image.effect_noise((1000, 1000), 50).convert('RGB'), 'JPEG'))
+        monkeypatch.setattr(st.storage, 'read', None)
+
+        assert st.probe('probe.jpg')['width'] == 1000
+        st.storage.delete('probe.jpg')
+
+    def test_cache(self, app_manager):
+        st = mm.by_name()
+        st.write('probe.png', encode(Image.new('RGB', (10, 10)), 'PNG'), overwrite=True)
+        assert st.probe('probe.png')['width'] == 10
+        st.write('probe.png', encode(Image.new('RGB', (20, 10)), 'PNG'), overwrite=True)
+        assert st.probe('probe.png')['width'] == 20
+        st.storage.delete('probe.png')
+
+    def test_changed_by_other_process(self, app_manager):
+        st = mm.by_name()
+        st.write('probe.png', encode(Image.new('RGB', (10, 10)), 'PNG'), overwrite=True)
+        assert st.probe('probe.png')['width'] == 10
+        # Written to the storage directly, the cached result is not forgotten
+        st.storage.write('probe.png', encode(Image.new('RGB', (20, 10)), 'PNG'))
+        assert st.probe('probe.png')['width'] == 20
+        st.storage.delete('probe.png')
+
+    def test_header_only(self, app_manager, monkeypatch):
+        st = mm.by_name()
+        st.write('probe.png', b'%PDF-1.7\n' + b'x' * (5 * 1024 * 1024), overwrite=True)
+        monkeypatch.setattr(st.storage, 'read', None)
+        reads = []
+        read_head = st.storage.read_head
+        monkeypatch.setattr(st.storage, 'read_head', lambda name, size: reads.append(size) or read_head(name, size))
+
+        with pytest.raises(ValueError):
+            st.probe('probe.png')
+        assert reads == [1024]
+        st.storage.delete('probe.png')
+
+    def test_probe_many(self, app_manager):
+        st = mm.by_name()
+        names = ['probe%d.png' % i for i in range(5)]
+        for i, name in enumerate(names):
+            st.write(name, encode(Image.new('RGB', (i + 1, 1)), 'PNG'), overwrite=True)
+        st.write('invalid.png', b'test', overwrite=True)
+
+        results = st.probe_many(names + ['invalid.png', 'missing.png'])
+        assert [results[name]['width'] for name in names] == [1, 2, 3, 4, 5]
+        assert results['invalid.png'] is None
+        assert results['missing.png'] is None
+        for name in names + ['invalid.png']:
+            st.storage.delete(name)
+
+def oriented_jpeg(size=(300, 200), orientation=6):
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    exif[0x010f] = 'Camera'
+    return encode(Image.new('RGB', size, 'red'), 'JPEG', exif=exif)
+
+@pytest.mark.parametrize("app_manager", [('local', 'image', { 'MAX_SIZE': (100, 100, False),
+                                                              'THUMBNAIL_SIZE': (50, 80, True),
+                                                              'STRIP_METADATA': ['XMP'] })], indirect=True)
+class TestLocalImageManagerOrientation:
+
+    def test_resize(self, app_manager, utils):
+        st = mm.by_name()
+
+        with profile() as p:
+            filename = st.save(utils.filestorage('photo.jpg', oriented_jpeg()))
+        image = Image.open(io.BytesIO(st.read(filename)))
+        assert image.size == (67, 100)
+        exif = image.getexif()
+        assert 0x0112 not in exif
+        assert exif[0x010f] == 'Camera'
+        assert Image.open(io.BytesIO(st.read(st.get_thumbnail(filename)))).size == (50, 80)
+        # Only the reduced image is transposed
+        assert 'orient' not in [s['stage'] for s in p.stages]
+        st.delete(filename)
+
+    def test_full_size(self, app_manager, utils):
+        st = mm.by_name()
+
+        filename = st.save(utils.filestorage('photo.jpg', oriented_jpeg((60, 40), 8)))
+        assert Image.open(io.BytesIO(st.read(filename))).size == (40, 60)
+        st.delete(filename)
+
+    def test_disabled(self, app_manager, utils):
+        st = mm.by_name()
+
+        filename = st.save(utils.filestorage('photo.jpg', oriented_jpeg()), exif_orientation=False)
+        image = Image.open(io.BytesIO(st.read(filename)))
+        assert image.size == (100, 67)
+        assert image.getexif()[0x0112] == 6
+        st.delete(filename)
+
+    def test_strip_all(self, app_manager, utils):
+        st = mm.by_name()
+
+        filename = st.save(utils.filestorage('photo.jpg', oriented_jpeg()), strip_metadata=True)
+        assert not Image.open(io.BytesIO(st.read(filename))).getexif()
+        st.delete(filename)
+
+    @pytest.mark.parametrize("strip_metadata, kept", [(True, False), (['XMP'], True)])
+    def test_png_icc_profile(self, app_manager, utils, strip_metadata, kept):
+        st = mm.by_name()
+
+        data = encode(Image.new('RGB', (300, 200), 'red'), 'PNG', icc_profile=b'profile')
+        filename = st.save(utils.filestorage('image.png', data), strip_metadata=strip_metadata, output_format='PNG')
+        image = Image.open(io.BytesIO(st.read(filename)))
+        assert (image.format, image.size) == ('PNG', (100, 67))
+        assert ('icc_profile' in image.info) == kept
+        st.delete(filename)
+
+    def test_invalid_strip_metadata(self, app_manager):
+        with pytest.raises(ValueError):
+            mm.by_name().__class__(None, 'test', mm.by_name().storage, strip_metadata=['GPS'])
+
+def animated_gif(count=3, size=(300, 200), duration=100, **kwargs):
+    kwargs.setdefault('loop', 0)
+    if kwargs['loop'] is None:
+        # Played once
+        del kwargs['loop']
+    frames = [Image.new('RGB', size, color) for color in ('red', 'green', 'blue', 'white')[:count]]
+    return encode(frames[0], 'GIF', save_all=True, append_images=frames[1:], duration=duration, **kwargs)
+
+@pytest.mark.parametrize("app_manager", [('local', 'image', { 'MAX_SIZE': (100, 100, False),
+                                                              'ANIMATION': 'KEEP',
+                                                              'MAX_FRAMES': 3,
+                                                              'MAX_DURATION': 1000 })], indirect=True)
+class TestLocalImageManagerAnimation:
+
+    def test_keep(self, app_manager, utils):
+        st = mm.by_name()
+
+        filename = st.save(utils.filestorage('animation.gif', animated_gif()))
+        assert filename.endswith('.gif')
+        image = Image.open(io.BytesIO(st.read(filename)))
+        assert image.n_frames == 3
+        assert image.size == (100, 67)
+        assert image.info['duration'] == 100
+        # The thumbnail is the first frame
+        thumbnail = Image.open(io.BytesIO(st.read(st.get_thumbnail(filename))))
+        assert not getattr(thumbnail, 'is_animated', False)
+        st.delete(filename)
+
+    def test_webp(self, app_manager, utils):
+        st = mm.by_name()
+
+        filename = st.save(utils.filestorage('animation.gif', animated_gif()), animation='WEBP',
+                           animated_thumbnail=True)
+        assert filename.endswith('.webp')
+        assert Image.open(io.BytesIO(st.read(filename))).n_frames == 3
+        assert Image.open(io.BytesIO(st.read(st.get_thumbnail(filename)))).n_frames == 3
+        st.delete(filename)
+
+    def test_flatten(self, app_manager, utils):
+        st = mm.by_name()
+
+        filename = st.save(utils.filestorage('animation.gif', animated_gif()), animation=None)
+        assert not getattr(Image.open(io.BytesIO(st.read(filename))), 'is_animated', False)
+        st.delete(filename)
+
+    @pytest.mark.parametrize("count, duration", [(4, 100), (3, 500)])
+    def test_limits(self, app_manager, utils, count, duration):
+        st = mm.by_name()
+
+        with pytest.raises(ValueError):
+            st.save(utils.filestorage('animation.gif', animated_gif(count, duration=duration)))
+
+    def test_pixel_limit(self, app_manager, utils):
+        st = mm.by_name()
+        upload = animated_gif(size=(2000, 2000))
+
+        # The frames are reduced to 100x100 before they are kept
+        filename = st.save(utils.filestorage('animation.gif', upload), max_animation_pixels=30000)
+        st.delete(filename)
+        with pytest.raises(ValueError):
+            st.save(utils.filestorage('animation.gif', upload), size=None, max_animation_pixels=30000)
+
+    @pytest.mark.parametrize("animation", ['KEEP', 'WEBP'])
+    def test_play_once(self, app_manager, utils, animation):
+        st = mm.by_name()
+
+        filename = st.save(utils.filestorage('animation.gif', animated_gif(loop=None)), animation=animation)
+        assert Image.open(io.BytesIO(st.read(filename))).info.get('loop') in (None, 1)
+        st.delete(filename)
+
+    def test_invalid_mode(self, app_manager):
+        with pytest.raises(ValueError):
+            mm.by_name().__class__(None, 'test', mm.by_name().storage, animation='APNG')
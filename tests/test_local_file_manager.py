@@ -6,6 +6,7 @@ from __future__ import unicode_literals
 
 import os
 import io
+import shutil
 
 # Pip package imports
 from flask import url_for
@@ -21,6 +22,15 @@ class TestGetByName:
         init_mm.init_app(app)
         assert init_mm.by_name() == mm.by_name() == app.extensions['mediamanager']['media']
 
+    def test_by_name_case_insensitive(self, app, init_mm):
+        init_mm.init_app(app)
+        assert mm.by_name('MEDIA') == mm.by_name('media') == app.extensions['mediamanager']['media']
+
+    def test_by_name_not_found(self, app, init_mm):
+        init_mm.init_app(app)
+        with pytest.raises(KeyError):
+            mm.by_name('notfound')
+
 @pytest.mark.parametrize("app_manager", [('local', 'file', {})], indirect=True)
 class TestLocalFileManager:
 
@@ -181,3 +191,184 @@ class TestLocalFileManager:
         st.delete(filename1)
         st.delete(filename2)
         st.delete(archive)
+
+@pytest.fixture
+def sharded(app, init_mm, tmp_path):
+    app.Configure(
+        MEDIA_MANAGER = {
+            'STORAGE': 'local',
+            'MANAGER': 'file',
+            'ROOT': str(tmp_path),
+            'SHARD_DEPTH': 2,
+        }
+    )
+    init_mm.init_app(app)
+    return mm.by_name()
+
+class TestLocalShardedStorage:
+
+    def test_path(self, sharded, tmp_path):
+        st = sharded
+        relpath = st.storage.relpath('file.test')
+        parts = relpath.split(os.sep)
+        assert len(parts) == 3
+        assert all(len(part) == 2 for part in parts[:2])
+        assert st.path('file.test') == os.path.join(str(tmp_path), relpath)
+
+    def test_write_read_list(self, sharded, tmp_path):
+        st = sharded
+        st.write('file.test', b'test')
+        assert os.path.exists(os.path.join(str(tmp_path), st.storage.relpath('file.test')))
+        assert not os.path.exists(os.path.join(str(tmp_path), 'file.test'))
+        assert st.read('file.test') == b'test'
+        assert list(st.list_files()) == ['file.test']
+
+    def test_serve(self, sharded, app):
+        st = sharded
+        st.write('file.test', b'test')
+        response = app.test_client().get(st.url('file.test'))
+        assert response.data == b'test'
+        response.close()
+
+    def test_rehome(self, sharded, tmp_path, app):
+        st = sharded
+        for name in ('a.test', 'b.test'):
+            with open(os.path.join(str(tmp_path), name), 'wb') as f:
+                f.write(b'test')
+
+        assert sorted(st.list_files()) == ['a.test', 'b.test']
+        assert not st.exists('a.test')
+        result = app.test_cli_runner().invoke(args=['mm', 'rehome'])
+        assert 'Moved 2 file(s)' in result.output
+        assert st.exists('a.test') and st.exists('b.test')
+        assert sorted(st.list_files()) == ['a.test', 'b.test']
+        assert st.storage.rehome_files() == 0
+
+    def test_rehome_unshard(self, sharded, tmp_path):
+        st = sharded
+        st.write('file.test', b'test')
+        st.storage.shard_depth = 0
+        assert not st.exists('file.test')
+        assert st.storage.rehome_files(previous_depth=2) == 1
+        assert os.path.exists(os.path.join(str(tmp_path), 'file.test'))
+
+@pytest.fixture
+def atomic(app, init_mm, tmp_path):
+    app.Configure(
+        MEDIA_MANAGER = {
+            'STORAGE': 'local',
+            'MANAGER': 'file',
+            'ROOT': str(tmp_path),
+            'ATOMIC_WRITES': True,
+            'DURABILITY': 'dir',
+        }
+    )
+    init_mm.init_app(app)
+    return mm.by_name()
+
+class TestLocalAtomicStorage:
+
+    def test_write(self, atomic, tmp_path):
+        st = atomic
+        st.write('file.test', b'test')
+        assert st.read('file.test') == b'test'
+        assert os.listdir(str(tmp_path)) == ['file.test']
+
+    def test_save(self, atomic, utils, tmp_path):
+        st = atomic
+        filename = st.save(utils.filestorage('test.png', 'test'))
+        assert st.read(filename) == b'test'
+        filename = st.save(utils.file(b'test2'), 'test2.png')
+        assert st.read(filename) == b'test2'
+        assert sorted(os.listdir(str(tmp_path))) == ['test.png', 'test2.png']
+
+    def test_open_failed_write(self, atomic, tmp_path):
+        st = atomic
+        st.write('file.test', 'original')
+        with pytest.raises(RuntimeError):
+            with st.open('file.test', 'w') as f:
+                f.write('partial')
+                raise RuntimeError()
+        assert st.read('file.test') == b'original'
+        assert os.listdir(str(tmp_path)) == ['file.test']
+
+    def test_copy(self, atomic, tmp_path):
+        st = atomic
+        st.write('file.test', b'test')
+        st.storage.copy('file.test', 'copy.test')
+        assert st.read('copy.test') == b'test'
+        assert sorted(os.listdir(str(tmp_path))) == ['copy.test', 'file.test']
+
+    def test_invalid_durability(self, tmp_path):
+        from flask_mm.storages.local import LocalStorage
+        with pytest.raises(ValueError):
+            LocalStorage(str(tmp_path), durability='always')
+
+class TestLocalDirectoryCache:
+
+    def test_known_dirs(self, tmp_path):
+        from flask_mm.storages.local import LocalStorage
+        st = LocalStorage(str(tmp_path), dir_cache_size=2)
+        for name in ('a/file.test', 'b/file.test', 'c/file.test'):
+            st.write(name, b'test')
+        assert list(st._known_dirs) == [os.path.join(str(tmp_path), 'b'), os.path.join(str(tmp_path), 'c')]
+
+    def test_disabled(self, tmp_path):
+        from flask_mm.storages.local import LocalStorage
+        st = LocalStorage(str(tmp_path), dir_cache_size=0)
+        st.write('a/file.test', b'test')
+        assert not st._known_dirs
+
+    def test_delete_dir(self, tmp_path):
+        from flask_mm.storages.local import LocalStorage
+        st = LocalStorage(str(tmp_path))
+        st.write('a/b/file.test', b'test')
+        st.delete('a')
+        assert not st._known_dirs
+        st.write('a/b/file.test', b'test')
+        assert st.read('a/b/file.test') == b'test'
+
+    def test_removed_behind_cache(self, tmp_path):
+        from flask_mm.storages.local import LocalStorage
+        st = LocalStorage(str(tmp_path))
+        st.write('a/file.test', b'test')
+        shutil.rmtree(os.path.join(str(tmp_path), 'a'))
+        st.write('a/file.test', b'test2')
+        assert st.read('a/file.test') == b'test2'
+
+class TestLocalReadBuffer:
+
+    def test_read_buffer(self, tmp_path):
+        from flask_mm.storages.local import LocalStorage
+        st = LocalStorage(str(tmp_path))
+        st.write('file.test', b'test')
+        with st.read_buffer('file.test') as buffer:
+            assert isinstance(buffer, memoryview)
+            assert bytes(buffer) == b'test'
+        with pytest.raises(ValueError):
+            bytes(buffer)
+
+    def test_empty(self, tmp_path):
+        from flask_mm.storages.local import LocalStorage
+        st = LocalStorage(str(tmp_path))
+        st.write('file.test', b'')
+        with st.read_buffer('file.test') as buffer:
+            assert bytes(buffer) == b''
+
+    def test_buffer_reader(self, tmp_path):
+        from flask_mm.storages import BufferReader
+        from flask_mm.storages.local import LocalStorage
+        st = LocalStorage(str(tmp_path))
+        st.write('file.test', b'0123456789')
+        with st.read_buffer('file.test') as buffer, BufferReader(buffer) as reader:
+            assert reader.read(4) == b'0123'
+            reader.seek(-2, io.SEEK_END)
+            assert reader.read() == b'89'
+            reader.seek(0)
+            assert reader.read() == b'0123456789'
+
+    def test_metadata(self, tmp_path):
+        from flask_mm.storages.local import LocalStorage
+        st = LocalStorage(str(tmp_path))
+        st.write('file.test', b'test')
+        assert st.metadata('file.test')['checksum'] == 'sha1:a94a8fe5ccb19ba61c4c0873d391e987982fbbd3'
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Common Python library imports
+from __future__ import unicode_literals
+
+import os
+import time
+
+# Pip package imports
+import pytest
+
+# Internal package imports
+import flask_mm as mm
+from flask_mm.storages.local import LocalStorage
+from flask_mm.storages.replicated import ReplicatedStorage, HEDGE_MIN_SAMPLES
+
+class FailingStorage(LocalStorage):
+
+    def write(self, filename, content):
+        raise IOError('Disk failure')
+
+class SlowStorage(LocalStorage):
+
+    delay = 0
+
+    def read(self, filename):
+        time.sleep(self.delay)
+        return super(SlowStorage, self).read(filename)
+
+def local(tmp_path, name, cls=LocalStorage):
+    return cls(str(tmp_path / name))
+
+class TestReplicatedStorage:
+
+    def test_write_all(self, tmp_path):
+        st = ReplicatedStorage([local(tmp_path, 'a'), local(tmp_path, 'b')])
+        st.write('file.test', b'test')
+        assert os.path.exists(str(tmp_path / 'a' / 'file.test'))
+        assert os.path.exists(str(tmp_path / 'b' / 'file.test'))
+        assert st.read('file.test') == b'test'
+        with st.open('file.test', 'rb') as f:
+            assert f.read() == b'test'
+        st.delete('file.test')
+        assert not st.exists('file.test')
+
+    def test_open_write(self, tmp_path):
+        st = ReplicatedStorage([local(tmp_path, 'a'), local(tmp_path, 'b')])
+        with st.open('file.test', 'w') as f:
+            f.write('test')
+        assert st.replicas[1].storage.read('file.test') == b'test'
+
+    def test_quorum(self, tmp_path):
+        st = ReplicatedStorage([local(tmp_path, 'a'), local(tmp_path, 'b', FailingStorage)], write_quorum=1)
+        st.write('file.test', b'test')
+        assert st.read('file.test') == b'test'
+        # The failing replica may be still written in the background
+        deadline = time.time() + 1
+        while st.replicas[1].healthy and time.time() < deadline:
+            time.sleep(0.01)
+        assert not st.replicas[1].healthy
+        assert st._ordered()[0] is st.replicas[0]
+
+    def test_quorum_failed(self, tmp_path):
+        st = ReplicatedStorage([local(tmp_path, 'a'), local(tmp_path, 'b', FailingStorage)])
+        with pytest.raises(IOError):
+            st.write('file.test', b'test')
+
+    def test_invalid_quorum(self, tmp_path):
+        with pytest.raises(ValueError):
+            ReplicatedStorage([local(tmp_path, 'a')], write_quorum=2)
+
+    def test_read_missing_replica(self, tmp_path):
+        st = ReplicatedStorage([local(tmp_path, 'a'), local(tmp_path, 'b')], write_quorum=1)
+        st.replicas[1].storage.write('file.test', b'test')
+        assert st.exists('file.test')
+        assert st.read('file.test') == b'test'
+        with st.read_buffer('file.test') as buffer:
+            assert bytes(buffer) == b'test'
+
+    def test_s3_missing_replica(self, tmp_path, s3_endpoint):
+        from flask_mm.storages.s3 import S3Storage
+        s3 = S3Storage('mm-replicas', 'us-east-1', 'test', 'test', endpoint_url=s3_endpoint)
+        with pytest.raises(FileNotFoundError):
+            s3.read('missing.test')
+        st = ReplicatedStorage([s3, local(tmp_path, 'b')], write_quorum=1)
+        st.replicas[1].storage.write('file.test', b'test')
+        for _ in range(3):
+            assert st.read('file.test') == b'test'
+            assert st.read_head('file.test', 2) == b'te'
+        # A missing object is not a failure of the replica
+        assert st.replicas[0].healthy
+
+    def test_fastest_replica(self, tmp_path):
+        st = ReplicatedStorage([local(tmp_path, 'a'), local(tmp_path, 'b')])
+        st.replicas[0].latencies.extend([1.0] * 5)
+        st.replicas[1].latencies.extend([0.1] * 5)
+        assert st._ordered()[0] is st.replicas[1]
+
+    def test_hedge(self, tmp_path):
+        slow = local(tmp_path, 'a', SlowStorage)
+        st = ReplicatedStorage([slow, local(tmp_path, 'b')])
+        st.write('file.test', b'test')
+        st.replicas[0].latencies.extend([0.01] * HEDGE_MIN_SAMPLES)
+        st.replicas[1].latencies.extend([0.05] * HEDGE_MIN_SAMPLES)
+        slow.delay = 1
+        start = time.time()
+        assert st.read('file.test') == b'test'
+        assert time.time() - start < 0.5
+
+@pytest.fixture
+def replicated_app(app, init_mm, tmp_path):
+    app.Configure(
+        MEDIA_MANAGER = {
+            'STORAGE': 'replicated',
+            'MANAGER': 'file',
+            'REPLICAS': [
+                {'STORAGE': 'local', 'ROOT': str(tmp_path / 'a')},
+                {'STORAGE': 'local', 'ROOT': str(tmp_path / 'b')},
+            ],
+        }
+    )
+    init_mm.init_app(app)
+    return app
+
+class TestReplicatedStorageConfig:
+
+    def test_configure(self, replicated_app, tmp_path):
+        st = mm.by_name()
+        assert isinstance(st.storage, ReplicatedStorage)
+        assert [r.storage.root for r in st.storage.replicas] == [str(tmp_path / 'a'), str(tmp_path / 'b')]
+
+    def test_serve(self, replicated_app):
+        st = mm.by_name()
+        st.write('file.test', b'test')
+        response = replicated_app.test_client().get(st.url('file.test'))
+        assert response.data == b'test'
+        response.close()
+
+    def test_missing_root(self, tmp_path):
+        with pytest.raises(ValueError) as e:
+            ReplicatedStorage([{'STORAGE': 'local'}], root=str(tmp_path))
+        assert 'replica 0 is missing ROOT' in str(e.value)
@@ -184,3 +184,18 @@ class TestS3FileManager:
         st.delete(filename1)
         st.delete(filename2)
         st.delete(archive)
+
+    def test_copy_move(self, app_manager):
+        st = mm.by_name()
+
+        st.write('copy.test', b'test')
+        st.storage.copy('copy.test', 'copied.test')
+        assert st.read('copied.test') == b'test'
+        st.storage.move('copied.test', 'moved.test')
+        assert not st.exists('copied.test')
+        assert st.read('moved.test') == b'test'
+
+        assert st.storage.move_files([('copy.test', 'batch/copy.test'), ('moved.test', 'batch/moved.test')]) == 2
+        assert st.exists('batch/copy.test') and st.exists('batch/moved.test')
+        st.delete('batch/copy.test')
+        st.delete('batch/moved.test')
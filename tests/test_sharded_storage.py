@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Common Python library imports
+from __future__ import unicode_literals
+
+import os
+import zipfile
+
+# Pip package imports
+import pytest
+
+# Internal package imports
+import flask_mm as mm
+from flask_mm.storages.local import LocalStorage
+from flask_mm.storages.sharded import ShardedStorage, HashRing
+
+FILENAMES = ['file%d.test' % i for i in range(40)]
+
+def sharded(tmp_path, count, **kwargs):
+    return ShardedStorage([LocalStorage(str(tmp_path / str(i))) for i in range(count)], **kwargs)
+
+class TestHashRing:
+
+    def test_stable(self):
+        assert HashRing(range(3)).get('file.test') == HashRing(range(3)).get('file.test')
+
+    def test_add_node(self):
+        before, after = HashRing(range(3)), HashRing(range(4))
+        moved = [key for key in FILENAMES if before.get(key) != after.get(key)]
+        # Only the keys taken over by the new node move
+        assert all(after.get(key) == 3 for key in moved)
+        assert 0 < len(moved) < len(FILENAMES) / 2
+
+class TestShardedStorage:
+
+    def test_route(self, tmp_path):
+        st = sharded(tmp_path, 3)
+        for filename in FILENAMES:
+            st.write(filename, filename)
+        for filename in FILENAMES:
+            assert st.shard(filename).exists(filename)
+            assert st.read(filename) == filename.encode('utf8')
+        assert all(list(shard.list_files()) for shard in st.shards)
+        assert sorted(st.list_files()) == sorted(FILENAMES)
+
+    def test_copy_move(self, tmp_path):
+        st = sharded(tmp_path, 3)
+        st.write('file0.test', b'test')
+        st.copy('file0.test', 'file1.test')
+        st.move('file1.test', 'file2.test')
+        assert st.read('file2.test') == b'test'
+        assert not st.exists('file1.test')
+        assert st.shard('file2.test').exists('file2.test')
+
+    def test_archive(self, tmp_path):
+        st = sharded(tmp_path, 3)
+        for filename in FILENAMES[:5]:
+            st.write(filename, filename)
+        st.archive_files('files.zip', FILENAMES[:5])
+        with st.open('files.zip', 'rb') as f:
+            assert sorted(zipfile.ZipFile(f).namelist()) == sorted(FILENAMES[:5])
+
+    def test_rebalance(self, tmp_path):
+        st = sharded(tmp_path, 3)
+        for filename in FILENAMES:
+            st.write(filename, filename)
+        grown = sharded(tmp_path, 4, shard_fallback=True)
+        assert all(grown.exists(filename) for filename in FILENAMES)
+        moved = grown.rebalance()
+        assert moved == len(list(grown.shards[3].list_files())) > 0
+        grown.shard_fallback = False
+        for filename in FILENAMES:
+            assert grown.read(filename) == filename.encode('utf8')
+        assert grown.rebalance() == 0
+
+@pytest.fixture
+def sharded_app(app, init_mm, tmp_path):
+    app.Configure(
+        MEDIA_MANAGER = {
+            'STORAGE': 'sharded',
+            'MANAGER': 'file',
+            'SHARDS': [
+                {'STORAGE': 'local', 'ROOT': str(tmp_path / 'a')},
+                {'STORAGE': 'local', 'ROOT': str(tmp_path / 'b')},
+            ],
+        }
+    )
+    init_mm.init_app(app)
+    return app
+
+class TestShardedStorageConfig:
+
+    @pytest.mark.parametrize("shards, message", [
+        ([{'STORAGE': 'local', 'ROOT': 'a'}, {'ROOT': 'b'}], 'shard 1 is missing STORAGE'),
+        ([{'STORAGE': 'local', 'ROOT': 'a'}, {'STORAGE': 'local'}], 'shard 1 is missing ROOT'),
+        ([{'STORAGE': 'local', 'ROOT': 'a'}, {'STORAGE': 'local', 'ROOT': 'a/'}], 'same ROOT as shard 0'),
+    ])
+    def test_invalid_shards(self, tmp_path, shards, message):
+        for shard in shards:
+            if 'ROOT' in shard:
+                shard['ROOT'] = os.path.join(str(tmp_path), shard['ROOT'])
+        with pytest.raises(ValueError) as e:
+            ShardedStorage(shards, root=str(tmp_path))
+        assert message in str(e.value)
+
+    def test_serve(self, sharded_app):
+        st = mm.by_name()
+        assert isinstance(st.storage, ShardedStorage)
+        st.write('file.test', b'test')
+        response = sharded_app.test_client().get(st.url('file.test'))
+        assert response.data == b'test'
+        response.close()
+
+    def test_rebalance_command(self, sharded_app):
+        result = sharded_app.test_cli_runner().invoke(args=['mm', 'rebalance'])
+        assert 'Moved 0 file(s)' in result.output
+
+class TestS3PrefixShards:
+
+    def sharded(self, s3_endpoint, count):
+        from flask_mm.storages.s3 import S3Storage
+        return ShardedStorage([S3Storage('mm-shards', 'us-east-1', 'test', 'test', endpoint_url=s3_endpoint,
+                                         root='p%d' % i) for i in range(count)])
+
+    def test_list_and_rebalance(self, s3_endpoint):
+        filenames = FILENAMES[:12]
+        st = self.sharded(s3_endpoint, 2)
+        for filename in filenames:
+            st.write(filename, filename)
+        assert sorted(st.list_files()) == sorted(filenames)
+
+        grown = self.sharded(s3_endpoint, 3)
+        assert grown.rebalance() == len(list(grown.shards[2].list_files())) > 0
+        assert sorted(grown.list_files()) == sorted(filenames)
+        assert grown.read(filenames[0]) == filenames[0].encode('utf8')
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Common Python library imports
+from __future__ import unicode_literals
+
+from contextlib import contextmanager
+
+# Pip package imports
+import pytest
+
+pytest.importorskip('blinker')
+
+# Internal package imports
+import flask_mm as mm
+from flask_mm import signals
+
+
+@contextmanager
+def captured(signal):
+    events = []
+    def receiver(sender, **kwargs):
+        events.append((sender, kwargs))
+    signal.connect(receiver)
+    try:
+        yield events
+    finally:
+        signal.disconnect(receiver)
+
+
+@pytest.mark.parametrize("app_manager", [('local', 'file', {})], indirect=True)
+class TestOperationSignals:
+
+    def test_manager_operation(self, app_manager):
+        st = mm.by_name()
+
+        with captured(signals.manager_operation) as events:
+            st.write('signal.test', b'12345', overwrite=True)
+            assert st.read('signal.test') == b'12345'
+            st.delete('signal.test')
+
+        assert [(e[1]['operation'], e[1]['filename'], e[1]['size']) for e in events] == [
+            ('write', 'signal.test', 5),
+            ('read', 'signal.test', 5),
+            ('delete', 'signal.test', None),
+        ]
+        assert all(e[0] is st for e in events)
+        assert all(e[1]['duration'] >= 0 for e in events)
+
+    def test_storage_operation(self, app_manager):
+        st = mm.by_name()
+
+        with captured(signals.storage_operation) as events:
+            st.write('signal.test', b'12345', overwrite=True)
+            st.delete('signal.test')
+
+        assert [e[1]['operation'] for e in events] == ['write', 'delete']
+        assert all(e[0] is st.storage for e in events)
+
+    def test_not_connected(self, app_manager):
+        assert not signals.is_connected(signals.manager_operation)
+        with captured(signals.manager_operation):
+            assert signals.is_connected(signals.manager_operation)
+        assert not signals.is_connected(signals.manager_operation)
+
+
+@pytest.mark.parametrize("app_manager", [('local', 'image', { 'MAX_SIZE': (400, 400, False) })], indirect=True)
+class TestImageStageSignals:
+
+    def test_image_stages(self, app_manager, utils):
+        st = mm.by_name()
+
+        with open('tests/flask.png', 'rb') as fp:
+            f = utils.filestorage('flask.png', fp)
+            with captured(signals.image_stage) as events:
+                filename = st.save(f)
+
+        stages = [e[1]['stage'] for e in events]
+        assert stages == ['decode', 'resize', 'thumbnail', 'encode', 'store', 'encode', 'store']
+        decode = events[0][1]
+        assert (decode['width'], decode['height']) == (3000, 1174)
+        assert events[1][1]['width'] == 400
+        assert all(e[1]['size'] > 0 for e in events if e[1]['stage'] in ('encode', 'store'))
+        st.delete(filename)
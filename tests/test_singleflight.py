@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Common Python library imports
+from __future__ import unicode_literals
+
+import os
+import threading
+import time
+
+# Pip package imports
+import pytest
+
+# Internal package imports
+from flask_mm.singleflight import SingleFlight
+from flask_mm.storages.local import LocalStorage
+from flask_mm.storages.cached import CachedStorage
+
+def run_concurrently(func, count=8):
+    results = [None] * count
+    def target(index):
+        try:
+            results[index] = func()
+        except Exception as e:
+            results[index] = e
+    threads = [threading.Thread(target=target, args=(i, )) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+class TestSingleFlight:
+
+    def test_coalesce(self):
+        flights = SingleFlight()
+        calls = []
+        def work():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'result'
+        results = run_concurrently(lambda: flights.do('key', work))
+        assert results == ['result'] * 8
+        assert len(calls) == 1
+        assert len(flights) == 0
+
+    def test_error(self):
+        flights = SingleFlight()
+        def work():
+            time.sleep(0.2)
+            raise KeyError('missing')
+        results = run_concurrently(lambda: flights.do('key', work), count=2)
+        assert all(isinstance(r, KeyError) for r in results)
+        assert len(flights) == 0
+
+    def test_lock_dir(self, tmp_path):
+        flights = SingleFlight(str(tmp_path / 'locks'))
+        assert flights.do_shared('key', lambda x: x * 2, 2) == 4
+        assert len(os.listdir(str(tmp_path / 'locks'))) == 1
+
+    def test_local_only(self, tmp_path):
+        flights = SingleFlight(str(tmp_path / 'locks'))
+        assert flights.do('key', lambda x: x * 2, 2) == 4
+        assert os.listdir(str(tmp_path / 'locks')) == []
+
+    def test_lock_stripes(self, tmp_path):
+        flights = SingleFlight(str(tmp_path / 'locks'), stripes=4)
+        for i in range(50):
+            flights.do_shared(('key', i), lambda: None)
+        assert len(os.listdir(str(tmp_path / 'locks'))) <= 4
+
+    def test_nested(self, tmp_path):
+        flights = SingleFlight(str(tmp_path / 'locks'), stripes=1)
+        # The inner call maps to the stripe which is locked already
+        assert flights.do_shared('outer', lambda: flights.do_shared('inner', lambda: 'done')) == 'done'
+
+class SlowStorage(LocalStorage):
+
+    def __init__(self, *args, **kwargs):
+        super(SlowStorage, self).__init__(*args, **kwargs)
+        self.opened = 0
+
+    def open(self, filename, mode='r', encoding='utf8'):
+        if 'r' in mode:
+            self.opened += 1
+            time.sleep(0.2)
+        return super(SlowStorage, self).open(filename, mode, encoding)
+
+class TestCoalescedStorage:
+
+    def test_cache_fill(self, tmp_path):
+        origin = SlowStorage(str(tmp_path / 'origin'))
+        origin.write('file.test', b'test')
+        st = CachedStorage(origin, cache_root=str(tmp_path / 'cache'), cache_memory_size=0)
+        assert run_concurrently(lambda: st.read('file.test')) == [b'test'] * 8
+        assert origin.opened == 1
+
+    def test_disabled(self, tmp_path):
+        origin = SlowStorage(str(tmp_path / 'origin'))
+        st = CachedStorage(origin, cache_root=str(tmp_path / 'cache'), coalesce=False)
+        assert st.flights is None
+        st.write('file.test', b'test')
+        assert st.read('file.test') == b'test'
+
+    def test_shared_cache_dir(self, tmp_path):
+        origin = SlowStorage(str(tmp_path / 'origin'))
+        origin.write('file.test', b'test')
+        kwargs = dict(cache_root=str(tmp_path / 'cache'), cache_memory_size=0, lock_dir=str(tmp_path / 'locks'))
+        # Two caches over the same directory stand in for two processes
+        first, second = CachedStorage(origin, **kwargs), CachedStorage(origin, **kwargs)
+        assert first.read('file.test') == b'test'
+        assert second.read('file.test') == b'test'
+        assert origin.opened == 1
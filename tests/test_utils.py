@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Common Python library imports
+from __future__ import unicode_literals
+
+import time
+
+# Pip package imports
+import pytest
+
+# Internal package imports
+from flask_mm.utils import UuidNameGen, UlidNameGen, get_name_gen
+
+
+@pytest.mark.parametrize("namegen", [UuidNameGen, UlidNameGen])
+class TestNameGen:
+
+    def test_original_name(self, namegen):
+        name = namegen.generate_name('flask_sep_image.jpg')
+        assert namegen.get_original_name(name) == 'image.jpg'
+        assert namegen.get_original_name('image.jpg') == 'Not valid'
+
+    def test_unique(self, namegen):
+        names = namegen.generate_names(['image.jpg'] * 100)
+        assert len(set(names)) == 100
+        assert all(namegen.get_original_name(name) == 'image.jpg' for name in names)
+
+    def test_thumbnail_name(self, namegen):
+        assert namegen.thumbgen_filename('dir/image.jpg') == 'dir/image_thumb.jpg'
+
+
+def test_ulid_sortable():
+    first = UlidNameGen.generate_name('b.jpg')
+    time.sleep(0.002)
+    second = UlidNameGen.generate_name('a.jpg')
+    assert first < second
+
+
+def test_get_name_gen():
+    assert get_name_gen('ULID') is UlidNameGen
+    assert get_name_gen(UuidNameGen) is UuidNameGen
+    with pytest.raises(ValueError):
+        get_name_gen('notexists')
@@ -49,3 +49,94 @@ class TestUrls:
         response = app_manager.test_client().get(file_url)
         assert response.status_code == 404
 
+
+@pytest.mark.parametrize("app_manager", [('local', 'image', { 'ALTERNATE_FORMATS': ['WEBP'] })], indirect=True)
+class TestNegotiation:
+
+    def test_get_file_accept_webp(self, app_manager, utils):
+        st = mm.by_name()
+
+        with open('tests/flask.jpg', 'rb') as fp:
+            filename = st.save(utils.filestorage('flask.jpg', fp))
+
+        file_url = url_for('mm.get_file', mm='media', filename=filename)
+        response = app_manager.test_client().get(file_url, headers={'Accept': 'image/avif,image/webp,*/*'})
+        assert response.status_code == 200
+        assert response.mimetype == 'image/webp'
+        assert 'Accept' in response.vary
+        response.close()
+        st.delete(filename)
+
+    def test_get_file_accept_wildcard(self, app_manager, utils):
+        st = mm.by_name()
+
+        with open('tests/flask.jpg', 'rb') as fp:
+            filename = st.save(utils.filestorage('flask.jpg', fp))
+
+        file_url = url_for('mm.get_file', mm='media', filename=filename)
+        response = app_manager.test_client().get(file_url, headers={'Accept': 'image/*,*/*;q=0.8'})
+        assert response.status_code == 200
+        assert response.mimetype == 'image/jpeg'
+        assert 'Accept' in response.vary
+        response.close()
+        st.delete(filename)
+
+@pytest.mark.parametrize("app_manager", [('local', 'image', {})], indirect=True)
+class TestNoNegotiation:
+
+    def test_get_file_single_encoding(self, app_manager, utils, monkeypatch):
+        st = mm.by_name()
+
+        with open('tests/flask.jpg', 'rb') as fp:
+            filename = st.save(utils.filestorage('flask.jpg', fp))
+        lookups = []
+        exists = st.storage.exists
+        monkeypatch.setattr(st.storage, 'exists', lambda name: lookups.append(name) or exists(name))
+
+        file_url = url_for('mm.get_file', mm='media', filename=filename)
+        response = app_manager.test_client().get(file_url, headers={'Accept': 'image/avif,image/webp,*/*'})
+        assert response.mimetype == 'image/jpeg'
+        assert 'Accept' not in response.vary
+        response.close()
+        # Only the image itself is looked up
+        assert lookups == [filename]
+        st.delete(filename)
+
+@pytest.mark.parametrize("app_manager", [('local', 'image', { 'GENERATE_VARIANTS': True })], indirect=True)
+class TestNegotiationGenerateVariants:
+
+    def test_get_file_generate_variant(self, app_manager, utils):
+        st = mm.by_name()
+
+        with open('tests/flask.png', 'rb') as fp:
+            filename = st.save(utils.filestorage('flask.png', fp))
+        assert not st.get_variants(filename)
+
+        file_url = url_for('mm.get_file', mm='media', filename=filename)
+        response = app_manager.test_client().get(file_url, headers={'Accept': 'image/webp'})
+        assert response.mimetype == 'image/webp'
+        response.close()
+        assert 'WEBP' in st.get_variants(filename)
+        st.delete(filename)
+
+@pytest.mark.parametrize("app_manager", [('local', 'file', {})], indirect=True)
+class TestUrlFastPath:
+
+    @pytest.mark.parametrize("filename", ['test.txt', '/test.txt', 'dir/sub dir/test.txt', 'árvíztűrő.png', 'a:b?c#d.txt'])
+    def test_url_matches_url_for(self, app_manager, filename):
+        st = mm.by_name()
+
+        expected_filename = filename[1:] if filename.startswith('/') else filename
+        assert st.url(filename) == url_for('mm.get_file', mm=st.name, filename=expected_filename)
+        assert st.url(filename, external=True) == url_for('mm.get_file', mm=st.name, filename=expected_filename, _external=True)
+
+    def test_url_filestorage(self, app_manager, utils):
+        st = mm.by_name()
+
+        f = utils.filestorage('test.txt', 'test')
+        assert st.url(f) == url_for('mm.get_file', mm=st.name, filename='test.txt')
+
+    def test_urls(self, app_manager):
+        st = mm.by_name()
+
+        assert st.urls(['a.txt', 'b.txt']) == [st.url('a.txt'), st.url('b.txt')]